@@ -0,0 +1,443 @@
+"""pyfind benchmarks
+
+Generates reproducible synthetic corpora and measures search performance for
+each search engine and option, to catch performance regressions in pyfind.
+Results are saved to a JSON file, which can be compared with the results of
+a previous run:
+
+    python benchmark.py --output before.json
+    (make changes)
+    python benchmark.py --output after.json --compare before.json
+
+Each benchmark case is run in a fresh process, so that peak memory use (RSS)
+is measured separately for each case. Peak RSS isn't available on Windows.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+from pyfind import NotebookCache, Search
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# text planted in each corpus, for measuring time to first match
+NEEDLE = "pyfind_benchmark_needle"
+
+# words used to generate Python-like source code
+WORDS = (
+    "self data value result items config path name count index json dumps "
+    "loads request response os file line text search match folder options args"
+).split()
+
+# generated corpora, by name
+CORPORA = ["deep_tree", "huge_file", "notebooks", "minified"]
+
+# benchmark cases: (name, corpus, Search keyword arguments)
+CASES: List[Tuple[str, str, dict]] = [
+    (f"{corpus}/{engine}", corpus, {"engine": engine})
+    for corpus in CORPORA
+    for engine in ["text", "mmap"]
+] + [
+    ("deep_tree/files_with_matches", "deep_tree", {"files_with_matches": True}),
+    ("deep_tree/workers", "deep_tree", {"workers": os.cpu_count() or 1}),
+    ("notebooks/cache", "notebooks", {"notebook_cache": True}),
+]
+
+
+@click.command()
+@click.option(
+    "--corpus-dir",
+    default="benchmark_corpus",
+    metavar="<folder>",
+    help="folder for the generated corpora. Default: benchmark_corpus",
+)
+@click.option(
+    "--scale",
+    default=1.0,
+    type=click.FloatRange(min=0.01),
+    metavar="<float>",
+    help="relative size of the generated corpora. Default: 1",
+)
+@click.option(
+    "--seed", default=1, metavar="<int>", help="random seed for the corpora"
+)
+@click.option(
+    "--repeat",
+    default=3,
+    type=click.IntRange(min=1),
+    metavar="<int>",
+    help="number of times to run each case; the fastest run is kept. Default: 3",
+)
+@click.option(
+    "--cases",
+    "case_filter",
+    metavar="<str>",
+    help="only run cases whose name contains this text",
+)
+@click.option(
+    "--output",
+    default="benchmark_results.json",
+    metavar="<file>",
+    help="file the results are saved to. Default: benchmark_results.json",
+)
+@click.option(
+    "--compare",
+    metavar="<file>",
+    help="results file from a previous run, to compare with",
+)
+@click.option(
+    "--threshold",
+    default=10.0,
+    metavar="<float>",
+    help="percent slowdown that's reported as a regression. Default: 10",
+)
+def main(
+    corpus_dir: str,
+    scale: float,
+    seed: int,
+    repeat: int,
+    case_filter: Optional[str],
+    output: str,
+    compare: Optional[str],
+    threshold: float,
+) -> None:
+    """Runs the pyfind benchmarks.
+    """
+    corpus_root: Path = Path(corpus_dir).resolve()
+    generate_corpora(corpus_root, scale, seed)
+
+    results: Dict[str, dict] = {}
+    for name, corpus, options in CASES:
+        if case_filter and case_filter not in name:
+            continue
+        runs: List[dict] = []
+        for _ in range(repeat):
+            # each run is in a new process, to measure its peak RSS
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                runs.append(
+                    executor.submit(
+                        run_case, corpus_root.joinpath(corpus), options
+                    ).result()
+                )
+        results[name] = min(runs, key=lambda run: run["seconds"])
+        print_result(name, results[name])
+
+    Path(output).write_text(
+        json.dumps(
+            {"scale": scale, "seed": seed, "python": sys.version, "results": results},
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+    click.echo(f"Results saved to {output}")
+
+    if compare:
+        baseline: dict = json.loads(Path(compare).read_text(encoding="utf-8"))
+        compare_results(baseline["results"], results, threshold)
+
+
+def compare_results(baseline: dict, results: dict, threshold: float) -> None:
+    """Compares benchmark results with the results of a previous run.
+
+    Args:
+        baseline: results of the previous run, by case name
+        results: results of this run, by case name
+        threshold: percent slowdown that's reported as a regression
+
+    Returns:
+        None
+    """
+    click.echo(f"{'case':32} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before: float = baseline[name]["seconds"]
+        after: float = result["seconds"]
+        change: float = (after - before) / before * 100 if before else 0.0
+        color: Optional[str] = None
+        if change > threshold:
+            color = "red"
+        elif change < -threshold:
+            color = "green"
+        click.echo(
+            click.style(
+                f"{name:32} {before:10.3f} {after:10.3f} {change:+7.1f}%", fg=color
+            )
+        )
+
+
+def generate_corpora(root: Path, scale: float, seed: int) -> None:
+    """Generates the benchmark corpora, if they don't already exist.
+
+    Args:
+        root: the folder to generate the corpora in
+        scale: relative size of the corpora
+        seed: random seed, so that the same corpora are generated every time
+
+    Returns:
+        None
+
+    A corpus is only re-generated if the scale or seed has changed since it
+    was generated.
+    """
+    settings: str = json.dumps({"scale": scale, "seed": seed})
+    settings_file: Path = root.joinpath("corpus.json")
+    if (
+        settings_file.is_file()
+        and settings_file.read_text(encoding="utf-8") == settings
+    ):
+        return
+    click.echo(f"Generating benchmark corpora in {root} ...")
+
+    for corpus in CORPORA + ["notebook_cache"]:
+        shutil.rmtree(root.joinpath(corpus), ignore_errors=True)
+    rng = random.Random(seed)
+    generate_deep_tree(root.joinpath("deep_tree"), rng, scale)
+    generate_huge_file(root.joinpath("huge_file"), rng, scale)
+    generate_notebooks(root.joinpath("notebooks"), rng, scale)
+    generate_minified(root.joinpath("minified"), rng, scale)
+    settings_file.write_text(settings, encoding="utf-8")
+
+
+def generate_deep_tree(folder: Path, rng: random.Random, scale: float) -> None:
+    """Generates a deep folder tree of small source files.
+
+    Args:
+        folder: the folder to generate the tree in
+        rng: the random number generator
+        scale: relative size of the corpus
+
+    Returns:
+        None
+    """
+    depth: int = 5
+    fanout: int = 3
+    files_per_folder: int = max(1, int(4 * scale))
+    folders: List[Path] = [folder]
+    for level in range(depth):
+        folders += [
+            parent.joinpath(f"pkg{child}")
+            for parent in folders
+            if len(parent.relative_to(folder).parts) == level
+            for child in range(fanout)
+        ]
+    for subfolder in folders:
+        subfolder.mkdir(parents=True, exist_ok=True)
+        for file_no in range(files_per_folder):
+            lines: List[str] = source_lines(rng, 200)
+            subfolder.joinpath(f"module{file_no}.py").write_text(
+                "\n".join(lines), encoding="utf-8"
+            )
+    # the needle is in the last file walked, so it's found at the end
+    plant_needle(folders[-1].joinpath("module0.py"))
+
+
+def generate_huge_file(folder: Path, rng: random.Random, scale: float) -> None:
+    """Generates a single large source file.
+
+    Args:
+        folder: the folder to generate the file in
+        rng: the random number generator
+        scale: relative size of the corpus
+
+    Returns:
+        None
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    lines: List[str] = source_lines(rng, int(200000 * scale))
+    lines.insert(len(lines) // 2, f"{NEEDLE} = True")
+    folder.joinpath("huge.py").write_text("\n".join(lines), encoding="utf-8")
+
+
+def generate_minified(folder: Path, rng: random.Random, scale: float) -> None:
+    """Generates files with very long lines, like minified code.
+
+    Args:
+        folder: the folder to generate the files in
+        rng: the random number generator
+        scale: relative size of the corpus
+
+    Returns:
+        None
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    for file_no in range(max(1, int(20 * scale))):
+        lines: List[str] = [";".join(source_lines(rng, 2000)) for _ in range(5)]
+        folder.joinpath(f"minified{file_no}.py").write_text(
+            "\n".join(lines), encoding="utf-8"
+        )
+    plant_needle(folder.joinpath("minified0.py"))
+
+
+def generate_notebooks(folder: Path, rng: random.Random, scale: float) -> None:
+    """Generates notebooks with large outputs.
+
+    Args:
+        folder: the folder to generate the notebooks in
+        rng: the random number generator
+        scale: relative size of the corpus
+
+    Returns:
+        None
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    for file_no in range(max(1, int(10 * scale))):
+        cells: List[dict] = []
+        for cell_no in range(30):
+            code: List[str] = [line + "\n" for line in source_lines(rng, 10)]
+            if file_no == 0 and cell_no == 15:
+                code.append(f"{NEEDLE} = True\n")
+            image: str = "".join(
+                rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+                for _ in range(2000)
+            ) * 50
+            cells.append(
+                {
+                    "cell_type": "code",
+                    "execution_count": cell_no,
+                    "metadata": {},
+                    "outputs": [
+                        {
+                            "data": {"image/png": image, "text/plain": ["<Figure>"]},
+                            "output_type": "display_data",
+                        }
+                    ],
+                    "source": code,
+                }
+            )
+        notebook: dict = {"cells": cells, "metadata": {}, "nbformat": 4}
+        folder.joinpath(f"notebook{file_no}.ipynb").write_text(
+            json.dumps(notebook), encoding="utf-8"
+        )
+
+
+def peak_rss() -> Optional[int]:
+    """Gets the peak resident set size of the current process.
+
+    Returns:
+        Peak RSS in bytes, or None if it's not available on this platform.
+    """
+    if resource is None:
+        return None
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def plant_needle(file: Path) -> None:
+    """Appends the needle text to a generated file.
+
+    Args:
+        file: the file
+
+    Returns:
+        None
+    """
+    with file.open("a", encoding="utf-8") as fhandle:
+        fhandle.write(f"\n{NEEDLE} = True\n")
+
+
+def print_result(name: str, result: dict) -> None:
+    """Prints the result of a benchmark case.
+
+    Args:
+        name: the case name
+        result: the result, as returned by run_case()
+
+    Returns:
+        None
+    """
+    rss: str = (
+        f"{result['peak_rss'] / 1024 / 1024:7.1f} MB"
+        if result["peak_rss"] is not None
+        else "      n/a"
+    )
+    first: str = (
+        f"{result['first_match']:.3f}s"
+        if result["first_match"] is not None
+        else "n/a"
+    )
+    click.echo(
+        f"{name:32} {result['seconds']:8.3f}s "
+        f"{result['lines_per_sec']:12,.0f} lines/s "
+        f"{result['files_per_sec']:9,.1f} files/s "
+        f"RSS {rss}  first match {first}"
+    )
+
+
+def run_case(corpus: Path, options: dict) -> dict:
+    """Runs a benchmark case.
+
+    Args:
+        corpus: the corpus folder to search
+        options: keyword arguments for Search. A notebook_cache option is
+            replaced with a NotebookCache that has been filled by a previous
+            search, to measure searches that hit the cache.
+
+    Returns:
+        A dictionary of the results.
+    """
+    options = dict(options)
+    cache: Optional[NotebookCache] = None
+    if options.pop("notebook_cache", False):
+        cache = NotebookCache(corpus.parent.joinpath("notebook_cache"))
+        for notebook in corpus.glob("*.ipynb"):
+            cache.source(notebook)
+
+    searcher = Search(NEEDLE, [".py", ".ipynb"], **options)
+    searcher.notebook_cache = cache
+    searcher.console.show_progress = False
+    first_match: Optional[float] = None
+    start: float = time.perf_counter()
+    for _ in searcher.iter_matches(str(corpus), subdirs=True):
+        if first_match is None:
+            first_match = time.perf_counter() - start
+    seconds: float = time.perf_counter() - start
+    searcher.close()
+
+    return {
+        "seconds": seconds,
+        "first_match": first_match,
+        "files": searcher.searched_files,
+        "lines": searcher.searched_lines,
+        "bytes": searcher.searched_bytes,
+        "lines_per_sec": searcher.searched_lines / seconds if seconds else 0.0,
+        "files_per_sec": searcher.searched_files / seconds if seconds else 0.0,
+        "peak_rss": peak_rss(),
+    }
+
+
+def source_lines(rng: random.Random, count: int) -> List[str]:
+    """Generates lines of Python-like source code.
+
+    Args:
+        rng: the random number generator
+        count: number of lines to generate
+
+    Returns:
+        A list of the generated lines, without newlines.
+    """
+    lines: List[str] = []
+    for _ in range(count):
+        words: List[str] = rng.choices(WORDS, k=rng.randint(2, 8))
+        indent: str = " " * 4 * rng.randint(0, 3)
+        call: str = ".".join(words[1:])
+        lines.append(f"{indent}{words[0]} = {call}({rng.randint(0, 999)})")
+    return lines
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
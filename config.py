@@ -6,6 +6,7 @@ COLOR_FOLDER = "green"
 COLOR_FILENAME = "white"
 COLOR_MATCH_LINE = "cyan"
 COLOR_MATCH_TEXT = "green"
+COLOR_CONTEXT = "bright_black"
 COLOR_SUMMARY = "green"
 COLOR_WARNING = "red"
 COLOR_SEARCHED_FOLDERS = "yellow"
@@ -22,5 +23,63 @@ SKIPPED_FOLDERS = [
     "backups",
 ]
 
+# glob patterns for names of subfolders to never be searched:
+SKIPPED_FOLDER_GLOBS = ["*.egg-info"]
+
+# regular expressions for paths of subfolders to never be searched:
+SKIPPED_FOLDER_REGEXES = []
+
 # length in characters of the left column of displayed output:
 PREFIX_LENGTH = 12
+
+# minimum seconds between updates of the running status line:
+PROGRESS_INTERVAL = 0.1
+
+# maximum seconds that console output is buffered while searching:
+CONSOLE_FLUSH_INTERVAL = 0.1
+
+# number of files queued per worker process when searching in parallel:
+WORKER_QUEUE_DEPTH = 4
+
+# trigram index for *projects searches, stored in the pyfind folder:
+INDEX_FILE = "projects.index"
+INDEX_VERSION = 3
+INDEX_MIN_BITS = 64
+
+# trigram indexes for *stdlib and *packages searches, in the pyfind folder:
+SCOPE_INDEX_FOLDER = "scope_index"
+
+# bytes copied at a time when counting lines in the mmap search engine:
+MMAP_CHUNK_SIZE = 1024 * 1024
+
+# bytes checked for a NUL byte (binary files aren't searched), a byte order
+# mark and a coding declaration at the start of each file:
+BINARY_CHECK_SIZE = 8192
+
+# archives searched by the --archives option:
+ARCHIVE_TYPES = [".whl", ".egg", ".zip", ".tar.gz", ".tgz"]
+
+# bytes read at a time by the text search engine:
+READ_BLOCK_SIZE = 256 * 1024
+
+# lines searched between checks of whether a search has been stopped, such as
+# by --timeout, when a file is searched line by line:
+STOP_CHECK_LINES = 4096
+
+# socket file of the pyfind server (pyfind --serve), in the pyfind folder:
+SERVER_SOCKET = "pyfind.sock"
+
+# seconds between checks for changed files by pyfind --watch, if inotify
+# isn't available:
+WATCH_POLL_INTERVAL = 1.0
+
+# cache of source code extracted from notebooks, in the pyfind folder:
+NOTEBOOK_CACHE_FOLDER = "notebook_cache"
+NOTEBOOK_CACHE_VERSION = 1
+
+# cache of the code tokens of Python files for --code, in the pyfind folder:
+TOKEN_CACHE_FOLDER = "token_cache"
+TOKEN_CACHE_VERSION = 1
+
+# number of slowest folders and files listed by the --stats option:
+STATS_SLOWEST_COUNT = 5
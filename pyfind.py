@@ -2,13 +2,58 @@
 """
 from __future__ import annotations
 
+from array import array
+from bisect import bisect_left
+import codecs
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+import cProfile
+import csv
+import ctypes
+import ctypes.util
+import fnmatch
+from functools import partial
+import hashlib
+import heapq
+import io
 import json
+import locale
+import mmap
 import os
 from pathlib import Path
+import pickle
+import re
+import select
 import shutil
 import site
+import socket
+import struct
 import sys
-from typing import List, Tuple, Union
+import tarfile
+import time
+import tokenize
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
+import zipfile
+import zlib
+
+try:
+    import re._parser as sre_parse  # Python 3.11 and later
+except ImportError:
+    import sre_parse  # type: ignore
 
 import click
 
@@ -16,11 +61,55 @@ import config
 
 CONTEXT_SETTINGS: dict = dict(help_option_names=["-h", "--help"])
 
+# regular expressions used to skip over JSON values without decoding them
+JSON_STRUCTURE = re.compile(r'[\[\]{}"]')
+JSON_SCALAR = re.compile(r"-?[0-9][0-9.eE+-]*|true|false|null")
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_DECODER = json.JSONDecoder()
+# the rest of a string after its opening quote, up to the closing quote, and
+# a string followed by the colon that makes it an object key
+JSON_STRING_CHARS = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*')
+JSON_KEY = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"[ \t\n\r]*(:)?')
+
+# TrigramIndex entry for a file: (mtime_ns, size, lines, mask bits, mask)
+IndexEntry = Tuple[int, int, int, int, int]
+
+# table of contents of an archive: (mtime_ns, size, [(member name, size)])
+ArchiveContents = Tuple[int, int, List[Tuple[str, int]]]
+
+# TokenCache entry for a file: (code tokens separated by spaces, offset of
+# each token in the code, (line index, start, end) of each token, lines)
+CodeTokens = Tuple[str, array, array, int]
+
+# byte order marks and the encodings they identify, with UTF-32 before UTF-16
+# because the UTF-32 little-endian mark starts with the UTF-16 one
+UNICODE_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+# tokenize token types that are searched in --code mode
+CODE_TOKEN_TYPES = frozenset([tokenize.NAME, tokenize.OP, tokenize.NUMBER])
+
+# inotify event flags (from <sys/inotify.h>) used by Watcher
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len, then the name
+
 # This comment is used by tests. DO NOT REMOVE
 
 
 @click.argument("startdir", default="*projects", metavar="<startdir>")
-@click.argument("searchfor", metavar="searchfor")
+@click.argument("searchfor", metavar="searchfor", required=False)
 @click.command(context_settings=CONTEXT_SETTINGS, options_metavar="<options>")
 @click.option(
     "-s",
@@ -37,34 +126,420 @@ CONTEXT_SETTINGS: dict = dict(help_option_names=["-h", "--help"])
     help="File types to search. Multiple types may "
     + "be delimited with /. Default: -ft=py/ipynb",
 )
+@click.option(
+    "-f",
+    "--patterns-file",
+    metavar="<file>",
+    help="search for each line of this file, in a single pass. The first "
+    + "argument is then the startdir.",
+)
+@click.option(
+    "--regex",
+    default=False,
+    help="search for a regular expression instead of literal text",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "-w",
+    "--word",
+    default=False,
+    help="only match whole words",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--case-sensitive",
+    default=False,
+    help="match upper and lower case exactly",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--code",
+    default=False,
+    help="match Python names, attributes and calls in .py files and notebook "
+    + "code cells, ignoring comments and strings",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "-A",
+    "--after-context",
+    type=click.IntRange(min=0),
+    metavar="<n>",
+    help="print n lines of context after each match",
+)
+@click.option(
+    "-B",
+    "--before-context",
+    type=click.IntRange(min=0),
+    metavar="<n>",
+    help="print n lines of context before each match",
+)
+@click.option(
+    "-C",
+    "--context",
+    type=click.IntRange(min=0),
+    metavar="<n>",
+    help="print n lines of context before and after each match",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    metavar="<int>",
+    help="number of worker processes used to search files. Default: 1",
+)
+@click.option(
+    "--no-index",
+    default=False,
+    help="don't use the trigram index for *projects, *stdlib and *packages "
+    + "searches",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--engine",
+    default="text",
+    type=click.Choice(["text", "mmap"]),
+    help="file search engine: text (decode and search each line) or mmap "
+    + "(search raw bytes, decode matched lines only). Default: text",
+)
+@click.option(
+    "-x",
+    "--exclude",
+    multiple=True,
+    metavar="<glob>",
+    help="skip folders whose name matches this glob pattern. May be used "
+    + "more than once.",
+)
+@click.option(
+    "--exclude-regex",
+    multiple=True,
+    metavar="<regex>",
+    help="skip folders whose path matches this regular expression. May be "
+    + "used more than once.",
+)
+@click.option(
+    "--gitignore",
+    default=False,
+    help="skip files and folders ignored by .gitignore files",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "-L",
+    "--follow-links",
+    default=False,
+    help="follow symlinks to folders. Each folder and file is only searched "
+    + "once, even if links or overlapping folders lead to it more than once.",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--archives",
+    default=False,
+    help="also search the files in .whl, .egg, .zip and .tar.gz archives, "
+    + "without extracting them",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "-m",
+    "--max-count",
+    type=click.IntRange(min=1),
+    metavar="<int>",
+    help="stop searching a file after this many matches",
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    metavar="<int>",
+    help="stop searching after this many matches in total",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0),
+    metavar="<seconds>",
+    help="stop searching after this many seconds, and print the matches found "
+    + "so far with a partial summary",
+)
+@click.option(
+    "--recent",
+    default=False,
+    help="search the most recently modified files first, so that matches in "
+    + "recently edited projects are printed first",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "-l",
+    "--files-with-matches",
+    default=False,
+    help="only print the path of each file with a match, and stop searching "
+    + "each file at its first match",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--no-cache",
+    default=False,
+    help="don't use the cache of source code extracted from notebooks",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--serve",
+    default=False,
+    help="run the pyfind server, which keeps the index and file lists for "
+    + "*projects searches in memory until it's stopped with Ctrl-C",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--watch",
+    default=False,
+    help="keep the index and notebook cache for *projects searches up to "
+    + "date as files change, until stopped with Ctrl-C",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--no-server",
+    default=False,
+    help="search in this process even if the pyfind server is running",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--format",
+    "output_format",
+    default="text",
+    type=click.Choice(["text", "jsonl"]),
+    help="output format: text, or jsonl for one JSON record per match and a "
+    + "final summary record. Default: text",
+)
+@click.option(
+    "--stats",
+    default=False,
+    help="print how long each phase of the search took, and the slowest "
+    + "folders and files",
+    is_flag=True,
+    metavar="",
+)
+@click.option(
+    "--profile",
+    metavar="<file>",
+    help="save cProfile statistics for the search to this file",
+)
 @click.version_option(version="1.1", prog_name="PyFind")
-def cli(searchfor: str, startdir: str, filetypes: str, subfolders: bool) -> None:
+def cli(
+    searchfor: Optional[str],
+    startdir: str,
+    filetypes: str,
+    subfolders: bool,
+    patterns_file: Optional[str],
+    regex: bool,
+    word: bool,
+    case_sensitive: bool,
+    code: bool,
+    after_context: Optional[int],
+    before_context: Optional[int],
+    context: Optional[int],
+    jobs: int,
+    no_index: bool,
+    engine: str,
+    exclude: Tuple[str, ...],
+    exclude_regex: Tuple[str, ...],
+    gitignore: bool,
+    follow_links: bool,
+    archives: bool,
+    max_count: Optional[int],
+    limit: Optional[int],
+    timeout: Optional[float],
+    recent: bool,
+    files_with_matches: bool,
+    no_cache: bool,
+    serve: bool,
+    watch: bool,
+    no_server: bool,
+    output_format: str,
+    stats: bool,
+    profile: Optional[str],
+) -> None:
     """\b
-    _______________         searchfor: text to search for (required)
+    _______________         searchfor: text to search for (required, unless -f is used)
      |___|___|___|          startdir:  folder to search, or one of the options below
        |___|___|            *projects = project folders as defined in projects.txt (default)
          |___|              *stdlib   = Python standard library
            |                *packages = installed packages in current environment
     """
     # Note that Click uses the above docstring for the help screen.
+    deadline: Optional[float] = (
+        None if timeout is None else time.monotonic() + timeout
+    )
+
+    pyfind_folder: Path = Path(__file__).resolve().parent
+    if serve:
+        if not hasattr(socket, "AF_UNIX"):
+            click.echo(click.style("--serve requires Unix domain sockets", fg="red"))
+            return
+        server_socket: Path = pyfind_folder.joinpath(config.SERVER_SOCKET)
+        running = query_server(server_socket, {})
+        if running is not None:
+            for _ in running:
+                pass  # an empty request just gets an error record
+            click.echo(click.style(f"ALREADY RUNNING: {server_socket}", fg="red"))
+            return
+        click.echo(f"pyfind server listening on {server_socket}")
+        try:
+            server = Server(
+                pyfind_folder, use_index=not no_index, use_cache=not no_cache
+            )
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        return
 
     typelist: List[str]
     if filetypes:
         typelist = ["." + _.lower() for _ in filetypes.split("/")]
     else:
         typelist = [".py", ".ipynb"]
-    searcher = Search(search_for=searchfor, file_types=typelist)
+
+    projects_file: Path = pyfind_folder.joinpath("projects.txt")
+    if watch:
+        if not projects_file.is_file():
+            click.echo(click.style(f"FILE NOT FOUND: {projects_file}", fg="red"))
+            return
+        watched = Search(
+            "",
+            typelist,
+            skipped_globs=config.SKIPPED_FOLDER_GLOBS + list(exclude),
+            skipped_regexes=config.SKIPPED_FOLDER_REGEXES + list(exclude_regex),
+        )
+        if not no_index:
+            watched.index = TrigramIndex(pyfind_folder.joinpath(config.INDEX_FILE))
+        if not no_cache:
+            watched.notebook_cache = NotebookCache(
+                pyfind_folder.joinpath(config.NOTEBOOK_CACHE_FOLDER)
+            )
+        project_folders: List[str] = textfile_to_list(projects_file)
+        click.echo(f"pyfind watching {len(project_folders)} project folders")
+        watcher = Watcher(watched, project_folders)
+        try:
+            watcher.watch()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            watched.close()
+        return
+
+    search_for: Union[str, List[str]]
+    if patterns_file:
+        if not Path(patterns_file).is_file():
+            click.echo(click.style(f"FILE NOT FOUND: {patterns_file}", fg="red"))
+            return
+        if searchfor is not None:
+            if startdir != "*projects":
+                raise click.UsageError(f"Got unexpected extra argument ({startdir})")
+            startdir = searchfor
+        search_for = textfile_to_list(patterns_file)
+    elif searchfor is None:
+        raise click.UsageError("Missing argument 'searchfor'.")
+    else:
+        search_for = searchfor
+    if code and regex:
+        raise click.UsageError("--code can't be used with --regex.")
+
+    # the options that affect which matches are found, which are also sent to
+    # the pyfind server
+    options: dict = dict(
+        search_for=search_for,
+        file_types=typelist,
+        engine=engine,
+        skipped_globs=config.SKIPPED_FOLDER_GLOBS + list(exclude),
+        skipped_regexes=config.SKIPPED_FOLDER_REGEXES + list(exclude_regex),
+        gitignore=gitignore,
+        follow_links=follow_links,
+        archives=archives,
+        max_count=max_count,
+        max_results=limit,
+        recent=recent,
+        files_with_matches=files_with_matches,
+        regex=regex,
+        word=word,
+        case_sensitive=case_sensitive,
+        code=code,
+        # -A and -B override -C, as for grep
+        context=(
+            before_context if before_context is not None else context or 0,
+            after_context if after_context is not None else context or 0,
+        ),
+    )
+    try:
+        searcher = Search(
+            workers=jobs,
+            output_format=output_format,
+            stats=stats,
+            deadline=deadline,
+            **options,
+        )
+    except re.error as error:
+        click.echo(click.style(f"INVALID REGULAR EXPRESSION: {error}", fg="red"))
+        return
+    except ValueError as error:
+        click.echo(click.style(f"INVALID CODE PATTERN: {error}", fg="red"))
+        return
+    if not no_cache:
+        searcher.notebook_cache = NotebookCache(
+            pyfind_folder.joinpath(config.NOTEBOOK_CACHE_FOLDER)
+        )
+        if code:
+            searcher.token_cache = TokenCache(
+                pyfind_folder.joinpath(config.TOKEN_CACHE_FOLDER)
+            )
+
+    profiler: Optional[cProfile.Profile] = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
     if startdir.lower().startswith("*project"):
         # special case for *projects option
-        pyfind_folder: Path = Path(__file__).resolve().parent
-        projects_file: Path = Path.joinpath(pyfind_folder, "projects.txt")
         if not projects_file.is_file():
             click.echo(click.style(f"FILE NOT FOUND: {projects_file}", fg="red"))
+            finish_profile(profiler, profile)
+            return
+        records: Optional[Iterator[dict]] = None
+        if not (no_server or no_index or no_cache or stats or profile or jobs > 1):
+            records = query_server(
+                pyfind_folder.joinpath(config.SERVER_SOCKET),
+                {"options": options, "subdirs": subfolders, "timeout": timeout},
+            )
+        if records is not None:
+            try:
+                for match in searcher.iter_server_matches(records):
+                    searcher.print_search_match(match)
+            except RuntimeError as error:
+                click.echo(click.style(f"SERVER ERROR: {error}", fg="red"))
+                return
+            searcher.close()
+            searcher.print_summary()
             return
-        for project_folder in textfile_to_list(projects_file):
-            searcher.search_folder(project_folder, subdirs=subfolders)
+        if not no_index:
+            searcher.index = TrigramIndex(pyfind_folder.joinpath(config.INDEX_FILE))
+        for match in searcher.iter_folders_matches(
+            searcher.search_roots(textfile_to_list(projects_file), subdirs=subfolders),
+            subdirs=subfolders,
+        ):
+            searcher.print_search_match(match)
+        searcher.close()
         searcher.print_summary()
+        finish_profile(profiler, profile)
         return
 
     search_root: Path
@@ -72,23 +547,223 @@ def cli(searchfor: str, startdir: str, filetypes: str, subfolders: bool) -> None
         # search installed packages source code
         search_root = Path(site.getsitepackages()[-1])
         subfolders = True
+        if not no_index:
+            searcher.index = VersionedIndex(
+                scope_index_file(pyfind_folder, "packages", search_root),
+                search_root,
+                packages=True,
+            )
     elif startdir.lower().startswith("*stdlib"):
         # search Python standard library source code
         search_root = Path(sys.exec_prefix).joinpath("Lib")
         subfolders = True
+        if not no_index:
+            searcher.index = VersionedIndex(
+                scope_index_file(pyfind_folder, "stdlib", search_root),
+                search_root,
+                packages=False,
+            )
     else:
         # An explicit search folder was specified on the command line.
         search_root = Path(startdir)
 
-    searcher.search_folder(search_root, subdirs=subfolders)
+    for match in searcher.iter_folders_matches([search_root], subdirs=subfolders):
+        searcher.print_search_match(match)
+    searcher.close()
     searcher.print_summary()
+    finish_profile(profiler, profile)
+
+
+class Console:
+    """Buffered console output for a search.
+
+    Styled text is collected in a buffer and written with a single click.echo
+    call when the buffer is flushed, which happens at most every
+    config.CONSOLE_FLUSH_INTERVAL seconds while searching, and no more than
+    that long after the text was written if poll() is called regularly. The
+    console width is read once, and the running status line is updated at
+    most every config.PROGRESS_INTERVAL seconds, or not at all if stdout
+    isn't a terminal.
+    """
+
+    def __init__(self, file: Optional[IO[str]] = None) -> None:
+        """Constructor
+
+        Args:
+            file: the file to write to instead of stdout, such as a connection
+                to the pyfind server. The status line isn't shown.
+
+        Returns:
+            None
+        """
+        self.width: int = get_console_width()
+        self.file: Optional[IO[str]] = file
+        self.show_progress: bool = (
+            file is None and sys.stdout is not None and sys.stdout.isatty()
+        )
+        self.buffer: List[str] = []
+        self.last_flush: float = time.monotonic()
+        self.last_progress: float = 0.0
+
+    def flush(self) -> None:
+        """Writes the buffered output to the console.
+        """
+        if self.buffer:
+            click.echo("".join(self.buffer), file=self.file, nl=False)
+            self.buffer.clear()
+        self.last_flush = time.monotonic()
+
+    def poll(self) -> None:
+        """Flushes the buffered output, if it's time for a flush.
+
+        This is called while searching between writes, so that output isn't
+        held in the buffer while no more matches are being found.
+        """
+        if (
+            self.buffer
+            and time.monotonic() - self.last_flush >= config.CONSOLE_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def progress(self, text: str, color: str) -> None:
+        """Updates the running status line, if it's time for an update.
+
+        Args:
+            text: the status text
+            color: the color of the status text
+
+        Returns:
+            None
+        """
+        if not self.show_progress:
+            return
+        now: float = time.monotonic()
+        if now - self.last_progress < config.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        self.buffer.append(
+            "\r" + click.style(pad_string(text, self.width), fg=color) + "\r"
+        )
+        self.flush()
+
+    def write(self, text: str, color: Optional[str] = None, nl: bool = True) -> None:
+        """Writes text to the console.
+
+        Args:
+            text: the text to be written
+            color: the color of the text, or None for no styling
+            nl: whether to write a newline after the text
+
+        Returns:
+            None
+        """
+        self.buffer.append(click.style(text, fg=color) if color else text)
+        if nl:
+            self.buffer.append("\n")
+            if time.monotonic() - self.last_flush >= config.CONSOLE_FLUSH_INTERVAL:
+                self.flush()
+
+
+class GitIgnore:
+    """Compiled rules from a .gitignore file.
+    """
+
+    def __init__(self, folder: str, lines: Iterable[str]) -> None:
+        """Constructor, compiles the rules.
+
+        Args:
+            folder: the folder that contains the .gitignore file
+            lines: the lines of the .gitignore file
+
+        Returns:
+            None
+        """
+        self.folder: str = folder
+        # rules are (regex, negated, directories only) tuples, in file order
+        self.rules: List[Tuple[Pattern[str], bool, bool]] = []
+        for line in lines:
+            rule = gitignore_rule(line)
+            if rule:
+                self.rules.append(rule)
+
+        # Without negated rules, the order of the rules doesn't matter and
+        # they're combined into one regex each for files and folders.
+        self.combined: bool = not any(negated for _, negated, _ in self.rules)
+        self.file_regex: Optional[Pattern[str]] = None
+        self.folder_regex: Optional[Pattern[str]] = None
+        if self.combined:
+            file_patterns = [
+                regex.pattern for regex, _, dir_only in self.rules if not dir_only
+            ]
+            folder_patterns = [regex.pattern for regex, _, _ in self.rules]
+            if file_patterns:
+                self.file_regex = re.compile("|".join(file_patterns))
+            if folder_patterns:
+                self.folder_regex = re.compile("|".join(folder_patterns))
+
+    def match(self, path: str, is_dir: bool) -> Optional[bool]:
+        """Matches a path against the rules.
+
+        Args:
+            path: the path of a file or folder below self.folder
+            is_dir: whether path is a folder
+
+        Returns:
+            True if the last matching rule ignores the path, False if it's a
+            negated rule that re-includes the path, or None if no rule matches.
+        """
+        relative: str = path[len(self.folder) :].lstrip(os.sep)
+        if os.sep != "/":
+            relative = relative.replace(os.sep, "/")
+
+        if self.combined:
+            regex = self.folder_regex if is_dir else self.file_regex
+            if regex is not None and regex.match(relative):
+                return True
+            return None
+
+        for regex, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative):
+                return not negated
+        return None
 
 
 class Match:
     """Stores a single match found in a search.
+
+    Matches are slotted, to keep large result sets small: all of a file's
+    matches share its Path, the span is stored as two ints, and context lines
+    are only stored if there are any. A match that knows the byte offset of
+    its line can also drop the line's text (see compact), and read it from
+    the file again when it's needed.
     """
 
-    def __init__(self, file: Path, match: str, position: int, search_for: str) -> None:
+    __slots__ = (
+        "file",
+        "position",
+        "search_for",
+        "_match",
+        "_offset",
+        "_encoding",
+        "_start",
+        "_end",
+        "_context",
+    )
+
+    def __init__(
+        self,
+        file: Path,
+        match: str,
+        position: int,
+        search_for: str,
+        span: Optional[Tuple[int, int]] = None,
+        before: Optional[List[str]] = None,
+        after: Optional[List[str]] = None,
+        offset: Optional[int] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
         """Constructor, initializes properties.
 
         Args:
@@ -97,250 +772,3731 @@ class Match:
             position: the position of the match within the file. Either a line
                 number, or a cell number (for notebook files).
             search_for: the search text that was found.
+            span: the (start, end) offsets of the matched text in match, if
+                known. Searches always provide it, so that the line doesn't
+                have to be searched again to highlight the match.
+            before: the context lines before the match, if any
+            after: the context lines after the match, if any
+            offset: the byte offset of the matched line in file, if known
+            encoding: the encoding of file, if offset is provided
         Returns:
             None
         """
-        self.file = file
-        self.match = match
-        self.position = position
-        self.search_for = search_for
+        self.file: Path = file
+        self._match: Optional[str] = match
+        self.position: int = position
+        self.search_for: str = search_for
+        self._start: Optional[int] = None if span is None else span[0]
+        self._end: Optional[int] = None if span is None else span[1]
+        self._context: Optional[Tuple[List[str], List[str]]] = (
+            None if before is None and after is None else (before or [], after or [])
+        )
+        self._offset: Optional[int] = offset
+        self._encoding: Optional[str] = encoding
 
-    def print_match(self) -> None:
-        """Prints the match to the console.
+    @property
+    def after(self) -> List[str]:
+        """The context lines after the match."""
+        return [] if self._context is None else self._context[1]
+
+    @after.setter
+    def after(self, lines: List[str]) -> None:
+        self._context = (self.before, lines)
+
+    @property
+    def before(self) -> List[str]:
+        """The context lines before the match."""
+        return [] if self._context is None else self._context[0]
+
+    @before.setter
+    def before(self, lines: List[str]) -> None:
+        self._context = (lines, self.after)
+
+    @property
+    def match(self) -> str:
+        """The line of text where the match was found, stripped.
+
+        If the match has been compacted, the line is read from the file each
+        time, so it's only correct if the file hasn't changed since it was
+        searched.
+        """
+        if self._match is not None:
+            return self._match
+        with self.file.open("rb") as fhandle:
+            fhandle.seek(self._offset or 0)
+            line: bytes = fhandle.readline()
+        return line.decode(self._encoding or "utf-8", "replace").strip()
+
+    @match.setter
+    def match(self, text: str) -> None:
+        self._match = text
+
+    @property
+    def span(self) -> Optional[Tuple[int, int]]:
+        """The (start, end) offsets of the matched text in match, if known."""
+        if self._start is None or self._end is None:
+            return None
+        return (self._start, self._end)
+
+    @span.setter
+    def span(self, span: Optional[Tuple[int, int]]) -> None:
+        self._start, self._end = (None, None) if span is None else span
+
+    def as_record(self) -> dict:
+        """Converts the match to a dictionary, for JSON output.
+
+        Returns:
+            A dictionary with the match's file path, line number (or cell
+            number, for notebook files), 1-based column of the search text
+            within the matched line, and the matched line. Context lines are
+            included as "before" and "after" lists, if there are any.
+        """
+        position_key: str = "cell" if is_notebook(self.file) else "line"
+        record: dict = {
+            "type": "match",
+            "path": str(self.file),
+            position_key: self.position,
+            "column": (
+                self.span[0]
+                if self.span is not None
+                else self.match.lower().find(self.search_for.lower())
+            )
+            + 1,
+            "text": self.match,
+        }
+        if self.before:
+            record["before"] = self.before
+        if self.after:
+            record["after"] = self.after
+        return record
+
+    def compact(self) -> Match:
+        """Drops the text of the matched line, if it can be read again.
+
+        Returns:
+            The match itself. Its text is dropped if the search found the byte
+            offset of the line in the file, which the text and mmap engines
+            do for lines that they've searched as raw bytes. It's then read
+            from the file again when the match attribute is used.
         """
-        prefix = f"{'cell' if is_notebook(self.file) else 'line'} {self.position}: ".rjust(
-            config.PREFIX_LENGTH
+        if self._offset is not None and self._encoding is not None:
+            self._match = None
+        return self
+
+    def print_context(
+        self, output: Console, kind: str, offset: int, context_line: str
+    ) -> None:
+        """Prints a context line of the match.
+
+        Args:
+            output: the Console to write the context line to
+            kind: "line" or "cell"
+            offset: the context line's position relative to the match
+            context_line: the text of the context line
+
+        Returns:
+            None
+        """
+        prefix = f"{kind} {self.position + offset}- ".rjust(config.PREFIX_LENGTH)
+        output.write(
+            pad_string(prefix + context_line.strip(), output.width),
+            config.COLOR_CONTEXT,
         )
 
+    def print_match(self, console: Optional[Console] = None) -> None:
+        """Prints the match to the console.
+
+        Args:
+            console: the Console to write the match to. If not provided, the
+                match is printed immediately.
+
+        Returns:
+            None
+        """
+        output: Console = console if console is not None else Console()
+        notebook: bool = is_notebook(self.file)
+        kind: str = "cell" if notebook else "line"
+        prefix = f"{kind} {self.position}: ".rjust(config.PREFIX_LENGTH)
+
         # chars = the maximum number of characters of self.match to be printed
-        chars: int = get_console_width() - len(prefix)
+        chars: int = output.width - len(prefix)
         # to color-highlight the matched text, break the line into sections
-        sections: List[Tuple] = highlight_match(self.match, self.search_for, chars)
+        sections: List[Tuple] = highlight_match(
+            self.match, self.search_for, chars, self.span
+        )
 
-        click.echo("\r", nl=False)  # reset console to start of line
+        output.write("\r", nl=False)  # reset console to start of line
+
+        # context lines are numbered like grep's, with "-" instead of ":"
+        # (notebook context lines are in the same cell as the match)
+        offset: int
+        context_line: str
+        for offset, context_line in enumerate(self.before, -len(self.before)):
+            self.print_context(output, kind, 0 if notebook else offset, context_line)
 
         # print the prefix, with nl=False to print the sections on the same line
-        click.echo(click.style(prefix, fg=config.COLOR_MATCH_LINE), nl=False)
+        output.write(prefix, config.COLOR_MATCH_LINE, nl=False)
         # all but the final section have nl=False to print on same line
         for text, color in sections[:-1]:
-            click.echo(click.style(text, fg=color), nl=False)
+            output.write(text, color, nl=False)
         # final section does not include nl=False
-        click.echo(click.style(sections[-1][0], fg=sections[-1][1]))
+        output.write(sections[-1][0], sections[-1][1])
+        for offset, context_line in enumerate(self.after, 1):
+            self.print_context(output, kind, 0 if notebook else offset, context_line)
+        if console is None:
+            output.flush()
 
 
-class Search:
-    """Master search instance. Typical use is to instantiate an instance and
-    set what to search for and which file types to search, then call the
-    search_folder method one or more times to do the searches, then call the
-    print_summary method to print a summary.
+class NotebookCache:
+    """Persistent cache of the source code extracted from notebooks.
+
+    Each notebook's code cell source lines are saved in a small file in the
+    cache folder, along with the notebook's mtime and size. If the notebook
+    hasn't changed, its source is read from the cache without parsing the
+    notebook's JSON at all.
     """
 
-    def __init__(self, search_for: str, file_types: List[str]) -> None:
+    def __init__(self, folder: Union[Path, str], in_memory: bool = False) -> None:
         """Constructor
 
         Args:
-            search_for: text to be searched for
-            file_types: list of file types to search, with preceding period
-                on each (e.g., [".py", ".ipynb"])
+            folder: the folder where cached notebook source is stored. It's
+                created when the first notebook is cached.
+            in_memory: whether to also keep the source in memory, for a
+                long-running process that searches the same notebooks again
 
         Returns:
             None
         """
-        self.search_for: str = search_for
-        self.file_types: List[str] = file_types
+        self.folder: Path = Path(folder)
+        # (mtime, size, source) for each notebook path, if in_memory is True
+        self.memory: Optional[Dict[str, Tuple[int, int, List[Tuple[int, str]]]]] = (
+            {} if in_memory else None
+        )
 
-        self.searched_folders: int = 0
-        self.searched_files: int = 0
-        self.searched_lines: int = 0
-        self.searched_bytes: int = 0
+    def cache_file(self, file: Path) -> Path:
+        """Gets the name of the cache file for a notebook.
 
-        self.last_folder_printed = ""
-        self.last_file_printed = ""
+        Args:
+            file: the notebook file
 
-        self.console_width = get_console_width()
+        Returns:
+            The cache file, named for a hash of the notebook's full path.
+        """
+        key = hashlib.sha1(str(file.resolve()).encode("utf-8", "replace"))
+        return self.folder.joinpath(key.hexdigest() + ".nbsource")
 
-    def print_search_match(self, match: Match) -> None:
-        """Prints a match to console.
+    def discard(self, file: Path) -> None:
+        """Removes a notebook's source from the cache, if it's there.
 
-        This is a wrapper around the Match.print_match method, to format the
-        output as appropriate for printing within the context of a Search
+        Args:
+            file: the notebook file
+
+        Returns:
+            None
+        """
+        if self.memory is not None:
+            self.memory.pop(str(file), None)
+        try:
+            self.cache_file(file).unlink()
+        except OSError:
+            pass
+
+    def source(self, file: Path) -> List[Tuple[int, str]]:
+        """Gets the source code lines of a notebook's code cells.
+
+        Args:
+            file: the notebook file, as a pathlib.Path
+
+        Returns:
+            A list of (cell number, source line) tuples, as for
+            notebook_source(). The notebook is only read and parsed if it's
+            not in the cache or has changed since it was cached.
+        """
+        stat = file.stat()
+        if self.memory is not None:
+            remembered = self.memory.get(str(file))
+            if remembered and remembered[:2] == (stat.st_mtime_ns, stat.st_size):
+                return remembered[2]
+        source: List[Tuple[int, str]]
+        cache_file: Path = self.cache_file(file)
+        try:
+            with cache_file.open("rb") as fhandle:
+                version, mtime, size, cells = pickle.load(fhandle)
+            if (version, mtime, size) == (
+                config.NOTEBOOK_CACHE_VERSION,
+                stat.st_mtime_ns,
+                stat.st_size,
+            ):
+                source = [
+                    (cell_no, source_line)
+                    for cell_no, source_lines in cells
+                    for source_line in source_lines
+                ]
+                if self.memory is not None:
+                    self.memory[str(file)] = (stat.st_mtime_ns, stat.st_size, source)
+                return source
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass  # not cached, or a damaged cache file that will be replaced
+
+        source = list(notebook_source(file))
+        if self.memory is not None:
+            self.memory[str(file)] = (stat.st_mtime_ns, stat.st_size, source)
+        # source lines are stored grouped by cell, to store each cell number
+        # only once
+        cells: List[Tuple[int, List[str]]] = []
+        for cell_no, source_line in source:
+            if not cells or cells[-1][0] != cell_no:
+                cells.append((cell_no, []))
+            cells[-1][1].append(source_line)
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with temp_file.open("wb") as fhandle:
+                pickle.dump(
+                    (
+                        config.NOTEBOOK_CACHE_VERSION,
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                        cells,
+                    ),
+                    fhandle,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(temp_file, cache_file)
+        except OSError:
+            pass  # the cache is an optimization, so searching continues
+        return source
+
+
+class Search:
+    """Master search instance. Typical use is to instantiate an instance and
+    set what to search for and which file types to search, then call the
+    search_folder method one or more times to do the searches, then call the
+    print_summary method to print a summary. A folder or file is only searched
+    once until reset_totals is called, even if several searches reach it.
+    """
+
+    def __init__(
+        self,
+        search_for: Union[str, List[str]],
+        file_types: List[str],
+        workers: int = 1,
+        engine: str = "text",
+        skipped_folders: Optional[List[str]] = None,
+        skipped_globs: Optional[List[str]] = None,
+        skipped_regexes: Optional[List[str]] = None,
+        gitignore: bool = False,
+        follow_links: bool = False,
+        archives: bool = False,
+        max_count: Optional[int] = None,
+        max_results: Optional[int] = None,
+        recent: bool = False,
+        files_with_matches: bool = False,
+        output_format: str = "text",
+        stats: bool = False,
+        regex: bool = False,
+        word: bool = False,
+        case_sensitive: bool = False,
+        code: bool = False,
+        context: Tuple[int, int] = (0, 0),
+        deadline: Optional[float] = None,
+    ) -> None:
+        """Constructor
+
+        Args:
+            search_for: text to be searched for, or a list of patterns to
+                search for in a single pass. Each match's search_for is the
+                pattern that was found.
+            file_types: list of file types to search, with preceding period
+                on each (e.g., [".py", ".ipynb"])
+            workers: number of worker processes used to search files. The
+                default of 1 searches each file in the current process.
+            engine: the search_file engine to use, "text" or "mmap"
+            skipped_folders: names of folders to skip. Default:
+                config.SKIPPED_FOLDERS
+            skipped_globs: glob patterns for names of folders to skip.
+                Default: config.SKIPPED_FOLDER_GLOBS
+            skipped_regexes: regular expressions for paths of folders to
+                skip. Default: config.SKIPPED_FOLDER_REGEXES
+            gitignore: whether to skip files and folders that are ignored by
+                .gitignore files in the searched folders
+            follow_links: whether to follow symlinks to folders. Symlinks to
+                files are always followed. Either way, each folder and file
+                is searched only once (see walk_folder).
+            archives: whether to also search the members of .whl, .egg, .zip
+                and .tar.gz archives (see iter_archive_matches) that are of
+                the file types being searched
+            max_count: maximum number of matches to find in each file
+            max_results: maximum number of matches to find in total
+            recent: whether iter_folders_matches searches the most recently
+                modified files first, instead of in walk order
+            files_with_matches: whether to only find the first match in each
+                file, and print only the file's path
+            output_format: "text" to print color-highlighted matches, or
+                "jsonl" to print a JSON record for each match and a summary
+                record, with no status line
+            stats: whether to collect timing statistics, which are printed
+                by print_summary
+            regex: whether search_for is a regular expression (or a list of
+                them)
+            word: whether to only match whole words
+            case_sensitive: whether matching is case-sensitive
+            code: whether to match sequences of Python tokens in .py files and
+                notebooks, as for TextMatcher. Context lines aren't included
+                with these matches.
+            context: the number of (before, after) context lines to include
+                with each match
+            deadline: the time.monotonic() time to stop searching at, if the
+                search hasn't finished. The matches found by then are kept,
+                and the summary is marked as partial (see is_stopped).
+
+        Returns:
+            None
+
+        Raises:
+            re.error: if regex is True and search_for isn't a valid regular
+                expression.
+            ValueError: if code is True and a pattern has no code tokens.
+        """
+        self.search_for: Union[str, List[str]] = search_for
+        self.patterns: List[str] = pattern_list(search_for)
+        self.file_types: List[str] = file_types
+        self.skipped_names: set = set(
+            config.SKIPPED_FOLDERS if skipped_folders is None else skipped_folders
+        )
+        globs: List[str] = (
+            config.SKIPPED_FOLDER_GLOBS if skipped_globs is None else skipped_globs
+        )
+        regexes: List[str] = (
+            config.SKIPPED_FOLDER_REGEXES
+            if skipped_regexes is None
+            else skipped_regexes
+        )
+        # the exclude rules are combined into one regex each for folder names
+        # and folder paths, so each folder is checked with a single match
+        self.skipped_name_regex: Optional[Pattern[str]] = (
+            re.compile("|".join(fnmatch.translate(glob) for glob in globs))
+            if globs
+            else None
+        )
+        self.skipped_path_regex: Optional[Pattern[str]] = (
+            re.compile("|".join(f"(?:{regex})" for regex in regexes))
+            if regexes
+            else None
+        )
+        self.gitignore: bool = gitignore
+        # compiled .gitignore rules, by folder (None if no .gitignore file)
+        self.gitignore_cache: Dict[str, Optional[GitIgnore]] = {}
+        self.follow_links: bool = follow_links
+        # (st_dev, st_ino) of the folders and files walked in the current
+        # search, so that overlapping search roots, hard links and symlinks
+        # don't lead to anything being searched twice. It's cleared when a
+        # new search starts, and shared by the roots of a multi-root search.
+        self.visited: set = set()
+        self.archives: bool = archives
+        # archive tables of contents, by path, kept between searches
+        self.archive_cache: Dict[str, ArchiveContents] = {}
+        self.engine: str = engine
+        self.text_matcher: TextMatcher = TextMatcher(
+            search_for,
+            regex=regex,
+            word=word,
+            case_sensitive=case_sensitive,
+            code=code,
+        )
+        self.index_patterns: Optional[List[str]] = self.text_matcher.index_patterns()
+        self.workers: int = max(1, workers)
+        self.executor: Optional[Executor] = None
+        self.index: Optional[TrigramIndex] = None
+        self.notebook_cache: Optional[NotebookCache] = None
+        self.token_cache: Optional[TokenCache] = None
+        # folder listings kept between searches, by path: (mtime, entries)
+        self.folder_cache: Optional[Dict[str, Tuple[int, List[os.DirEntry]]]] = None
+
+        self.files_with_matches: bool = files_with_matches
+        self.max_count: Optional[int] = 1 if files_with_matches else max_count
+        # context is a list in requests to the pyfind server
+        self.context: Tuple[int, int] = (
+            (0, 0) if files_with_matches else (context[0], context[1])
+        )
+        self.max_results: Optional[int] = max_results
+        self.recent: bool = recent
+        self.match_count: int = 0
+        self.stop_requested: bool = False
+        self.deadline: Optional[float] = deadline
+        self.timed_out: bool = False
+
+        self.searched_folders: int = 0
+        self.searched_files: int = 0
+        self.searched_lines: int = 0
+        self.searched_bytes: int = 0
+        # folders that weren't walked and files that were found but not
+        # searched, because the deadline passed or the file was deleted or
+        # couldn't be read by the time it was searched
+        self.skipped_folders: int = 0
+        self.skipped_files: int = 0
+
+        self.last_folder_printed = ""
+        self.last_file_printed = ""
+
+        self.output_format: str = output_format
+        self.stats: Optional[SearchStats] = SearchStats() if stats else None
+        self.console: Console = Console()
+        self.console_width = self.console.width
+        if output_format == "jsonl":
+            self.console.show_progress = False
+
+    def close(self) -> None:
+        """Shuts down the worker pool, if one was started, saves the trigram
+        index, if one is in use, and flushes console output.
+
+        The pool is started on first use and re-used across search_folder
+        calls, so callers that pass workers > 1 or set an index should call
+        close() after the last search.
+        """
+        self.console.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.index is not None:
+            self.index.save()
+
+    def iter_folders_matches(
+        self, folders: Iterable[Union[Path, str]], subdirs: bool = False
+    ) -> Generator[Match, None, None]:
+        """Searches several folders' files and yields matches as they're found.
+
+        Args:
+            folders: the folders to be searched, such as the folders returned
+                by search_roots()
+            subdirs: whether to recursively search all subfolders
+
+        Returns:
+            A generator that yields each match found, as a Match object, as
+            for iter_matches.
+
+        If self.recent is True, all of the folders are walked first, and their
+        files are searched from the most recently modified to the least
+        recently modified, so that matches in the files being worked on are
+        found first. Walking and checking each file's mtime is much quicker
+        than searching, so with max_results or a deadline, the matches that
+        are found are the most recent ones. Otherwise each folder is searched
+        in turn, in walk order. The folders are one search, so a folder or file
+        that's reached from more than one of them is only searched once.
+        """
+        self.visited.clear()
+        if not self.recent:
+            for folder in folders:
+                if self.is_stopped():
+                    if self.timed_out:
+                        self.skipped_folders += 1
+                    continue
+                walked: Generator[Path, None, None] = self.walk_folder(
+                    folder, subdirs
+                )
+                try:
+                    yield from self.iter_walked_matches(walked)
+                finally:
+                    walked.close()
+            return
+
+        if self.stats is not None:
+            self.stats.switch("walk")
+        recent_files: List[Tuple[int, Path]] = []
+        for folder in folders:
+            if self.is_stopped():
+                if self.timed_out:
+                    self.skipped_folders += 1
+                continue
+            for file in self.walk_folder(folder, subdirs):
+                try:
+                    recent_files.append((file.stat().st_mtime_ns, file))
+                except OSError:
+                    continue  # deleted since the folder was listed
+        # the sort is stable, so files with the same mtime stay in walk order
+        recent_files.sort(key=lambda item: item[0], reverse=True)
+        files: Deque[Path] = deque(file for _, file in recent_files)
+
+        def unsearched() -> Iterator[Path]:
+            while files and not self.is_stopped():
+                yield files.popleft()
+
+        try:
+            yield from self.iter_walked_matches(unsearched())
+        finally:
+            if self.timed_out:
+                self.skipped_files += len(files)
+
+    def iter_matches(
+        self, folder: str, subdirs: bool = False
+    ) -> Generator[Match, None, None]:
+        """Searches a folder's files and yields matches as they're found.
+
+        Args:
+            folder: name of the folder to be searched
+            subdirs: whether to recursively search all subfolders
+
+        Returns:
+            A generator that yields each match found, as a Match object. The
+            search totals are updated as files are searched. Matches aren't
+            kept after they're yielded, so memory use doesn't grow with the
+            number of matches, and calling close() on the generator stops the
+            search. If the deadline passes, the search stops and the folders
+            and files that weren't searched are added to skipped_folders and
+            skipped_files.
+
+        With workers > 1, each file is searched in a worker process and its
+        matches are yielded when the whole file has been searched. Each call
+        is a new search, so folders and files visited by earlier calls are
+        searched again.
+        """
+        self.visited.clear()
+        if self.is_stopped():
+            if self.timed_out:
+                self.skipped_folders += 1
+            return
+        files: Generator[Path, None, None] = self.walk_folder(folder, subdirs)
+        try:
+            yield from self.iter_walked_matches(files)
+        finally:
+            # the walk counts what it skipped when it's closed
+            files.close()
+
+    def iter_server_matches(
+        self, records: Iterable[dict]
+    ) -> Generator[Match, None, None]:
+        """Yields the matches found by a search on the pyfind server.
+
+        Args:
+            records: the records received from the server, as returned by
+                query_server()
+
+        Returns:
+            A generator that yields each match, as a Match object. The search
+            totals are set from the server's summary record.
+
+        Raises:
+            RuntimeError: if the server couldn't run the search.
+        """
+        for record in records:
+            if record["type"] == "match":
+                self.match_count += 1
+                yield Match(
+                    Path(record["path"]),
+                    record["text"],
+                    record["position"],
+                    record["pattern"],
+                    tuple(record["span"]) if record["span"] else None,
+                    record["before"],
+                    record["after"],
+                )
+            elif record["type"] == "summary":
+                self.searched_folders += record["folders"]
+                self.searched_files += record["files"]
+                self.searched_lines += record["lines"]
+                self.searched_bytes += record["bytes"]
+                if record["partial"]:
+                    self.timed_out = True
+                self.skipped_folders += record["skipped_folders"]
+                self.skipped_files += record["skipped_files"]
+            elif record["type"] == "error":
+                raise RuntimeError(record["message"])
+
+    def iter_walked_matches(
+        self, files: Iterator[Path]
+    ) -> Generator[Match, None, None]:
+        """Searches files found by walk_folder and yields matches as they're
+        found, for iter_matches and iter_folders_matches.
+
+        Args:
+            files: the files to be searched, in the order to search them
+
+        Returns:
+            A generator that yields each match found, as a Match object. The
+            search totals are updated as files are searched, and it stops when
+            is_stopped() returns True.
+        """
+        stats: Optional[SearchStats] = self.stats
+        if self.workers > 1:
+            # files are walked and searched in worker processes while
+            # waiting for results, so that time isn't broken down further
+            if stats is not None:
+                stats.switch("workers")
+            results = self.search_files(files)
+            try:
+                for matches, lines_count, bytes_count in results:
+                    self.searched_files += 1
+                    self.searched_lines += lines_count
+                    self.searched_bytes += bytes_count
+                    for match in matches:
+                        self.match_count += 1
+                        yield match
+                        if self.is_stopped():
+                            return
+                    self.console.poll()
+                    if self.is_stopped():
+                        return
+            finally:
+                results.close()
+            return
+
+        if stats is not None:
+            stats.switch("walk")
+        for file in files:
+            if stats is not None:
+                file_start: float = stats.switch("index")
+                render_start: float = stats.phases.get("render", 0.0)
+            try:
+                skipped = self.skip_file(file)
+            except OSError:
+                # deleted or made unreadable since it was found
+                self.skipped_files += 1
+                continue
+            if self.is_stopped():
+                # the deadline passed while the file was being indexed
+                if self.timed_out:
+                    self.skipped_files += 1
+                return
+            self.searched_files += 1
+            if skipped:
+                lines_count, bytes_count = skipped[1], skipped[2]
+            else:
+                file_matches = iter_file_matches(
+                    file,
+                    self.search_for,
+                    self.engine,
+                    max_count=self.max_count,
+                    stop=self.is_stopped,
+                    notebook_cache=self.notebook_cache,
+                    token_cache=self.token_cache,
+                    stats=stats,
+                    text_matcher=self.text_matcher,
+                    context=self.context,
+                    archive_types=self.file_types if self.archives else None,
+                    archive_cache=self.archive_cache,
+                )
+                while True:
+                    try:
+                        match: Match = next(file_matches)
+                    except StopIteration as done:
+                        lines_count, bytes_count = done.value
+                        break
+                    except OSError:
+                        self.searched_files -= 1
+                        self.skipped_files += 1
+                        lines_count, bytes_count = 0, 0
+                        break
+                    self.match_count += 1
+                    yield match
+            self.searched_lines += lines_count
+            self.searched_bytes += bytes_count
+            if stats is not None:
+                # time spent printing this file's matches isn't counted
+                file_end: float = stats.switch("walk")
+                stats.add_file(
+                    file,
+                    file_end
+                    - file_start
+                    - (stats.phases.get("render", 0.0) - render_start),
+                )
+            # printed matches aren't held back while other files are searched
+            self.console.poll()
+            if self.is_stopped():
+                return
+
+    def is_stopped(self) -> bool:
+        """Determines whether searching should stop.
+
+        Returns:
+            True if stop() has been called, max_results matches have been
+            found or the deadline has passed, else False. Files being searched
+            stop at their next match, or their next block if they're being
+            read as bytes, and no more files are searched.
+        """
+        if (
+            self.deadline is not None
+            and not self.timed_out
+            and time.monotonic() >= self.deadline
+        ):
+            self.timed_out = True
+        return (
+            self.stop_requested
+            or self.timed_out
+            or (self.max_results is not None and self.match_count >= self.max_results)
+        )
+
+    def list_folder(self, folder: str) -> List[os.DirEntry]:
+        """Lists the entries of a folder.
+
+        Args:
+            folder: path of the folder
+
+        Returns:
+            The folder's entries, from os.scandir(). If folder_cache is set,
+            listings are cached in it and re-used while the folder's mtime,
+            which changes when entries are added, removed or renamed, stays
+            the same.
+        """
+        if self.folder_cache is None:
+            with os.scandir(folder) as entries:
+                return list(entries)
+        mtime: int = os.stat(folder).st_mtime_ns
+        cached = self.folder_cache.get(folder)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with os.scandir(folder) as entries:
+            entry_list: List[os.DirEntry] = list(entries)
+        self.folder_cache[folder] = (mtime, entry_list)
+        return entry_list
+
+    def print_search_match(self, match: Match) -> None:
+        """Prints a match to console.
+
+        This is a wrapper around the Match.print_match method, to format the
+        output as appropriate for printing within the context of a Search
         instance.
         """
+        if self.stats is None:
+            self.render_match(match)
+            return
+        previous_phase: str = self.stats.phase
+        self.stats.switch("render")
+        self.render_match(match)
+        self.stats.switch(previous_phase)
+
+    def print_stats(self) -> None:
+        """Prints the timing statistics collected with the stats option.
+        """
+        if self.stats is None:
+            return
+        self.stats.switch("other")
+        if self.output_format == "jsonl":
+            self.console.write(json.dumps(self.stats.as_record()))
+            return
+
+        total: float = sum(self.stats.phases.values()) or 1.0
+        self.console.write("Time: ".rjust(config.PREFIX_LENGTH), config.COLOR_SUMMARY)
+        for phase, seconds in sorted(
+            self.stats.phases.items(), key=lambda item: item[1], reverse=True
+        ):
+            self.console.write(
+                f"{phase}: ".rjust(config.PREFIX_LENGTH)
+                + f"{seconds:9.3f}s {seconds / total:6.1%}",
+                config.COLOR_SUMMARY,
+            )
+        for title, slowest in [
+            ("Slowest folders:", self.stats.slowest_folders()),
+            ("Slowest files:", self.stats.slowest_files()),
+        ]:
+            if not slowest:
+                continue
+            self.console.write(title.rjust(config.PREFIX_LENGTH), config.COLOR_SUMMARY)
+            for seconds, name in slowest:
+                self.console.write(
+                    pad_string(
+                        f"{seconds:9.3f}s ".rjust(config.PREFIX_LENGTH) + name,
+                        self.console_width,
+                    ),
+                    config.COLOR_SUMMARY,
+                )
+
+    def print_summary(self):
+        """Prints the search totals to the console.
+        """
+        if self.output_format == "jsonl":
+            self.console.write(json.dumps(self.summary_record()))
+            self.print_stats()
+            self.console.flush()
+            return
+
+        self.console.write("\r", nl=False)  # reset console to start of line
+        prefix = "Searched: ".rjust(config.PREFIX_LENGTH)
+        summary_text = (
+            f"{prefix}{self.searched_folders} folders, "
+            f"{self.searched_files} files, "
+            f"{self.searched_lines} lines, "
+            f"{self.searched_bytes} bytes"
+        )
+        self.console.write(
+            pad_string(summary_text, self.console_width), config.COLOR_SUMMARY
+        )
+        if self.timed_out:
+            prefix = "Partial: ".rjust(config.PREFIX_LENGTH)
+            self.console.write(
+                pad_string(
+                    f"{prefix}timed out, {self.skipped_folders} folders and "
+                    f"{self.skipped_files} files not searched",
+                    self.console_width,
+                ),
+                config.COLOR_SUMMARY,
+            )
+        self.print_stats()
+        self.console.flush()
+
+    def render_match(self, match: Match) -> None:
+        """Prints a match to console, in the selected output format.
+
+        Args:
+            match: the match to be printed
+
+        Returns:
+            None
+        """
+        if self.output_format == "jsonl":
+            record: dict = match.as_record()
+            if self.files_with_matches:
+                record = {"type": "file", "path": record["path"]}
+            elif len(self.patterns) > 1:
+                record["pattern"] = match.search_for
+            self.console.write(json.dumps(record))
+            return
+
+        if self.files_with_matches:
+            self.console.write("\r", nl=False)  # reset console to start of line
+            self.console.write(
+                pad_string(str(match.file), self.console_width), config.COLOR_FILENAME
+            )
+            return
+
         if self.last_folder_printed != match.file.parent:
-            click.echo("\r", nl=False)  # reset console to start of line
+            self.console.write("\r", nl=False)  # reset console to start of line
             prefix = "folder: ".rjust(config.PREFIX_LENGTH)
             folder_name = pad_string(
                 str(match.file.parent), self.console_width - config.PREFIX_LENGTH
             )
 
-            click.echo(click.style(f"{prefix}{folder_name}", fg=config.COLOR_FOLDER))
-            self.last_folder_printed = match.file.parent
-            self.last_file_printed = ""
+            self.console.write(f"{prefix}{folder_name}", config.COLOR_FOLDER)
+            self.last_folder_printed = match.file.parent
+            self.last_file_printed = ""
+
+        if self.last_file_printed != match.file.name:
+            prefix = " " * config.PREFIX_LENGTH
+            self.console.write(f"{prefix}{match.file.name}", config.COLOR_FILENAME)
+            self.last_file_printed = match.file.name
+
+        match.print_match(self.console)
+
+    def reset_totals(self) -> None:
+        """Resets search totals to start a new set of searches. The deadline
+        isn't changed, so set a new one if it has passed.
+        """
+        self.searched_folders = 0
+        self.searched_files = 0
+        self.searched_lines = 0
+        self.searched_bytes = 0
+        self.skipped_folders = 0
+        self.skipped_files = 0
+        self.match_count = 0
+        self.stop_requested = False
+        self.timed_out = False
+        self.visited.clear()
+
+    def search_files(
+        self, files: Iterable[Path]
+    ) -> Iterator[Tuple[List[Match], int, int]]:
+        """Searches a sequence of files, in parallel if workers > 1.
+
+        Args:
+            files: the files to be searched, as pathlib.Path objects
+
+        Returns:
+            A generator that yields the search_file results for each file, in
+            the same order as files. Each file's results are complete before
+            they're yielded, so output from two files is never interleaved.
+        """
+        search = partial(
+            search_file,
+            search_for=self.search_for,
+            engine=self.engine,
+            max_count=self.max_count,
+            notebook_cache=self.notebook_cache,
+            token_cache=self.token_cache,
+            text_matcher=self.text_matcher,
+            context=self.context,
+            archive_types=self.file_types if self.archives else None,
+        )
+        if self.workers == 1:
+            for file in files:
+                try:
+                    result = self.skip_file(file) or search(file)
+                except OSError:
+                    # deleted or made unreadable since it was found
+                    self.skipped_files += 1
+                    continue
+                yield result
+            return
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        # Keep a bounded window of pending files, so that the walk doesn't run
+        # far ahead of the results and memory use stays flat on huge trees.
+        # Files skipped by the index are queued as completed results, to keep
+        # the output order the same as the walk order.
+        pending: Deque = deque()
+        try:
+            for file in files:
+                if self.is_stopped():
+                    # e.g., the deadline passed while indexing the last file
+                    if self.timed_out:
+                        self.skipped_files += 1
+                    break
+                try:
+                    skipped = self.skip_file(file)
+                except OSError:
+                    skipped = None
+                if skipped is not None:
+                    pending.append(skipped)
+                else:
+                    pending.append(self.executor.submit(search, file))
+                if len(pending) >= self.workers * config.WORKER_QUEUE_DEPTH:
+                    result = result_of(pending.popleft())
+                    if result is None:
+                        self.skipped_files += 1
+                    else:
+                        yield result
+            while pending:
+                result = result_of(pending.popleft())
+                if result is None:
+                    self.skipped_files += 1
+                else:
+                    yield result
+        finally:
+            # if the caller stopped early, don't search the queued files
+            for future in pending:
+                if isinstance(future, Future):
+                    future.cancel()
+            if self.timed_out:
+                self.skipped_files += len(pending)
+
+    def search_folder(
+        self, folder: str, subdirs: bool = False, print_matches: bool = True
+    ) -> List[Match]:
+        """Searches a folder's files.
+
+        Args:
+            folder: name of the folder to be searched
+            subdirs: whether to recursively search all subfolders
+            print_matches: whether to print matches to the console
+
+        Returns:
+            A list of the matches found, as Match objects. The matches are
+            compacted after they're printed (see Match.compact), so that a
+            large list of matches doesn't keep the text of every matched line
+            in memory.
+        """
+        matchlist = []
+        for match in self.iter_matches(folder, subdirs):
+            if print_matches:
+                self.print_search_match(match)
+            matchlist.append(match.compact())
+        self.console.flush()
+        return matchlist
+
+    def search_roots(self, folders: Iterable[str], subdirs: bool = False) -> List[str]:
+        """Normalizes a list of folders to be searched, such as the folders in
+        projects.txt.
+
+        Args:
+            folders: the folders to be searched
+            subdirs: whether the folders' subfolders will be searched
+
+        Returns:
+            The folders' real paths, with symlinks resolved, in the same order
+            but without duplicates. If subdirs is True, folders inside another
+            of the folders are also removed, unless that folder's walk won't
+            reach them because a folder on the way is skipped or .gitignore
+            rules are in use. Anything else that's reached more than once is
+            only searched once, because walk_folder skips visited folders.
+            The visited folders and files are cleared, as this starts a new
+            search.
+        """
+        self.visited.clear()
+        roots: List[str] = []
+        for folder in folders:
+            root: str = os.path.realpath(folder)
+            if root not in roots:
+                roots.append(root)
+        if not subdirs or self.gitignore:
+            return roots
+
+        def reaches(parent: str, root: str) -> bool:
+            if root == parent or not root.startswith(parent.rstrip(os.sep) + os.sep):
+                return False
+            if self.skip_folder(os.path.basename(parent), parent):
+                return False
+            path: str = parent
+            for name in os.path.relpath(root, parent).split(os.sep):
+                path = os.path.join(path, name)
+                if self.skip_folder(name, path):
+                    return False
+            return True
+
+        return [
+            root for root in roots if not any(reaches(other, root) for other in roots)
+        ]
+
+    def skip_file(self, file: Path) -> Optional[Tuple[List[Match], int, int]]:
+        """Checks the trigram index to see whether a file can be skipped.
+
+        Args:
+            file: the file to be checked
+
+        Returns:
+            If the index shows that the file can't contain a match, the
+            search_file results for the file (no matches, and the line and
+            byte counts from the index). Otherwise None, and the file needs to
+            be searched. Files are always searched if a regular expression
+            has no literal text that the index can check, and archives are
+            never indexed.
+        """
+        if self.index is None or self.index_patterns is None or is_archive(file):
+            return None
+        entry: IndexEntry = self.index.refresh(file)
+        if self.index.may_contain(entry, self.index_patterns):
+            return None
+        # a file with no lines is empty or binary, and isn't read
+        return ([], entry[2], entry[1] if entry[2] else 0)
+
+    def skip_folder(self, name: str, path: str) -> bool:
+        """Determines whether a folder should be skipped.
+
+        Args:
+            name: the folder's name
+            path: the folder's path
+
+        Returns:
+            True if the folder matches the skipped folder names, globs or
+            regexes, else False.
+        """
+        return (
+            name in self.skipped_names
+            or (
+                self.skipped_name_regex is not None
+                and self.skipped_name_regex.match(name) is not None
+            )
+            or (
+                self.skipped_path_regex is not None
+                and self.skipped_path_regex.search(path) is not None
+            )
+        )
+
+    def stop(self) -> None:
+        """Stops the search.
+
+        This can be called while iterating over iter_matches, for example from
+        a library caller that has found what it needs. Searching stops at the
+        next match or the next file, and the search totals include only what
+        was actually read. Call reset_totals() before starting a new search.
+        """
+        self.stop_requested = True
+
+    def summary_record(self) -> dict:
+        """Returns the search totals, as a JSON Lines summary record.
+
+        The record's partial value is True if the deadline passed before the
+        search finished, and skipped_folders and skipped_files are the number
+        of folders that weren't walked and files that were found but not
+        searched. Subfolders of the skipped folders aren't counted.
+        """
+        return {
+            "type": "summary",
+            "folders": self.searched_folders,
+            "files": self.searched_files,
+            "lines": self.searched_lines,
+            "bytes": self.searched_bytes,
+            "partial": self.timed_out,
+            "skipped_folders": self.skipped_folders,
+            "skipped_files": self.skipped_files,
+        }
+
+    def walk_folder(
+        self, folder: str, subdirs: bool = False
+    ) -> Generator[Path, None, None]:
+        """Walks a folder and yields the files to be searched.
+
+        Args:
+            folder: name of the folder to be walked
+            subdirs: whether to recursively walk all subfolders
+
+        Returns:
+            A generator that yields each file of a type in self.file_types,
+            and each archive if self.archives is True, as a pathlib.Path. The
+            searched_folders total is updated and the
+            running status line is printed as each folder is visited.
+
+        Skipped folders are pruned before they're opened, so nothing below
+        them is walked. Like os.walk, symlinks to folders are only followed if
+        self.follow_links is True. Folders and files already in self.visited
+        are skipped, which breaks symlink cycles and means that a search root
+        inside another one, or a file reached by two paths, is only searched
+        once. The walk stops when the search is stopped, and if the deadline
+        has passed, the folders and files that weren't reached are counted in
+        skipped_folders and skipped_files.
+        """
+        root: str = os.fspath(folder)
+        if self.skip_folder(os.path.basename(os.path.normpath(root)), root):
+            return
+        file_types: set = set(self.file_types)
+        # each folder to be walked is stacked with the .gitignore rules that
+        # apply to it, from the search root down
+        folders: List[Tuple[str, Tuple[GitIgnore, ...]]] = [(root, ())]
+        # the files found in the current folder that haven't been yielded yet
+        files: List[str] = []
+        try:
+            while folders and not self.is_stopped():
+                current_folder: str
+                ignore_rules: Tuple[GitIgnore, ...]
+                current_folder, ignore_rules = folders.pop()
+                try:
+                    folder_stat: os.stat_result = os.stat(current_folder)
+                    folder_id: Tuple[int, int] = (
+                        folder_stat.st_dev,
+                        folder_stat.st_ino,
+                    )
+                    if folder_id in self.visited:
+                        continue
+                    entry_list: List[os.DirEntry] = self.list_folder(current_folder)
+                except OSError:
+                    continue  # unreadable folders are ignored, as in os.walk
+                self.visited.add(folder_id)
+
+                self.console.progress(current_folder, config.COLOR_SEARCHED_FOLDERS)
+                self.searched_folders += 1
+
+                if self.gitignore:
+                    if current_folder not in self.gitignore_cache:
+                        self.gitignore_cache[current_folder] = load_gitignore(
+                            current_folder
+                        )
+                    folder_rules = self.gitignore_cache[current_folder]
+                    if folder_rules is not None:
+                        ignore_rules = ignore_rules + (folder_rules,)
+
+                subfolders: List[str] = []
+                for entry in entry_list:
+                    try:
+                        is_dir: bool = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if (
+                            subdirs
+                            and (self.follow_links or not entry.is_symlink())
+                            and not self.skip_folder(entry.name, entry.path)
+                            and not is_ignored(ignore_rules, entry.path, True)
+                        ):
+                            subfolders.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in file_types or (
+                        self.archives and is_archive(entry.name)
+                    ):
+                        if is_ignored(ignore_rules, entry.path, False):
+                            continue
+                        # a file's inode number comes from the folder listing, so
+                        # only symlinks need a stat() call
+                        try:
+                            file_id: Tuple[int, int] = (
+                                (entry.stat().st_dev, entry.stat().st_ino)
+                                if entry.is_symlink()
+                                else (folder_stat.st_dev, entry.inode())
+                            )
+                        except OSError:
+                            continue  # a broken symlink
+                        if file_id not in self.visited:
+                            self.visited.add(file_id)
+                            files.append(entry.path)
+                # walk subfolders depth-first in directory order, as os.walk does
+                folders.extend(
+                    (subfolder, ignore_rules) for subfolder in reversed(subfolders)
+                )
+                files.reverse()
+                while files:
+                    yield Path(files.pop())
+
+        finally:
+            if self.timed_out:
+                self.skipped_folders += len(folders)
+                self.skipped_files += len(files)
+
+
+class SearchStats:
+    """Timing statistics for a search.
+
+    Time is attributed to one phase at a time (such as "walk", "read" or
+    "match"), by calling switch() at each phase boundary, so collecting the
+    statistics costs one timer call per boundary.
+    """
+
+    def __init__(self) -> None:
+        """Constructor
+
+        Returns:
+            None
+        """
+        self.phases: Dict[str, float] = {}
+        self.phase: str = "other"
+        self.phase_start: float = time.perf_counter()
+        # the slowest files, as a heap of (seconds, path) tuples
+        self.file_times: List[Tuple[float, str]] = []
+        self.folder_times: Dict[str, float] = {}
+
+    def add_file(self, file: Path, seconds: float) -> None:
+        """Records the time taken to search a file.
+
+        Args:
+            file: the file
+            seconds: the time taken to search the file
+
+        Returns:
+            None
+        """
+        folder: str = str(file.parent)
+        self.folder_times[folder] = self.folder_times.get(folder, 0.0) + seconds
+        if len(self.file_times) < config.STATS_SLOWEST_COUNT:
+            heapq.heappush(self.file_times, (seconds, str(file)))
+        elif seconds > self.file_times[0][0]:
+            heapq.heapreplace(self.file_times, (seconds, str(file)))
+
+    def as_record(self) -> dict:
+        """Converts the statistics to a dictionary, for JSON output.
+
+        Returns:
+            A dictionary with the seconds spent in each phase, and the slowest
+            folders and files.
+        """
+        return {
+            "type": "stats",
+            "phases": dict(self.phases),
+            "slowest_folders": [
+                {"path": name, "seconds": seconds}
+                for seconds, name in self.slowest_folders()
+            ],
+            "slowest_files": [
+                {"path": name, "seconds": seconds}
+                for seconds, name in self.slowest_files()
+            ],
+        }
+
+    def slowest_files(self) -> List[Tuple[float, str]]:
+        """Gets the slowest files searched.
+
+        Returns:
+            A list of (seconds, path) tuples, slowest first.
+        """
+        return sorted(self.file_times, reverse=True)
+
+    def slowest_folders(self) -> List[Tuple[float, str]]:
+        """Gets the folders whose files took the longest to search.
+
+        Returns:
+            A list of (seconds, path) tuples, slowest first.
+        """
+        return heapq.nlargest(
+            config.STATS_SLOWEST_COUNT,
+            ((seconds, name) for name, seconds in self.folder_times.items()),
+        )
+
+    def switch(self, phase: str) -> float:
+        """Ends the current phase and starts another one.
+
+        Args:
+            phase: name of the phase that's starting
+
+        Returns:
+            The current time, from time.perf_counter().
+        """
+        now: float = time.perf_counter()
+        self.phases[self.phase] = (
+            self.phases.get(self.phase, 0.0) + now - self.phase_start
+        )
+        self.phase = phase
+        self.phase_start = now
+        return now
+
+
+class Server:
+    """Long-running search server for the folders in projects.txt.
+
+    The server keeps the trigram index, the source code extracted from
+    notebooks and the listing of each folder in memory between searches, and
+    listens on a Unix socket. Each connection sends one search request, a
+    line of JSON with the Search options and an optional timeout in seconds,
+    and receives a line of JSON for
+    each match, followed by a summary record with the search totals. Use
+    query_server() to send a request.
+    """
+
+    def __init__(
+        self, pyfind_folder: Path, use_index: bool = True, use_cache: bool = True
+    ) -> None:
+        """Constructor
+
+        Args:
+            pyfind_folder: the pyfind folder, which contains projects.txt
+            use_index: whether to use the trigram index
+            use_cache: whether to use the caches of notebook source code and
+                code tokens
+
+        Returns:
+            None
+        """
+        self.pyfind_folder: Path = pyfind_folder
+        self.socket_file: Path = pyfind_folder.joinpath(config.SERVER_SOCKET)
+        self.index: Optional[TrigramIndex] = (
+            TrigramIndex(pyfind_folder.joinpath(config.INDEX_FILE))
+            if use_index
+            else None
+        )
+        self.notebook_cache: Optional[NotebookCache] = (
+            NotebookCache(
+                pyfind_folder.joinpath(config.NOTEBOOK_CACHE_FOLDER), in_memory=True
+            )
+            if use_cache
+            else None
+        )
+        self.token_cache: Optional[TokenCache] = (
+            TokenCache(
+                pyfind_folder.joinpath(config.TOKEN_CACHE_FOLDER), in_memory=True
+            )
+            if use_cache
+            else None
+        )
+        self.folder_cache: Dict[str, Tuple[int, List[os.DirEntry]]] = {}
+        self.archive_cache: Dict[str, ArchiveContents] = {}
+
+    def handle(self, connection: socket.socket) -> None:
+        """Runs the search requested on a connection, and sends the results.
+
+        Args:
+            connection: the connected socket
+
+        Returns:
+            None
+
+        A request that isn't valid, for example from an older or newer
+        client, gets an error record instead of search results.
+        """
+        with connection.makefile("rb") as reader:
+            request_line: bytes = reader.readline()
+        with connection.makefile("w", encoding="utf-8") as writer:
+            try:
+                request: Any = json.loads(request_line)
+                if not isinstance(request, dict) or not isinstance(
+                    request.get("options"), dict
+                ):
+                    raise ValueError("the request has no search options")
+                subdirs: bool = bool(request.get("subdirs", False))
+                timeout: Any = request.get("timeout")
+                if timeout is not None and not isinstance(timeout, (int, float)):
+                    raise ValueError(f"the timeout isn't a number: {timeout!r}")
+                searcher = Search(**request["options"])
+            except (re.error, TypeError, ValueError) as error:
+                writer.write(json.dumps({"type": "error", "message": str(error)}))
+                writer.write("\n")
+                return
+            searcher.index = self.index
+            searcher.notebook_cache = self.notebook_cache
+            searcher.token_cache = self.token_cache
+            searcher.folder_cache = self.folder_cache
+            searcher.archive_cache = self.archive_cache
+            # records are buffered and flushed like console output, so that
+            # they're sent while the search runs
+            searcher.console = Console(writer)
+            if timeout is not None:
+                searcher.deadline = time.monotonic() + timeout
+            projects_file: Path = self.pyfind_folder.joinpath("projects.txt")
+            for match in searcher.iter_folders_matches(
+                searcher.search_roots(textfile_to_list(projects_file), subdirs=subdirs),
+                subdirs=subdirs,
+            ):
+                record: dict = {
+                    "type": "match",
+                    "path": str(match.file),
+                    "position": match.position,
+                    "text": match.match,
+                    "pattern": match.search_for,
+                    "span": match.span,
+                    "before": match.before,
+                    "after": match.after,
+                }
+                searcher.console.write(json.dumps(record))
+            searcher.console.write(json.dumps(searcher.summary_record()))
+            searcher.console.flush()
+
+    def serve(self, requests: Optional[int] = None) -> None:
+        """Handles search requests, one at a time, until interrupted.
+
+        Args:
+            requests: the number of requests to handle before stopping, or
+                None to run until interrupted
+
+        Returns:
+            None
+
+        The trigram index is saved after each search if it has changed, and
+        the socket file is removed when the server stops.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            if self.socket_file.exists():
+                self.socket_file.unlink()  # left behind by a server that crashed
+            listener.bind(str(self.socket_file))
+            listener.listen()
+            handled: int = 0
+            try:
+                while requests is None or handled < requests:
+                    connection, _ = listener.accept()
+                    handled += 1
+                    with connection:
+                        try:
+                            self.handle(connection)
+                        except (OSError, ValueError, TypeError, KeyError):
+                            # the client disconnected, or a bad request got
+                            # past handle()'s checks; later clients are served
+                            pass
+                    if self.index is not None:
+                        self.index.save()
+            finally:
+                self.socket_file.unlink()
+
+
+class TextMatcher:
+    """Matcher for one or more search patterns, compiled once per search.
+
+    By default each pattern is a case-insensitive substring. With more than
+    one pattern, the patterns are merged into a trie that's compiled into a
+    single regular expression (see pattern_regex), so each line is scanned
+    once no matter how many patterns there are. Only lines that contain a
+    match are checked for each pattern, to find out which patterns they
+    contain.
+
+    In regex and word modes each pattern is compiled into its own regular
+    expression, and lines that don't contain the literal text required by
+    the regular expression (see required_literal) are rejected before it's
+    run.
+
+    In code mode each pattern is split into Python tokens, which are matched
+    against the tokens of .py files and notebooks by iter_code_matches().
+    Other files are searched for the patterns as substrings.
+    """
+
+    def __init__(
+        self,
+        search_for: Union[str, List[str]],
+        regex: bool = False,
+        word: bool = False,
+        case_sensitive: bool = False,
+        code: bool = False,
+    ) -> None:
+        """Constructor, compiles the patterns.
+
+        Args:
+            search_for: the text to search for, or a list of patterns
+            regex: whether the patterns are regular expressions
+            word: whether matches must be whole words, i.e. not preceded or
+                followed by a word character
+            case_sensitive: whether matching is case-sensitive
+            code: whether to match the patterns as sequences of Python tokens,
+                so that "json.dumps" matches json.dumps(x) and json . dumps,
+                but not my_json.dumps_all or a comment. Can't be combined
+                with regex.
+
+        Returns:
+            None
+
+        Raises:
+            re.error: if regex is True and a pattern isn't a valid regular
+                expression.
+            ValueError: if code is True and a pattern has no code tokens, or
+                regex is also True.
+        """
+        self.patterns: List[str] = pattern_list(search_for)
+        self.regex_mode: bool = regex
+        self.word: bool = word
+        self.case_sensitive: bool = case_sensitive
+        # in substring mode, lines are lowercased unless case_sensitive
+        self.fold: bool = not case_sensitive
+        self.needles: List[str] = [
+            pattern.lower() if self.fold else pattern for pattern in self.patterns
+        ]
+        self.single: Optional[str] = None
+        self.regex: Optional[Pattern[str]] = None
+        # regex and word modes: (pattern, regex, prefilter literal, fold
+        # the line before checking the literal) for each pattern
+        self.regexes: List[Tuple[str, Pattern[str], str, bool]] = []
+        # bytes matchers compiled by bytes_matcher(), by encoding
+        self.bytes_matchers: Dict[str, Optional[Pattern[bytes]]] = {}
+        # code mode: (pattern, its tokens as found in TokenCache code with a
+        # space before and after, number of tokens) for each pattern
+        self.code_patterns: Optional[List[Tuple[str, str, int]]] = None
+
+        if code:
+            if regex:
+                raise ValueError("code mode can't be used with regex")
+            self.code_patterns = []
+            for pattern in self.patterns:
+                tokens: List[str] = [token[0] for token in code_tokens(pattern)]
+                while tokens and tokens[-1] == "\n":
+                    tokens.pop()
+                if not tokens:
+                    raise ValueError(f"{pattern!r} has no code tokens")
+                needle: str = f" {' '.join(tokens)} "
+                self.code_patterns.append(
+                    (pattern, needle.lower() if self.fold else needle, len(tokens))
+                )
+
+        if regex or word:
+            flags: int = 0 if case_sensitive else re.IGNORECASE
+            for pattern in self.patterns:
+                source: str = pattern if regex else re.escape(pattern)
+                if word:
+                    source = rf"(?<!\w)(?:{source})(?!\w)"
+                literal, ignore_case = required_literal(source, flags)
+                self.regexes.append(
+                    (
+                        pattern,
+                        re.compile(source, flags),
+                        literal.casefold() if ignore_case else literal,
+                        ignore_case,
+                    )
+                )
+        elif len(self.patterns) == 1:
+            self.single = self.needles[0]
+        elif self.patterns:
+            self.regex = re.compile(pattern_regex(self.needles))
+
+    def bytes_matcher(
+        self, encoding: Optional[str] = None
+    ) -> Optional[Pattern[bytes]]:
+        """Gets a bytes matcher that finds the lines that may match.
+
+        Args:
+            encoding: the encoding of the files to be searched. Default: the
+                locale's preferred encoding.
+
+        Returns:
+            The matcher from compile_matcher(), or None if the patterns can't
+            be matched as raw bytes. It's compiled once for each encoding. In
+            regex and word modes it matches the literal text required by each
+            regular expression, and find() checks the lines that contain it,
+            so it's None if a regular expression has no required literal.
+        """
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        if encoding not in self.bytes_matchers:
+            matcher: Optional[Pattern[bytes]] = None
+            if not self.regexes:
+                matcher = compile_matcher(self.patterns, self.case_sensitive, encoding)
+            else:
+                # the literal is found ignoring case if any regex ignores case
+                literals: List[str] = []
+                ignore_case: bool = False
+                for _, regex, _, _ in self.regexes:
+                    literal, literal_ignores_case = required_literal(
+                        regex.pattern, regex.flags
+                    )
+                    literals.append(literal)
+                    ignore_case = ignore_case or literal_ignores_case
+                if all(literals):
+                    matcher = compile_matcher(literals, not ignore_case, encoding)
+            self.bytes_matchers[encoding] = matcher
+        return self.bytes_matchers[encoding]
+
+    def find(self, line: str) -> List[Tuple[str, int, int]]:
+        """Finds the patterns that a line contains.
+
+        Args:
+            line: the line of text to be searched
+
+        Returns:
+            A (pattern, start, end) tuple for the first match of each pattern
+            found in the line, in the order the patterns were given, or an
+            empty list if the line doesn't contain any of them. Start and end
+            are the offsets of the matched text in line.
+        """
+        found: List[Tuple[str, int, int]] = []
+        if self.regexes:
+            folded: Optional[str] = None
+            for pattern, regex, literal, ignore_case in self.regexes:
+                if literal:
+                    if ignore_case:
+                        if folded is None:
+                            folded = line.casefold()
+                        if literal not in folded:
+                            continue
+                    elif literal not in line:
+                        continue
+                hit = regex.search(line)
+                if hit:
+                    found.append((pattern, hit.start(), hit.end()))
+            return found
+
+        text: str = line.lower() if self.fold else line
+        if self.regex is not None and self.regex.search(text) is None:
+            return found
+        for pattern, needle in zip(self.patterns, self.needles):
+            start: int = text.find(needle)
+            if start != -1:
+                found.append((pattern, start, start + len(needle)))
+        return found
+
+    def index_patterns(self) -> Optional[List[str]]:
+        """Gets the text that the trigram index can check for each pattern.
+
+        Returns:
+            A list with text that every match of each pattern must contain,
+            ignoring case, or None if there's a pattern that the index can't
+            be used for, because it's a regular expression without any
+            required literal text. In code mode it's the longest token of each
+            pattern, because the tokens may be separated by whitespace.
+        """
+        if self.code_patterns is not None:
+            return [
+                max(needle.split(" "), key=len) for _, needle, _ in self.code_patterns
+            ]
+        if not self.regexes:
+            return self.patterns
+        literals: List[str] = []
+        for _, regex, _, _ in self.regexes:
+            literal, _ = required_literal(regex.pattern, regex.flags)
+            if not literal:
+                return None
+            literals.append(literal)
+        return literals
+
+
+class TokenCache:
+    """Persistent cache of the code tokens of Python files and notebooks.
+
+    The names, operators and numbers in each file (see tokenize_source) are
+    saved in a small file in the cache folder, along with the file's mtime
+    and size, so a file is only tokenized again after it changes. The tokens
+    are stored as a single string, separated by spaces, so a --code search
+    for a sequence of tokens is a substring search of that string.
+    """
+
+    def __init__(self, folder: Union[Path, str], in_memory: bool = False) -> None:
+        """Constructor
+
+        Args:
+            folder: the folder where the cached tokens are stored. It's
+                created when the first file is cached.
+            in_memory: whether to also keep the tokens in memory, for a
+                long-running process that searches the same files again
+
+        Returns:
+            None
+        """
+        self.folder: Path = Path(folder)
+        # (mtime, size, tokens) for each file path, if in_memory is True
+        self.memory: Optional[Dict[str, Tuple[int, int, CodeTokens]]] = (
+            {} if in_memory else None
+        )
+
+    def cache_file(self, file: Path) -> Path:
+        """Gets the name of the cache file for a Python file or notebook.
+
+        Args:
+            file: the Python file or notebook
+
+        Returns:
+            The cache file, named for a hash of the file's full path.
+        """
+        key = hashlib.sha1(str(file.resolve()).encode("utf-8", "replace"))
+        return self.folder.joinpath(key.hexdigest() + ".tokens")
+
+    def discard(self, file: Path) -> None:
+        """Removes a file's tokens from the cache, if they're there.
+
+        Args:
+            file: the Python file or notebook
+
+        Returns:
+            None
+        """
+        if self.memory is not None:
+            self.memory.pop(str(file), None)
+        try:
+            self.cache_file(file).unlink()
+        except OSError:
+            pass
+
+    def tokens(
+        self, file: Path, notebook_cache: Optional[NotebookCache] = None
+    ) -> CodeTokens:
+        """Gets the code tokens of a Python file or notebook.
+
+        Args:
+            file: the Python file or notebook, as a pathlib.Path
+            notebook_cache: the cache to read notebook source code from, if
+                the file has to be tokenized
+
+        Returns:
+            The file's tokens, as returned by tokenize_source(). The file is
+            only read and tokenized if it's not in the cache or has changed
+            since it was cached.
+        """
+        stat = file.stat()
+        if self.memory is not None:
+            remembered = self.memory.get(str(file))
+            if remembered and remembered[:2] == (stat.st_mtime_ns, stat.st_size):
+                return remembered[2]
+        tokens: CodeTokens
+        cache_file: Path = self.cache_file(file)
+        try:
+            with cache_file.open("rb") as fhandle:
+                version, mtime, size, tokens = pickle.load(fhandle)
+            if (version, mtime, size) == (
+                config.TOKEN_CACHE_VERSION,
+                stat.st_mtime_ns,
+                stat.st_size,
+            ):
+                if self.memory is not None:
+                    self.memory[str(file)] = (stat.st_mtime_ns, stat.st_size, tokens)
+                return tokens
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass  # not cached, or a damaged cache file that will be replaced
+
+        tokens = tokenize_source(
+            code_source(file, notebook_cache), cells=is_notebook(file)
+        )
+        if self.memory is not None:
+            self.memory[str(file)] = (stat.st_mtime_ns, stat.st_size, tokens)
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with temp_file.open("wb") as fhandle:
+                pickle.dump(
+                    (
+                        config.TOKEN_CACHE_VERSION,
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                        tokens,
+                    ),
+                    fhandle,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(temp_file, cache_file)
+        except OSError:
+            pass  # the cache is an optimization, so searching continues
+        return tokens
+
+
+class TrigramIndex:
+    """Persistent index of the trigrams found in each searched file.
+
+    Each entry stores a file's mtime, size and line count, and a bitmask with
+    one bit set for the hash of each lowercase trigram in the file's
+    searchable text. A file only needs to be searched if every trigram of the
+    search text has its bit set. Entries are refreshed when a file's mtime or
+    size changes, so only new or changed files are re-read.
+    """
+
+    def __init__(self, index_file: Union[Path, str]) -> None:
+        """Constructor, loads the index from disk if it exists.
+
+        Args:
+            index_file: the file the index is stored in
+
+        Returns:
+            None
+        """
+        self.index_file: Path = Path(index_file)
+        self.entries: Dict[str, IndexEntry] = {}
+        # other data saved with the entries, for use by subclasses
+        self.metadata: dict = {}
+        self.changed: bool = False
+        self.visited: set = set()
+        # query bitmasks for each pattern are cached by patterns and bitmask size
+        self.query_masks: Dict[Tuple[Tuple[str, ...], int], List[int]] = {}
+
+        if self.index_file.is_file():
+            try:
+                with self.index_file.open("rb") as fhandle:
+                    version, entries, metadata = pickle.load(fhandle)
+                if version == config.INDEX_VERSION:
+                    self.entries = entries
+                    self.metadata = metadata
+            except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+                # A damaged index is rebuilt from scratch.
+                self.entries = {}
+                self.metadata = {}
+
+    def discard(self, file: Path) -> None:
+        """Removes a file's entry, if it has one.
+
+        Args:
+            file: the file, as a pathlib.Path
+
+        Returns:
+            None
+        """
+        if self.entries.pop(self.entry_key(file), None) is not None:
+            self.changed = True
+
+    def entry_key(self, file: Path) -> str:
+        """Gets the key of a file's index entry.
+
+        Args:
+            file: the file, as a pathlib.Path
+
+        Returns:
+            The file's resolved path, as a string.
+        """
+        return str(file.resolve())
+
+    def may_contain(
+        self, entry: IndexEntry, search_for: Union[str, List[str]]
+    ) -> bool:
+        """Determines whether an indexed file may contain the search text.
+
+        Args:
+            entry: the file's index entry, as returned by refresh()
+            search_for: the text to search for, or a list of patterns
+
+        Returns:
+            False if the file can't contain a match for any of the patterns,
+            else True.
+        """
+        bits, mask = entry[3], entry[4]
+        patterns: List[str] = pattern_list(search_for)
+        key = (tuple(patterns), bits)
+        if key not in self.query_masks:
+            self.query_masks[key] = [
+                trigram_mask(trigrams(pattern.lower()), bits) for pattern in patterns
+            ]
+        return any(
+            mask & query_mask == query_mask for query_mask in self.query_masks[key]
+        )
+
+    def refresh(self, file: Path) -> IndexEntry:
+        """Gets a file's index entry, re-indexing the file if it has changed.
+
+        Args:
+            file: the file, as a pathlib.Path
+
+        Returns:
+            The file's index entry, a (mtime, size, lines, bits, mask) tuple.
+        """
+        key = self.entry_key(file)
+        self.visited.add(key)
+        stat = file.stat()
+        entry: Optional[IndexEntry] = self.entries.get(key)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry
+
+        text: str
+        line_count: int
+        if is_notebook(file):
+            source_lines = [source_line for _, source_line in notebook_source(file)]
+            text = "".join(source_lines)
+            line_count = len(source_lines)
+        else:
+            data: bytes = file.read_bytes()
+            encoding: Optional[str] = file_encoding(data[: config.BINARY_CHECK_SIZE])
+            # binary files aren't searched, so they're indexed with no lines
+            # and no trigrams (see Search.skip_file)
+            text = "" if encoding is None else data.decode(encoding, "replace")
+            # count lines the same way search_file does, with lines split at
+            # newlines only (see numbered_lines)
+            line_count = text.count("\n") + (
+                1 if text and not text.endswith("\n") else 0
+            )
+        file_trigrams = trigrams(text.lower())
+        bits: int = max(
+            config.INDEX_MIN_BITS, 1 << (len(file_trigrams) * 8).bit_length()
+        )
+        entry = (
+            stat.st_mtime_ns,
+            stat.st_size,
+            line_count,
+            bits,
+            trigram_mask(file_trigrams, bits),
+        )
+        self.entries[key] = entry
+        self.changed = True
+        return entry
+
+    def save(self) -> None:
+        """Saves the index to disk, if it has changed.
+
+        Entries for files that weren't visited in this session and no longer
+        exist are dropped before saving.
+        """
+        for key in [key for key in self.entries if key not in self.visited]:
+            if not os.path.isfile(key):
+                del self.entries[key]
+                self.changed = True
+        if not self.changed:
+            return
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        # the temp file is per process, so that a watcher and a search that
+        # save the same index at once don't write to the same file
+        temp_file = self.index_file.with_suffix(f".{os.getpid()}.tmp")
+        with temp_file.open("wb") as fhandle:
+            pickle.dump((config.INDEX_VERSION, self.entries, self.metadata), fhandle)
+        os.replace(temp_file, self.index_file)
+        self.changed = False
+
+
+class VersionedIndex(TrigramIndex):
+    """Trigram index for a tree that only changes when Python or a package is
+    installed or upgraded, such as the standard library or site-packages.
+
+    The index is only used with the Python version and tree it was built for,
+    and each file in the tree is owned by a distribution, identified by the
+    name and version in its dist-info (or egg-info) folder name. Entries for
+    files owned by a distribution that hasn't changed since the index was
+    saved are used without checking the file's mtime and size, so an
+    unchanged tree is searched without a stat() call for each file. The files
+    of added or changed distributions, and files that no distribution owns,
+    are checked and re-indexed as in TrigramIndex.
+    """
+
+    def __init__(
+        self, index_file: Union[Path, str], root: Union[Path, str], packages: bool
+    ) -> None:
+        """Constructor, loads the index and finds the changed distributions.
+
+        Args:
+            index_file: the file the index is stored in
+            root: the root folder of the tree
+            packages: whether root is a site-packages folder, which contains
+                the installed distributions. Otherwise every file in the tree
+                is owned by the Python installation.
+
+        Returns:
+            None
+        """
+        super().__init__(index_file)
+        self.root: Path = Path(root)
+        scope: Tuple[str, str] = (sys.version, str(self.root))
+        if self.metadata.get("scope") != scope:
+            self.entries = {}
+            self.metadata = {"scope": scope, "distributions": {}, "owners": {}}
+            self.changed = True
+
+        previous: Dict[str, int] = self.metadata["distributions"]
+        current: Dict[str, int] = (
+            installed_distributions(self.root) if packages else {sys.version: 0}
+        )
+        self.default_owner: Optional[str] = None if packages else sys.version
+        self.unchanged: set = {
+            name for name, stamp in current.items() if previous.get(name) == stamp
+        }
+        # owners of files, by entry key, from the distributions' file lists
+        owners: Dict[str, str] = {
+            key: owner
+            for key, owner in self.metadata["owners"].items()
+            if owner in self.unchanged
+        }
+        for name in current:
+            if packages and name not in self.unchanged:
+                for file in distribution_files(self.root.joinpath(name)):
+                    owners[os.fspath(file)] = name
+        if current != previous:
+            self.metadata["distributions"] = current
+            self.metadata["owners"] = owners
+            self.changed = True
+
+    def entry_key(self, file: Path) -> str:
+        """Gets the key of a file's index entry.
+
+        Args:
+            file: the file, as a pathlib.Path below self.root
+
+        Returns:
+            The file's path, as a string. The tree is walked from the same
+            root each time, so paths don't need to be resolved.
+        """
+        return str(file)
+
+    def refresh(self, file: Path) -> IndexEntry:
+        """Gets a file's index entry, re-indexing the file if it may have
+        changed.
+
+        Args:
+            file: the file, as a pathlib.Path below self.root
+
+        Returns:
+            The file's index entry, a (mtime, size, lines, bits, mask) tuple.
+        """
+        key: str = self.entry_key(file)
+        entry: Optional[IndexEntry] = self.entries.get(key)
+        if (
+            entry is not None
+            and self.metadata["owners"].get(key, self.default_owner) in self.unchanged
+        ):
+            self.visited.add(key)
+            return entry
+        return super().refresh(file)
+
+
+class Watcher:
+    """Keeps the trigram index and notebook cache up to date as files change.
+
+    On Linux, changes are reported by inotify, which is called through
+    ctypes so that no extra packages are needed. Files are updated when
+    they're closed after writing, moved, created or deleted, and not on each
+    write, so a file isn't re-read while it's still being written. Elsewhere,
+    or if inotify isn't available or its limit on watched folders is reached,
+    the folders are polled every config.WATCH_POLL_INTERVAL seconds. Polling
+    only lists folders whose mtime has changed, but checks every file with
+    stat(). Folders that the Search skips, such as config.SKIPPED_FOLDERS,
+    aren't watched.
+    """
+
+    def __init__(self, searcher: Search, folders: Iterable[str]) -> None:
+        """Constructor
+
+        Args:
+            searcher: the Search whose index and notebook_cache are kept up to
+                date. Its file types and skipped folders select the files that
+                are watched.
+            folders: the folders to watch, including all of their subfolders
+
+        Returns:
+            None
+        """
+        self.searcher: Search = searcher
+        if searcher.folder_cache is None:
+            searcher.folder_cache = {}
+        self.folders: List[str] = [os.path.realpath(folder) for folder in folders]
+        self.file_types: set = set(searcher.file_types)
+        # (mtime, size) of each watched file, by path
+        self.files: Dict[str, Tuple[int, int]] = {}
+        # watched folders, by inotify watch descriptor
+        self.watches: Dict[int, str] = {}
+        self.libc: Optional[ctypes.CDLL] = None
+        self.inotify_fd: int = -1
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                self.inotify_fd = libc.inotify_init1(os.O_CLOEXEC)
+                self.libc = libc
+            except (OSError, AttributeError):
+                self.inotify_fd = -1
+
+    def add_watch(self, folder: str) -> None:
+        """Adds an inotify watch for a folder, or switches to polling if the
+        watch can't be added.
+
+        Args:
+            folder: path of the folder
+
+        Returns:
+            None
+        """
+        if self.libc is None or self.inotify_fd < 0:
+            return
+        mask: int = (
+            IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        )
+        watch: int = self.libc.inotify_add_watch(
+            self.inotify_fd, os.fsencode(folder), mask
+        )
+        if watch < 0:
+            self.close()  # e.g., the limit on the number of watches was reached
+        else:
+            self.watches[watch] = folder
+
+    def close(self) -> None:
+        """Stops using inotify, so that the folders are polled instead.
+        """
+        if self.inotify_fd >= 0:
+            os.close(self.inotify_fd)
+        self.inotify_fd = -1
+        self.watches.clear()
+
+    def forget(self, folder: str) -> None:
+        """Handles a folder that was deleted or moved away.
+
+        Args:
+            folder: path of the folder
+
+        Returns:
+            None
+        """
+        prefix: str = folder + os.sep
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            self.update(path)
+        for watch, watched in list(self.watches.items()):
+            if watched == folder or watched.startswith(prefix):
+                if self.libc is not None:
+                    self.libc.inotify_rm_watch(self.inotify_fd, watch)
+                del self.watches[watch]
+
+    def handle_events(self, data: bytes) -> None:
+        """Handles the events read from inotify.
+
+        Args:
+            data: the events, as read from the inotify file descriptor
+
+        Returns:
+            None
+        """
+        offset: int = 0
+        while offset < len(data):
+            watch, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name: str = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.poll()  # events were lost
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(watch, None)
+                continue
+            folder: Optional[str] = self.watches.get(watch)
+            if folder is None or not name:
+                continue
+            path: str = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if not self.searcher.skip_folder(name, path):
+                        self.scan(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.forget(path)
+            elif os.path.splitext(name)[1].lower() in self.file_types:
+                self.update(path)
+
+    def poll(self) -> None:
+        """Checks all of the watched folders and files for changes.
+        """
+        seen: set = set()
+        for folder in self.folders:
+            self.scan(folder, seen)
+        for path in [path for path in self.files if path not in seen]:
+            self.update(path)
+
+    def scan(self, folder: str, seen: Optional[set] = None) -> None:
+        """Checks a folder and its subfolders for changed files, and watches
+        them with inotify if it's in use.
+
+        Args:
+            folder: path of the folder
+            seen: a set that the path of each file found is added to
+
+        Returns:
+            None
+        """
+        folders: List[str] = [folder]
+        while folders:
+            current_folder: str = folders.pop()
+            self.add_watch(current_folder)
+            try:
+                entry_list: List[os.DirEntry] = self.searcher.list_folder(
+                    current_folder
+                )
+            except OSError:
+                continue
+            for entry in entry_list:
+                try:
+                    is_dir: bool = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not entry.is_symlink() and not self.searcher.skip_folder(
+                        entry.name, entry.path
+                    ):
+                        folders.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in self.file_types:
+                    if seen is not None:
+                        seen.add(entry.path)
+                    self.update(entry.path)
+
+    def update(self, path: str) -> None:
+        """Updates the index entry and cached notebook source for a file that
+        may have changed, been created or been deleted.
+
+        Args:
+            path: path of the file
+
+        Returns:
+            None
+        """
+        file: Path = Path(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            if self.searcher.index is not None:
+                self.searcher.index.discard(file)
+            if self.searcher.notebook_cache is not None and is_notebook(file):
+                self.searcher.notebook_cache.discard(file)
+            return
+        signature: Tuple[int, int] = (stat.st_mtime_ns, stat.st_size)
+        if self.files.get(path) == signature:
+            return
+        self.files[path] = signature
+        try:
+            if self.searcher.index is not None:
+                self.searcher.index.refresh(file)
+            if self.searcher.notebook_cache is not None and is_notebook(file):
+                self.searcher.notebook_cache.source(file)
+        except (OSError, ValueError):
+            pass  # e.g., deleted or only partly written; there'll be another event
+
+    def watch(self, duration: Optional[float] = None) -> None:
+        """Scans the folders, then keeps the index and cache up to date until
+        interrupted.
+
+        Args:
+            duration: the number of seconds to watch for, or None to watch
+                until interrupted
+
+        Returns:
+            None
+
+        The index is saved after each batch of changes.
+        """
+        end: Optional[float] = None if duration is None else time.monotonic() + duration
+        self.poll()
+        while True:
+            if self.searcher.index is not None:
+                self.searcher.index.save()
+            timeout: float = config.WATCH_POLL_INTERVAL
+            if end is not None:
+                timeout = min(timeout, end - time.monotonic())
+                if timeout <= 0:
+                    return
+            if self.inotify_fd >= 0:
+                ready, _, _ = select.select([self.inotify_fd], [], [], timeout)
+                if ready:
+                    self.handle_events(os.read(self.inotify_fd, 65536))
+            else:
+                time.sleep(timeout)
+                self.poll()
+
+
+def code_source(
+    file: Path, notebook_cache: Optional[NotebookCache] = None
+) -> List[Tuple[int, str]]:
+    """Reads the source code lines of a Python file or notebook.
+
+    Args:
+        file: the Python file or notebook, as a pathlib.Path
+        notebook_cache: the cache to read notebook source code from, if any
+
+    Returns:
+        A list of (position, source line) tuples, where position is the line
+        number, or the cell number for notebooks. Python files are decoded
+        with the encoding from file_encoding().
+    """
+    if is_notebook(file):
+        if notebook_cache is not None:
+            return notebook_cache.source(file)
+        return list(notebook_source(file))
+    data: bytes = file.read_bytes()
+    encoding: str = file_encoding(data[: config.BINARY_CHECK_SIZE]) or "utf-8"
+    text: str = data.decode(encoding, "replace")
+    return list(enumerate(io.StringIO(text, newline=None), 1))
+
+
+def code_tokens(text: str) -> Iterator[Tuple[str, int, int, int]]:
+    """Splits Python source code into the tokens that --code searches match.
+
+    Args:
+        text: the source code
+
+    Returns:
+        A generator that yields a (token, row, start, end) tuple for each
+        name, operator and number, and a "\\n" token at the end of each
+        statement, so that a pattern can't match across statements. Comments
+        and strings are skipped. If text can't be tokenized completely, such
+        as a pattern with unclosed brackets, the tokens before the error are
+        yielded.
+    """
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            if token.type in CODE_TOKEN_TYPES:
+                yield (token.string, token.start[0], token.start[1], token.end[1])
+            elif token.type == tokenize.NEWLINE:
+                yield ("\n", token.start[0], token.start[1], token.start[1])
+    except (tokenize.TokenError, SyntaxError):
+        pass
+
+
+def compile_matcher(
+    search_for: Union[str, List[str]],
+    case_sensitive: bool = False,
+    encoding: Optional[str] = None,
+) -> Optional[Pattern[bytes]]:
+    """Compiles a bytes matcher, which searches a file's raw bytes.
+
+    Args:
+        search_for: the text to search for, or a list of patterns
+        case_sensitive: whether matching is case-sensitive
+        encoding: the encoding of the files to be searched. Default: the
+            locale's preferred encoding.
+
+    Returns:
+        A compiled bytes regular expression, or None if the search text can't
+        be matched as raw bytes. Bytes matching only folds ASCII case, so it's
+        used only for ASCII search text and an ASCII-compatible file encoding.
+    """
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    elif encoding == "utf-8-sig":
+        encoding = "utf-8"  # the byte order mark is only at the start of a file
+    patterns: List[str] = pattern_list(search_for)
+    if not all(pattern.isascii() for pattern in patterns) or (
+        "\n".encode(encoding) != b"\n"
+    ):
+        return None
+    flags: int = 0 if case_sensitive else re.IGNORECASE
+    if len(patterns) == 1:
+        return re.compile(re.escape(patterns[0].encode(encoding)), flags)
+    return re.compile(pattern_regex(patterns).encode(encoding), flags)
+
+
+def count_newlines(data: mmap.mmap, start: int, end: int) -> int:
+    """Counts the newline bytes in part of a memory-mapped file.
+
+    Args:
+        data: the memory-mapped file
+        start: offset of the first byte to be counted
+        end: offset after the last byte to be counted
+
+    Returns:
+        The number of newline bytes. The range is counted in fixed-size
+        chunks, so that large files aren't copied into memory all at once.
+    """
+    count: int = 0
+    for chunk_start in range(start, end, config.MMAP_CHUNK_SIZE):
+        chunk_end = min(chunk_start + config.MMAP_CHUNK_SIZE, end)
+        count += data[chunk_start:chunk_end].count(b"\n")
+    return count
+
+
+def distribution_files(info_folder: Path) -> List[Path]:
+    """Lists the files installed by a distribution.
+
+    Args:
+        info_folder: the distribution's dist-info or egg-info folder
+
+    Returns:
+        The paths of the files listed in the folder's RECORD (or, for
+        egg-info, installed-files.txt) file, not including compiled .pyc
+        files. The list is empty if there's no such file.
+    """
+    record_file: Path = info_folder.joinpath("RECORD")
+    relative_to: Path = info_folder.parent
+    if not record_file.is_file():
+        record_file = info_folder.joinpath("installed-files.txt")
+        relative_to = info_folder
+    try:
+        with record_file.open(newline="", errors="replace") as fhandle:
+            rows: List[List[str]] = list(csv.reader(fhandle))
+    except OSError:
+        return []
+    return [
+        Path(os.path.normpath(relative_to.joinpath(row[0])))
+        for row in rows
+        if row and not row[0].endswith(".pyc")
+    ]
+
+
+def file_encoding(head: bytes) -> Optional[str]:
+    """Detects a file's encoding from its first block of bytes.
+
+    Args:
+        head: the first bytes of the file, up to config.BINARY_CHECK_SIZE
+
+    Returns:
+        The encoding from the file's byte order mark, or from a PEP 263
+        coding declaration in its first two lines, else "utf-8". Returns None
+        for a binary file, which is detected by a NUL byte in head.
+    """
+    bom: bytes
+    encoding: str
+    for bom, encoding in UNICODE_BOMS:
+        if head.startswith(bom):
+            return encoding
+    if b"\0" in head:
+        return None
+    lines: Iterator[bytes] = iter(head.splitlines(keepends=True)[:2])
+    try:
+        encoding, _ = tokenize.detect_encoding(lambda: next(lines, b""))
+    except SyntaxError:
+        return "utf-8"  # an unknown encoding in the coding declaration
+    return encoding
+
+
+def finish_profile(
+    profiler: Optional[cProfile.Profile], filename: Optional[str]
+) -> None:
+    """Stops profiling and saves the profile statistics.
+
+    Args:
+        profiler: the profiler, or None if the search wasn't profiled
+        filename: the file to save the statistics in, which can be viewed
+            with the pstats module or tools such as snakeviz
+
+    Returns:
+        None
+    """
+    if profiler is None or not filename:
+        return
+    profiler.disable()
+    profiler.dump_stats(filename)
+
+
+def get_console_width() -> int:
+    """Gets the current width of the console screen in characters.
+
+    Args:
+        None
+
+    Returns:
+        Current screen width in characters.
+    """
+    full_width, _ = shutil.get_terminal_size((80, 20))
+    return full_width - 1
+
+
+def gitignore_rule(line: str) -> Optional[Tuple[Pattern[str], bool, bool]]:
+    """Compiles a line of a .gitignore file.
+
+    Args:
+        line: the line
+
+    Returns:
+        A (regex, negated, directories only) tuple, or None for blank lines
+        and comments. The regex matches paths relative to the folder that
+        contains the .gitignore file, using / as the separator.
+    """
+    pattern: str = line.rstrip("\n").rstrip("\r")
+    # trailing spaces are ignored unless they're escaped with a backslash
+    while pattern.endswith(" ") and not pattern.endswith("\\ "):
+        pattern = pattern[:-1]
+    if not pattern or pattern.startswith("#"):
+        return None
+
+    negated: bool = pattern.startswith("!")
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith(("\\!", "\\#")):
+        pattern = pattern[1:]
+
+    dir_only: bool = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    if not pattern:
+        return None
+    # patterns with a slash (other than a trailing one) are relative to the
+    # .gitignore folder, others match a name at any level below it
+    anchored: bool = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    regex: List[str] = []
+    pos: int = 0
+    while pos < len(pattern):
+        if pattern.startswith("**/", pos):
+            regex.append("(?:.*/)?")
+            pos += 3
+        elif pattern.startswith("**", pos):
+            regex.append(".*")
+            pos += 2
+        elif pattern[pos] == "*":
+            regex.append("[^/]*")
+            pos += 1
+        elif pattern[pos] == "?":
+            regex.append("[^/]")
+            pos += 1
+        elif pattern[pos] == "[" and "]" in pattern[pos + 2 :]:
+            end: int = pattern.index("]", pos + 2)
+            chars: str = pattern[pos + 1 : end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[" + chars.replace("\\", "\\\\") + "]")
+            pos = end + 1
+        elif pattern[pos] == "\\" and pos + 1 < len(pattern):
+            regex.append(re.escape(pattern[pos + 1]))
+            pos += 2
+        else:
+            regex.append(re.escape(pattern[pos]))
+            pos += 1
+
+    prefix: str = "" if anchored else "(?:.*/)?"
+    return (re.compile(f"(?:{prefix}{''.join(regex)})$"), negated, dir_only)
+
+
+def highlight_match(
+    match_line: str,
+    match_text: str,
+    max_chars: int,
+    span: Optional[Tuple[int, int]] = None,
+) -> List[Tuple]:
+    """Converts a match to a set of color-highlighted strings to be printed to
+    the console.
+
+    Args:
+        match_line: the line of text where a match was found
+        match_text: the text to be highlighted (i.e., what was searched for)
+        max_chars: the maximum total number of characters to be returned
+        span: the (start, end) offsets of the matched text in match_line, if
+            they're known. If not provided, the first case-insensitive
+            occurrence of match_text is highlighted.
+
+    Returns:
+        A list of (text, color) tuples for printing with click.echo/click.style.
+
+    Note that we only highlight the first match if there are multiple matches
+    in a single line.
+    """
+    match_start: int
+    match_end: int
+    if span is None:
+        match_start = match_line.lower().find(match_text.lower())
+        match_end = match_start + len(match_text)
+    else:
+        match_start, match_end = span
+
+    # substring_start = the start of the portion of the line that will be
+    # printed to the console
+    substring_start: int
+    if match_end <= max_chars:
+        # The match is in the first max_chars of the line.
+        substring_start = 0
+    elif match_start >= len(match_line) - max_chars:
+        # The match is in the last max_chars of the line.
+        substring_start = len(match_line) - max_chars
+    else:
+        # This is a very long line relative to the console, and we need to find
+        # a max_chars long substring in the middle of it that contains the
+        # matched text. We'll try to position the match in the center of this
+        # substring.
+        # center = the position of the center of the substring
+        center: int = (match_start + match_end) // 2
+        substring_start = max(0, center - max_chars // 2)
+    toprint: str = match_line[substring_start : substring_start + max_chars]
+
+    # Now we break toprint into colored sections. The matched search text will
+    # be config.COLOR_MATCH_TEXT, the rest of the line is config.COLOR_MATCH_LINE.
+    sections: List[Tuple] = []
+    match_position: int = match_start - substring_start
+    match_length: int = match_end - match_start
+    if match_position > 0:
+        sections.append((toprint[:match_position], config.COLOR_MATCH_LINE))
+    sections.append(
+        (
+            toprint[match_position : match_position + match_length],
+            config.COLOR_MATCH_TEXT,
+        )
+    )
+    if match_position < len(toprint) - match_length:
+        sections.append(
+            (toprint[match_position + match_length :], config.COLOR_MATCH_LINE)
+        )
+    return sections
+
+
+def installed_distributions(folder: Path) -> Dict[str, int]:
+    """Finds the distributions installed in a site-packages folder.
+
+    Args:
+        folder: the site-packages folder
+
+    Returns:
+        A dictionary mapping the name of each dist-info or egg-info folder,
+        which contains the distribution's name and version, to the mtime of
+        the folder's list of installed files. Reinstalling or upgrading a
+        distribution changes one or the other.
+    """
+    distributions: Dict[str, int] = {}
+    try:
+        entries: List[os.DirEntry] = list(os.scandir(folder))
+    except OSError:
+        return distributions
+    for entry in entries:
+        if not entry.name.endswith((".dist-info", ".egg-info")):
+            continue
+        stamp: int = 0
+        for file_list in ["RECORD", "installed-files.txt", "PKG-INFO"]:
+            try:
+                stamp = os.stat(os.path.join(entry.path, file_list)).st_mtime_ns
+                break
+            except OSError:
+                continue
+        distributions[entry.name] = stamp
+    return distributions
+
+
+def is_archive(file: Union[Path, str]) -> bool:
+    """Determines whether a file is an archive that pyfind can search.
+
+    Args:
+        file: the file's name or path
+
+    Returns:
+        True if the file name ends with one of config.ARCHIVE_TYPES.
+    """
+    return str(file).lower().endswith(tuple(config.ARCHIVE_TYPES))
+
+
+def is_ignored(rules: Iterable[GitIgnore], path: str, is_dir: bool) -> bool:
+    """Determines whether a path is ignored by a set of .gitignore files.
+
+    Args:
+        rules: the compiled .gitignore files that apply to the path, from the
+            top folder down
+        path: the path of the file or folder
+        is_dir: whether path is a folder
+
+    Returns:
+        True if the path is ignored, else False. Rules in deeper .gitignore
+        files take precedence over rules in the folders above them.
+    """
+    for gitignore in reversed(rules):
+        ignored = gitignore.match(path, is_dir)
+        if ignored is not None:
+            return ignored
+    return False
+
+
+def is_notebook(file: Union[Path, str]) -> bool:
+    """Determines whether a file is a notebook file or not.
+
+    Args:
+        file: the file, as either a pathlib.Path object or a filename string.
+
+    Returns:
+        True if notebook file, else False.
+    """
+    if isinstance(file, str):
+        return Path(file).suffix.lower() == ".ipynb"
+    return file.suffix.lower() == ".ipynb"
+
+
+def iter_archive_matches(
+    archive: Path,
+    text_matcher: TextMatcher,
+    member_types: Iterable[str],
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    context: Tuple[int, int] = (0, 0),
+    archive_cache: Optional[Dict[str, ArchiveContents]] = None,
+) -> Generator[Match, None, Tuple[int, int]]:
+    """Searches the members of a .whl, .egg, .zip or .tar.gz archive.
+
+    Args:
+        archive: the archive, as a pathlib.Path
+        text_matcher: the TextMatcher to search with
+        member_types: the file types of the members to be searched, with
+            preceding period on each (e.g., [".py", ".ipynb"])
+        max_count: stop searching each member after this many matches
+        stop: a function that's called after each match and before each
+            member, to stop searching the archive if it returns True
+        context: the number of (before, after) context lines to include with
+            each match
+        archive_cache: archive tables of contents, by path, which are added
+            to and kept up to date. An archive without any members to be
+            searched isn't opened, and a .tar.gz archive is only decompressed
+            up to its last member to be searched.
+
+    Returns:
+        A generator that yields each match found, as a Match object with an
+        "archive!member" path, and returns a (lines searched, bytes searched)
+        tuple when it's done, where bytes are uncompressed. Damaged archives
+        are searched up to the damage.
+
+    Members are decompressed one at a time, as a stream, and searched like
+    files (see iter_member_matches), without extracting them to disk.
+    """
+    stat = archive.stat()
+    types: set = set(member_types)
+    contents: Optional[ArchiveContents] = (
+        archive_cache.get(str(archive)) if archive_cache is not None else None
+    )
+    if contents is not None and contents[:2] != (stat.st_mtime_ns, stat.st_size):
+        contents = None
+    # the members to be searched, if the table of contents is known
+    wanted: Optional[set] = None
+    if contents is not None:
+        wanted = {
+            name
+            for name, _ in contents[2]
+            if os.path.splitext(name)[1].lower() in types
+        }
+        if not wanted:
+            return (0, 0)
+
+    line_count: int = 0
+    byte_count: int = 0
+    members: List[Tuple[str, int]] = []
+    totals: Tuple[int, int]
+    try:
+        if archive.name.lower().endswith((".tar.gz", ".tgz")):
+            # stream mode reads the archive once, from start to finish
+            with tarfile.open(archive, "r|*") as tar_file:
+                for info in tar_file:
+                    if stop is not None and stop():
+                        return (line_count, byte_count)
+                    if not info.isfile():
+                        continue
+                    members.append((info.name, info.size))
+                    if os.path.splitext(info.name)[1].lower() not in types:
+                        continue
+                    tar_member = tar_file.extractfile(info)
+                    if tar_member is None:
+                        continue
+                    with tar_member:
+                        totals = yield from iter_member_matches(
+                            Path(f"{archive}!{info.name}"),
+                            tar_member,
+                            text_matcher,
+                            max_count,
+                            stop,
+                            context,
+                        )
+                    line_count += totals[0]
+                    byte_count += totals[1]
+                    if stop is not None and stop():
+                        return (line_count, byte_count)
+                    if wanted is not None:
+                        wanted.discard(info.name)
+                        if not wanted:
+                            return (line_count, byte_count)
+        else:
+            with zipfile.ZipFile(archive) as zip_file:
+                for zip_info in zip_file.infolist():
+                    if zip_info.is_dir():
+                        continue
+                    members.append((zip_info.filename, zip_info.file_size))
+                for name, _ in members:
+                    if os.path.splitext(name)[1].lower() not in types:
+                        continue
+                    if stop is not None and stop():
+                        return (line_count, byte_count)
+                    with zip_file.open(name) as zip_member:
+                        totals = yield from iter_member_matches(
+                            Path(f"{archive}!{name}"),
+                            zip_member,
+                            text_matcher,
+                            max_count,
+                            stop,
+                            context,
+                        )
+                    line_count += totals[0]
+                    byte_count += totals[1]
+                    if stop is not None and stop():
+                        return (line_count, byte_count)
+    except (OSError, EOFError, zlib.error, zipfile.BadZipFile, tarfile.TarError):
+        return (line_count, byte_count)  # a damaged archive isn't cached
+
+    if archive_cache is not None:
+        archive_cache[str(archive)] = (stat.st_mtime_ns, stat.st_size, members)
+    return (line_count, byte_count)
+
+
+def iter_block_matches(
+    file_path: Path,
+    binary_file: IO[bytes],
+    head: bytes,
+    matcher: Pattern[bytes],
+    text_matcher: TextMatcher,
+    encoding: str,
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    offsets: bool = True,
+    stats: Optional[SearchStats] = None,
+) -> Generator[Match, None, Tuple[int, int]]:
+    """Searches a file's raw bytes, reading it a block at a time.
+
+    Args:
+        file_path: the file being searched, as a pathlib.Path
+        binary_file: the file, opened in binary mode and positioned after head
+        head: the bytes that have already been read from the start of the file
+        matcher: the bytes matcher from TextMatcher.bytes_matcher(), which
+            finds the lines that may contain a match
+        text_matcher: the TextMatcher that finds the patterns in those lines,
+            after they're decoded
+        encoding: the file's encoding, from file_encoding()
+        max_count: stop after this many matches
+        stop: stop after a match or a block if this function returns True
+        offsets: whether the matches record the byte offset of their line,
+            so that their text can be read again from file_path (see
+            Match.compact)
+        stats: the SearchStats to record phase timings in, if any. Reading
+            each block is timed as "read", and searching it, including
+            decoding the matched lines, as "match".
+
+    Returns:
+        A generator that yields each match found, as a Match object, and
+        returns a (lines searched, bytes searched) tuple when it's done. If the
+        search stops early, the totals are for the blocks that were read.
+
+    Each block is searched up to its last newline, and the rest is carried
+    over to the next block, so lines are never split. Line numbers are only
+    calculated for hits, and only the lines that the bytes matcher finds are
+    decoded. As in the text engine, a carriage return that isn't followed by a
+    newline doesn't start a new line.
+    """
+    # lowercasing each block and searching it case-sensitively is much faster
+    # than searching it ignoring case. The bytes matcher is only built from
+    # escaped text, so lowercasing its pattern doesn't change any escapes.
+    fold: bool = bool(matcher.flags & re.IGNORECASE)
+    if fold:
+        matcher = re.compile(matcher.pattern.lower(), matcher.flags & ~re.IGNORECASE)
+    lineno: int = 1  # line number of the first line in data
+    data_start: int = 0  # offset of data in the file
+    found: int = 0
+    bytes_read: int = len(head)
+    block: bytes = head
+    carry: bytes = b""
+    data: bytes
+    text: str
+    span: Tuple[int, int]
+    while True:
+        if block:
+            cut: int = block.rfind(b"\n") + 1
+            if not cut:
+                # the line continues in the next block
+                carry += block
+                block = read_block(binary_file, stats)
+                bytes_read += len(block)
+                continue
+            data, carry = carry + block[:cut], block[cut:]
+        else:
+            data = carry  # the final line, if it has no newline
+
+        counted_to: int = 0  # newlines have been counted up to this offset
+        searched: bytes = data.lower() if fold else data
+        hit = matcher.search(searched)
+        while hit:
+            line_start: int = data.rfind(b"\n", 0, hit.start()) + 1
+            line_end: int = data.find(b"\n", hit.start())
+            if line_end == -1:
+                line_end = len(data)
+            lineno += data.count(b"\n", counted_to, line_start)
+            counted_to = line_start
+            line: str = data[line_start:line_end].decode(encoding, "replace")
+            if line.endswith("\r"):
+                line = line[:-1]  # a CRLF line ending, as in numbered_lines
+            for pattern, start, end in text_matcher.find(line):
+                found += 1
+                text, span = strip_match(line, start, end)
+                yield Match(
+                    file_path,
+                    text,
+                    lineno,
+                    pattern,
+                    span,
+                    offset=data_start + line_start if offsets else None,
+                    encoding=encoding,
+                )
+                if found == max_count or (stop is not None and stop()):
+                    return (lineno, bytes_read)
+            # only one match per line, so resume the search on the next line
+            hit = matcher.search(searched, line_end + 1)
+        lineno += data.count(b"\n", counted_to)
+        data_start += len(data)
+
+        if not block:
+            # lineno is the number of the line after the last newline
+            return (lineno if data else lineno - 1, bytes_read)
+        if stop is not None and stop():
+            return (lineno - 1, bytes_read)
+        block = read_block(binary_file, stats)
+        bytes_read += len(block)
+
+
+def iter_bytes_matches(
+    file_path: Path,
+    search_for: Union[str, List[str]],
+    matcher: Pattern[bytes],
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    text_matcher: Optional[TextMatcher] = None,
+    encoding: Optional[str] = None,
+) -> Generator[Match, None, Optional[Tuple[int, int]]]:
+    """Searches a file's raw bytes through a memory map.
+
+    Args:
+        file_path: the file to be searched, as a pathlib.Path
+        search_for: the text to search for, or a list of patterns
+        matcher: the compiled bytes matcher from compile_matcher()
+        max_count: stop after this many matches
+        stop: a function that's called after each match, and after every
+            config.MMAP_CHUNK_SIZE bytes that are scanned, to stop the search
+            if it returns True
+        text_matcher: the TextMatcher for search_for, which finds the
+            patterns in each matched line. If not provided, it's compiled for
+            this file.
+        encoding: the file's encoding, which the matched lines are decoded
+            with. Default: the locale's preferred encoding.
+
+    Returns:
+        A generator that yields each match found, as a Match object, and
+        returns the number of lines and bytes searched. If the file contains
+        carriage returns, it returns None without searching the file, and
+        the file is searched by the text engine instead.
+
+    Line numbers are only calculated for hits, by counting the newlines since
+    the previous hit, and only the matched lines are decoded. The file is
+    searched in chunks of about config.MMAP_CHUNK_SIZE bytes, extended to the
+    end of a line, so that a search with no matches can still be stopped.
+    """
+    byte_count: int = file_path.stat().st_size
+    if byte_count == 0:
+        return (0, 0)
+
+    if text_matcher is None:
+        text_matcher = TextMatcher(search_for)
+    text: str
+    span: Tuple[int, int]
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    with file_path.open("rb") as fhandle, mmap.mmap(
+        fhandle.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        for chunk_start in range(0, byte_count, config.MMAP_CHUNK_SIZE):
+            if stop is not None and stop():
+                return (0, 0)
+            chunk_end: int = chunk_start + config.MMAP_CHUNK_SIZE
+            if data.find(b"\r", chunk_start, chunk_end) != -1:
+                return None
+
+        lineno: int = 1
+        counted_to: int = 0  # newlines have been counted up to this offset
+        found: int = 0
+        window_start: int = 0
+        while window_start < byte_count:
+            # each window ends at a newline, so lines are never split
+            window_end: int = (
+                data.find(b"\n", window_start + config.MMAP_CHUNK_SIZE) + 1
+                or byte_count
+            )
+            hit = matcher.search(data, window_start, window_end)
+            while hit:
+                line_start: int = data.rfind(b"\n", 0, hit.start()) + 1
+                line_end: int = data.find(b"\n", hit.start())
+                if line_end == -1:
+                    line_end = byte_count
+                lineno += count_newlines(data, counted_to, line_start)
+                counted_to = line_start
+                line: str = data[line_start:line_end].decode(encoding, "replace")
+                for pattern, start, end in text_matcher.find(line):
+                    found += 1
+                    text, span = strip_match(line, start, end)
+                    yield Match(
+                        file_path,
+                        text,
+                        lineno,
+                        pattern,
+                        span,
+                        offset=line_start,
+                        encoding=encoding,
+                    )
+                    if found == max_count or (stop is not None and stop()):
+                        # the file has been read through the end of the line
+                        return (lineno, min(line_end + 1, byte_count))
+                # only one match per line, so resume the search on the next line
+                hit = matcher.search(data, line_end + 1, window_end)
+            window_start = window_end
+            if window_start < byte_count and stop is not None and stop():
+                # the windows searched so far end with a complete line
+                lineno += count_newlines(data, counted_to, window_start)
+                return (lineno - 1, window_start)
+
+        line_count: int = count_newlines(data, 0, byte_count)
+        if data[byte_count - 1] != ord("\n"):
+            line_count += 1  # final line has no newline
+    return (line_count, byte_count)
+
+
+def iter_code_matches(
+    file_path: Path,
+    text_matcher: TextMatcher,
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    notebook_cache: Optional[NotebookCache] = None,
+    token_cache: Optional[TokenCache] = None,
+    source: Optional[List[Tuple[int, str]]] = None,
+) -> Generator[Match, None, Tuple[int, int]]:
+    """Searches a Python file or notebook for sequences of code tokens.
+
+    Args:
+        file_path: the Python file or notebook, as a pathlib.Path
+        text_matcher: a TextMatcher in code mode
+        max_count: stop after this many matches
+        stop: a function that's called after each match, to stop searching
+            the file if it returns True
+        notebook_cache: the cache to read notebook source code from, if any
+        token_cache: the cache to read the file's tokens from, if any
+        source: the file's source lines, as returned by code_source(), if
+            they've already been read. They're tokenized without the cache,
+            and the bytes searched are their length.
+
+    Returns:
+        A generator that yields a Match for the first match of each pattern
+        on each line, in order, and returns a (lines searched, bytes searched)
+        tuple when it's done. The tokens are searched as a single string, and
+        the file's source lines are only read if there's a match.
+    """
+    code: str
+    starts: array
+    places: array
+    line_count: int
+    byte_count: int
+    if source is not None:
+        code, starts, places, line_count = tokenize_source(
+            source, cells=is_notebook(file_path)
+        )
+        byte_count = sum(len(line) for _, line in source)
+    else:
+        code, starts, places, line_count = (
+            token_cache.tokens(file_path, notebook_cache)
+            if token_cache is not None
+            else tokenize_source(
+                code_source(file_path, notebook_cache), cells=is_notebook(file_path)
+            )
+        )
+        byte_count = file_path.stat().st_size
+    haystack: str = f" {code} "
+    if text_matcher.fold:
+        haystack = haystack.lower()
+
+    # (index of first token, index of last token, pattern order) of each match
+    hits: List[Tuple[int, int, int]] = []
+    order: int
+    needle: str
+    count: int
+    for order, (_, needle, count) in enumerate(text_matcher.code_patterns or []):
+        # the match starts at the space before its first token, which is at
+        # the token's offset in code
+        offset: int = haystack.find(needle)
+        while offset != -1:
+            first: int = bisect_left(starts, offset)
+            hits.append((first, first + count - 1, order))
+            offset = haystack.find(needle, offset + 1)
+    if not hits:
+        return (line_count, byte_count)
+
+    hits.sort()
+    if source is None:
+        source = code_source(file_path, notebook_cache)
+    reported: set = set()
+    found: int = 0
+    last: int
+    for first, last, order in hits:
+        line_index, start, end = places[3 * first : 3 * first + 3]
+        if (line_index, order) in reported or line_index >= len(source):
+            continue
+        reported.add((line_index, order))
+        position, line = source[line_index]
+        if places[3 * last] == line_index:
+            end = places[3 * last + 2]
+        else:
+            end = len(line.rstrip())  # the match continues on the next line
+        text, span = strip_match(line, start, end)
+        found += 1
+        yield Match(file_path, text, position, text_matcher.patterns[order], span)
+        if found == max_count or (stop is not None and stop()):
+            break
+    return (line_count, byte_count)
+
+
+def iter_file_matches(
+    file: Union[Path, str],
+    search_for: Union[str, List[str]],
+    engine: str = "text",
+    matcher: Optional[Pattern[bytes]] = None,
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    notebook_cache: Optional[NotebookCache] = None,
+    stats: Optional[SearchStats] = None,
+    text_matcher: Optional[TextMatcher] = None,
+    context: Tuple[int, int] = (0, 0),
+    token_cache: Optional[TokenCache] = None,
+    archive_types: Optional[Iterable[str]] = None,
+    archive_cache: Optional[Dict[str, ArchiveContents]] = None,
+) -> Generator[Match, None, Tuple[int, int]]:
+    """Searches a file and yields matches as they're found.
+
+    Args:
+        file: the file to be searched
+        search_for: the text to search for, or a list of patterns. A line
+            that contains several of the patterns yields a match for each.
+        engine: the search engine, as for search_file()
+        matcher: the bytes matcher, as for search_file()
+        max_count: stop reading the file after this many matches
+        stop: a function that's called after each match, to stop reading the
+            file if it returns True
+        notebook_cache: the cache to read notebook source code from, if any
+        stats: the SearchStats to record phase timings in, if any. Files
+            that are searched line by line are then read and decoded in
+            separate steps, so that both can be timed, and are always read
+            completely.
+        text_matcher: the TextMatcher for search_for. If not provided, it's
+            compiled for this file.
+        context: the number of (before, after) context lines to include with
+            each match, as for iter_line_matches()
+        token_cache: in code mode, the cache to read the tokens of Python files
+            and notebooks from, if any
+        archive_types: if provided, file is searched as an archive if it is
+            one, for members of these file types (see iter_archive_matches)
+        archive_cache: archive tables of contents, as for iter_archive_matches
+
+    Returns:
+        A generator that yields each match found, as a Match object, and
+        returns a (lines searched, bytes searched) tuple when it's done. Use
+        "yield from" to get the returned tuple. If the search stops early, the
+        totals are for the part of the file that was actually read. Binary
+        files (see file_encoding) aren't searched, and return (0, 0).
+    """
+    file_path: Path = Path(file)
+    if text_matcher is None:
+        text_matcher = TextMatcher(search_for)
+
+    if archive_types is not None and is_archive(file_path):
+        if stats is not None:
+            stats.switch("archive")
+        totals = yield from iter_archive_matches(
+            file_path,
+            text_matcher,
+            archive_types,
+            max_count,
+            stop,
+            context,
+            archive_cache,
+        )
+        return totals
+
+    if text_matcher.code_patterns is not None and (
+        file_path.suffix.lower() == ".py" or is_notebook(file_path)
+    ):
+        if stats is not None:
+            stats.switch("tokenize")
+        totals = yield from iter_code_matches(
+            file_path, text_matcher, max_count, stop, notebook_cache, token_cache
+        )
+        return totals
+
+    if stats is not None:
+        stats.switch("open")
+    line_count: int
+    byte_count: int = file_path.stat().st_size
+    stopped: bool
+
+    if is_notebook(file_path):
+        # special case for searching Jupyter notebook files, which are read
+        # and parsed completely before searching
+        if stats is not None:
+            stats.switch("notebook")
+        source: Iterable[Tuple[int, str]] = (
+            notebook_cache.source(file_path)
+            if notebook_cache is not None
+            else notebook_source(file_path)
+        )
+        if stats is not None:
+            source = list(source)
+            stats.switch("match")
+        line_count, stopped = yield from iter_line_matches(
+            file_path, source, text_matcher, max_count, stop, context, cells=True
+        )
+        return (line_count, byte_count)
+
+    # plain text search for all other file types
+    with file_path.open("rb") as binary_file:
+        head: bytes = binary_file.read(config.BINARY_CHECK_SIZE)
+        encoding: Optional[str] = file_encoding(head)
+        if encoding is None:
+            return (0, 0)  # binary files aren't searched
+        if matcher is None:
+            matcher = text_matcher.bytes_matcher(encoding)
 
-        if self.last_file_printed != match.file.name:
-            prefix = " " * config.PREFIX_LENGTH
-            click.echo(
-                click.style(f"{prefix}{match.file.name}", fg=config.COLOR_FILENAME)
+        # the raw bytes aren't split into lines, so they can't provide context
+        # lines. Only the matched lines are decoded, so for --stats decoding
+        # is timed as part of matching.
+        if matcher is not None and not any(context):
+            if stats is not None:
+                stats.switch("match")
+            if engine == "mmap":
+                totals = yield from iter_bytes_matches(
+                    file_path,
+                    search_for,
+                    matcher,
+                    max_count,
+                    stop,
+                    text_matcher,
+                    encoding,
+                )
+                if totals is not None:
+                    return totals
+            else:
+                totals = yield from iter_block_matches(
+                    file_path,
+                    binary_file,
+                    head,
+                    matcher,
+                    text_matcher,
+                    encoding,
+                    max_count,
+                    stop,
+                    stats=stats,
+                )
+                return totals
+
+        # otherwise the whole file is decoded and searched line by line, with
+        # lines split at newlines only, as in iter_block_matches. Removing
+        # carriage returns from each line is slow, so it's only done if the
+        # first block of the file has one.
+        searchfile: IO[str]
+        if stats is None:
+            binary_file.seek(0)
+            searchfile = io.TextIOWrapper(
+                binary_file, encoding, errors="replace", newline="\n"
             )
-            self.last_file_printed = match.file.name
+        else:
+            stats.switch("read")
+            file_bytes: bytes = head + binary_file.read()
+            stats.switch("decode")
+            searchfile = io.StringIO(
+                file_bytes.decode(encoding, "replace"), newline="\n"
+            )
+            stats.switch("match")
+        lines: Iterable[Tuple[int, str]] = (
+            numbered_lines(searchfile) if b"\r" in head else enumerate(searchfile, 1)
+        )
+        line_count, stopped = yield from iter_line_matches(
+            file_path, lines, text_matcher, max_count, stop, context
+        )
+        if stopped and stats is None:
+            # bytes actually read from the file, which is at least the size of
+            # the buffer used by open()
+            bytes_read: int = binary_file.raw.tell()  # type: ignore
+            return (line_count, min(bytes_read, byte_count))
+    return (line_count, byte_count)
 
-        match.print_match()
 
-    def print_summary(self):
-        """Prints the search totals to the console.
-        """
-        click.echo("\r", nl=False)  # reset console to start of line
-        prefix = "Searched: ".rjust(config.PREFIX_LENGTH)
-        summary_text = (
-            f"{prefix}{self.searched_folders} folders, "
-            f"{self.searched_files} files, "
-            f"{self.searched_lines} lines, "
-            f"{self.searched_bytes} bytes"
+def iter_line_matches(
+    file_path: Path,
+    lines: Iterable[Tuple[int, str]],
+    text_matcher: TextMatcher,
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    context: Tuple[int, int] = (0, 0),
+    cells: bool = False,
+) -> Generator[Match, None, Tuple[int, bool]]:
+    """Searches lines of text and yields matches as they're found.
+
+    Args:
+        file_path: the file the lines are from, as a pathlib.Path
+        lines: (position, line) tuples, where position is the line number, or
+            the cell number for notebook source
+        text_matcher: the TextMatcher to search with
+        max_count: stop reading lines after this many matches
+        stop: a function that's called after each match, and after every
+            config.STOP_CHECK_LINES lines, to stop reading lines if it returns
+            True
+        context: the number of (before, after) context lines to include with
+            each match. The lines before a match are kept in a ring buffer as
+            lines are read, and a match is yielded when its trailing context
+            has been read. Overlapping context is merged, so that no line is
+            included twice, or as both a match and context.
+        cells: whether the lines are notebook source. Context lines don't
+            extend past the cell that contains the match.
+
+    Returns:
+        A generator that yields each match found, as a Match object, and
+        returns a (lines read, stopped early) tuple when it's done.
+    """
+    line_count: int = 0
+    found: int = 0
+    check_lines: int = config.STOP_CHECK_LINES
+    # a single substring is checked inline, which is much faster than a call
+    single: Optional[str] = text_matcher.single
+    fold: bool = text_matcher.fold
+    find: Callable[[str], List[Tuple[str, int, int]]] = text_matcher.find
+    position: int
+    line: str
+    text: str
+    span: Tuple[int, int]
+
+    if not any(context):
+        for position, line in lines:
+            line_count += 1
+            if not line_count % check_lines and stop is not None and stop():
+                return (line_count, True)
+            if single is not None and single not in (line.lower() if fold else line):
+                continue
+            for pattern, start, end in find(line):
+                found += 1
+                text, span = strip_match(line, start, end)
+                yield Match(file_path, text, position, pattern, span)
+                if found == max_count or (stop is not None and stop()):
+                    return (line_count, True)
+        return (line_count, False)
+
+    before: Deque[str] = deque(maxlen=context[0])
+    # matches from the last matched line, waiting for their trailing context
+    pending: List[Match] = []
+    after_left: int = 0
+    after: List[str] = []
+    # True after max_count is reached, when only trailing context is read
+    last_match: bool = False
+    cell: Optional[int] = None
+    for position, line in lines:
+        if cells and position != cell:
+            cell = position
+            before.clear()
+            if pending:
+                yield from pending
+                pending = []
+                if last_match or (stop is not None and stop()):
+                    return (line_count, True)
+        line_count += 1
+        if not line_count % check_lines and stop is not None and stop():
+            yield from pending
+            return (line_count, True)
+        hits: List[Tuple[str, int, int]] = []
+        if not last_match and (
+            single is None or single in (line.lower() if fold else line)
+        ):
+            hits = find(line)
+        if hits:
+            if pending:
+                yield from pending
+                pending = []
+                if stop is not None and stop():
+                    return (line_count, True)
+            if max_count is not None:
+                hits = hits[: max_count - found]
+            found += len(hits)
+            for pattern, start, end in hits:
+                text, span = strip_match(line, start, end)
+                pending.append(Match(file_path, text, position, pattern, span))
+            pending[0].before = [previous.rstrip("\r\n") for previous in before]
+            after = pending[-1].after = []
+            before.clear()
+            after_left = context[1]
+            last_match = found == max_count
+        elif pending:
+            after.append(line.rstrip("\r\n"))
+            after_left -= 1
+        else:
+            before.append(line)
+        if pending and not after_left:
+            yield from pending
+            pending = []
+            if last_match or (stop is not None and stop()):
+                return (line_count, True)
+    yield from pending
+    return (line_count, last_match)
+
+
+def iter_member_matches(
+    member_path: Path,
+    member: IO[bytes],
+    text_matcher: TextMatcher,
+    max_count: Optional[int] = None,
+    stop: Optional[Callable[[], bool]] = None,
+    context: Tuple[int, int] = (0, 0),
+) -> Generator[Match, None, Tuple[int, int]]:
+    """Searches a member of an archive, as it's decompressed.
+
+    Args:
+        member_path: the "archive!member" path of the member
+        member: the member's decompressed contents, as a binary stream
+        text_matcher: the TextMatcher to search with
+        max_count: stop after this many matches
+        stop: a function that's called after each match, to stop searching
+            the member if it returns True
+        context: the number of (before, after) context lines to include with
+            each match
+
+    Returns:
+        A generator that yields each match found, as a Match object, and
+        returns a (lines searched, bytes searched) tuple when it's done.
+
+    The member is searched like a file by the text engine: it's read a block
+    at a time if it can be searched as raw bytes, and is otherwise decoded
+    completely. Binary members aren't searched.
+    """
+    head: bytes = member.read(config.BINARY_CHECK_SIZE)
+    encoding: Optional[str] = file_encoding(head)
+    if encoding is None:
+        return (0, 0)
+    matcher: Optional[Pattern[bytes]] = text_matcher.bytes_matcher(encoding)
+    code: bool = text_matcher.code_patterns is not None and (
+        member_path.suffix.lower() == ".py" or is_notebook(member_path)
+    )
+    if (
+        matcher is not None
+        and not any(context)
+        and not code
+        and not is_notebook(member_path)
+    ):
+        totals = yield from iter_block_matches(
+            member_path,
+            member,
+            head,
+            matcher,
+            text_matcher,
+            encoding,
+            max_count,
+            stop,
+            offsets=False,
         )
-        click.echo(
-            click.style(
-                pad_string(summary_text, self.console_width), fg=config.COLOR_SUMMARY
-            )
+        return totals
+
+    member_bytes: bytes = head + member.read()
+    text: str = member_bytes.decode(encoding, "replace")
+    source: List[Tuple[int, str]]
+    if is_notebook(member_path):
+        source = list(notebook_source(member_path, text))
+    elif "\r" in text:
+        source = list(numbered_lines(io.StringIO(text, newline="\n")))
+    else:
+        source = list(enumerate(io.StringIO(text, newline="\n"), 1))
+    if code:
+        totals = yield from iter_code_matches(
+            member_path, text_matcher, max_count, stop, source=source
         )
+        return (totals[0], len(member_bytes))
+    line_count, _ = yield from iter_line_matches(
+        member_path,
+        source,
+        text_matcher,
+        max_count,
+        stop,
+        context,
+        cells=is_notebook(member_path),
+    )
+    return (line_count, len(member_bytes))
 
-    def reset_totals(self) -> None:
-        """Resets search totals to start a new set of searches.
-        """
-        self.searched_folders = 0
-        self.searched_files = 0
-        self.searched_lines = 0
-        self.searched_bytes = 0
 
-    def search_folder(
-        self, folder: str, subdirs: bool = False, print_matches: bool = True
-    ) -> List[Match]:
-        """Searches a folder's files.
+def json_array(
+    text: str, pos: int, parse_item: Callable[[str, int], Tuple[Any, int]]
+) -> Tuple[List[Any], int]:
+    """Parses a JSON array.
 
-        Args:
-            folder: name of the folder to be searched
-            subdirs: whether to recursively search all subfolders
-            print_matches: whether to print matches to the console
+    Args:
+        text: the JSON text
+        pos: position of the array in text
+        parse_item: function that parses each item of the array, and returns
+            a (value, end position) tuple
 
-        Returns:
-            A list of the matches found, as Match objects
-        """
-        matchlist = []
-        for curdir, dirs, files in os.walk(folder):
-            current_folder: Path = Path(curdir)
-            if (
-                current_folder.name in config.SKIPPED_FOLDERS
-                or current_folder.name.endswith(".egg-info")
-            ):
-                continue
+    Returns:
+        A (list of parsed items, end position) tuple.
+    """
+    pos = json_expect(text, pos, "[")
+    items: List[Any] = []
+    if text.startswith("]", pos):
+        return (items, pos + 1)
+    while True:
+        item, pos = parse_item(text, pos)
+        items.append(item)
+        pos = JSON_WHITESPACE.match(text, pos).end()
+        if text.startswith(",", pos):
+            pos = JSON_WHITESPACE.match(text, pos + 1).end()
+        elif text.startswith("]", pos):
+            return (items, pos + 1)
+        else:
+            raise ValueError(f"invalid JSON array at position {pos}")
 
-            folder_full_line = pad_string(str(current_folder), self.console_width)
-            click.echo(
-                "\r"
-                + click.style(folder_full_line, fg=config.COLOR_SEARCHED_FOLDERS)
-                + "\r",
-                nl=False,
-            )
-            if not subdirs:
-                del dirs[:]  # Don't search subfolders.
-            self.searched_folders += 1
-            for file in files:
-                # file_to_search: Path = Path(file)
-                file_to_search: Path = Path(curdir).joinpath(file)
-                if file_to_search.suffix.lower() in self.file_types:
-                    self.searched_files += 1
-                    matches, lines_count, bytes_count = search_file(
-                        file_to_search, self.search_for
-                    )
-                    self.searched_lines += lines_count
-                    self.searched_bytes += bytes_count
-                    for match in matches:
-                        matchlist.append(match)
-                        if print_matches:
-                            self.print_search_match(match)
-        return matchlist
 
+def json_expect(text: str, pos: int, char: str) -> int:
+    """Checks for a character in JSON text, skipping leading whitespace.
+
+    Args:
+        text: the JSON text
+        pos: position to start looking for the character
+        char: the expected character
+
+    Returns:
+        The position after the character and any whitespace that follows it.
+    """
+    pos = JSON_WHITESPACE.match(text, pos).end()
+    if not text.startswith(char, pos):
+        raise ValueError(f"expected {char!r} in JSON at position {pos}")
+    return JSON_WHITESPACE.match(text, pos + 1).end()
 
-def get_console_width() -> int:
-    """Gets the current width of the console screen in characters.
+
+def json_object(
+    text: str, pos: int, parsers: Dict[str, Callable[[str, int], Tuple[Any, int]]]
+) -> Tuple[Dict[str, Any], int]:
+    """Parses selected members of a JSON object.
 
     Args:
-        None
+        text: the JSON text
+        pos: position of the object in text
+        parsers: functions that parse the members to be returned, by key. Each
+            returns a (value, end position) tuple.
 
     Returns:
-        Current screen width in characters.
+        A (dictionary of parsed members, end position) tuple. Members that
+        aren't in parsers are skipped without decoding them.
     """
-    full_width, _ = shutil.get_terminal_size((80, 20))
-    return full_width - 1
+    pos = json_expect(text, pos, "{")
+    members: Dict[str, Any] = {}
+    if text.startswith("}", pos):
+        return (members, pos + 1)
+    while True:
+        key, pos = json_value(text, pos)
+        pos = json_expect(text, pos, ":")
+        if key in parsers:
+            members[key], pos = parsers[key](text, pos)
+        else:
+            pos = json_skip(text, pos)
+        pos = JSON_WHITESPACE.match(text, pos).end()
+        if text.startswith(",", pos):
+            pos = JSON_WHITESPACE.match(text, pos + 1).end()
+        elif text.startswith("}", pos):
+            return (members, pos + 1)
+        else:
+            raise ValueError(f"invalid JSON object at position {pos}")
 
 
-def highlight_match(match_line: str, match_text: str, max_chars: int) -> List[Tuple]:
-    """Converts a match to a set of color-highlighted strings to be printed to
-    the console.
+def json_skip(text: str, pos: int) -> int:
+    """Skips over a JSON value without decoding it.
 
     Args:
-        match_line: the line of text where a match was found
-        match_text: the text to be highlighted (i.e., what was searched for)
-        max_chars: the maximum total number of characters to be returned
+        text: the JSON text
+        pos: position of the value in text
 
     Returns:
-        A list of (text, color) tuples for printing with click.echo/click.style.
+        The position after the value. Nested arrays and objects are skipped by
+        finding only quotes and brackets, and strings are skipped with
+        str.find(), so long strings such as encoded images are passed over at
+        memory-scan speed.
+    """
+    if text.startswith('"', pos):
+        return json_string_end(text, pos)
+    if not text.startswith(("[", "{"), pos):
+        token = JSON_SCALAR.match(text, pos)
+        if token is None:
+            raise ValueError(f"invalid JSON value at position {pos}")
+        return token.end()
 
-    Note that we only highlight the first match if there are multiple matches
-    in a single line.
+    depth: int = 0
+    start: int = pos
+    while True:
+        token = JSON_STRUCTURE.search(text, pos)
+        if token is None:
+            raise ValueError(f"unterminated JSON value at position {start}")
+        char: str = token.group()
+        if char == '"':
+            pos = json_string_end(text, token.start())
+            continue
+        if char in "[{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return token.end()
+        pos = token.end()
+
+
+def json_string_end(text: str, pos: int) -> int:
+    """Finds the end of a JSON string.
+
+    Args:
+        text: the JSON text
+        pos: position of the string's opening quote
+
+    Returns:
+        The position after the string's closing quote.
     """
+    end: int = pos
+    while True:
+        end = text.find('"', end + 1)
+        if end == -1:
+            raise ValueError(f"unterminated JSON string at position {pos}")
+        # the quote is escaped if it follows an odd number of backslashes
+        backslash: int = end - 1
+        while text[backslash] == "\\":
+            backslash -= 1
+        if (end - 1 - backslash) % 2 == 0:
+            return end + 1
 
-    # toprint = the portion of the line that will be printed to the console
-    toprint: str
-    if match_text.lower() in match_line[:max_chars].lower():
-        # The match is in the first max_chars of the line.
-        toprint = match_line[:max_chars]
-    elif match_text.lower() in match_line[-max_chars:].lower():
-        # The match is in the last max_chars of the line.
-        toprint = match_line[-max_chars:]
-    else:
-        # This is a very long line relative to the console, and we need to find
-        # a max_chars long substring in the middle of it that contains the
-        # matched text. We'll try to position the match in the center of this
-        # substring.
-        # match_start = starting position of the match
-        match_start: int = match_line.lower().find(match_text.lower())
-        # center = the position of the center of the substring
-        center: int = match_start + len(match_text) // 2
-        # substring_start = the start of the extracted substring
-        substring_start: int = center - max_chars // 2
-        toprint = match_line[substring_start : substring_start + max_chars]
 
-    # Now we break toprint into colored sections. The matched search text will
-    # be config.COLOR_MATCH_TEXT, the rest of the line is config.COLOR_MATCH_LINE.
-    sections: List[Tuple] = []
-    match_position: int = toprint.lower().find(match_text.lower())
-    if match_position > 0:
-        sections.append((toprint[:match_position], config.COLOR_MATCH_LINE))
-    sections.append(
-        (
-            toprint[match_position : match_position + len(match_text)],
-            config.COLOR_MATCH_TEXT,
-        )
+def json_value(text: str, pos: int) -> Tuple[Any, int]:
+    """Decodes a JSON value.
+
+    Args:
+        text: the JSON text
+        pos: position of the value in text
+
+    Returns:
+        A (decoded value, end position) tuple.
+    """
+    return JSON_DECODER.raw_decode(text, pos)
+
+
+def load_gitignore(folder: str) -> Optional[GitIgnore]:
+    """Loads and compiles the .gitignore file in a folder.
+
+    Args:
+        folder: the folder
+
+    Returns:
+        A GitIgnore instance, or None if the folder has no .gitignore file.
+    """
+    try:
+        with open(os.path.join(folder, ".gitignore"), errors="replace") as fhandle:
+            return GitIgnore(folder, fhandle.readlines())
+    except OSError:
+        return None
+
+
+def notebook_source(
+    file: Path, notebook_text: Optional[str] = None
+) -> Iterator[Tuple[int, str]]:
+    """Reads the source code lines of a notebook's code cells.
+
+    Args:
+        file: the notebook file, as a pathlib.Path
+        notebook_text: the notebook's JSON, if it has already been read, such
+            as a notebook in an archive
+
+    Returns:
+        A generator that yields a (cell number, source line) tuple for each
+        line of source code in the notebook's code cells.
+
+    Only the cell types and sources are decoded. Everything else, such as
+    cell outputs with large base64-encoded images, is skipped over without
+    building it in memory, and when the notebook is read from file, its
+    outputs are dropped as they're read (see read_notebook_json).
+    """
+    if notebook_text is None:
+        notebook_text = read_notebook_json(file)
+    parse_cell = partial(
+        json_object, parsers={"cell_type": json_value, "source": json_value}
     )
-    if match_position < len(toprint) - len(match_text):
-        sections.append(
-            (toprint[match_position + len(match_text) :], config.COLOR_MATCH_LINE)
-        )
-    return sections
+    parse_cells = partial(json_array, parse_item=parse_cell)
+    notebook_data, _ = json_object(notebook_text, 0, {"cells": parse_cells})
+    cell_no: int
+    cell: dict
+    for cell_no, cell in enumerate(notebook_data.get("cells", [])):
+        if cell.get("cell_type") == "code":
+            cell_source: Union[List[str], str] = cell.get("source", [])
+            if isinstance(cell_source, str):
+                cell_source = cell_source.splitlines(keepends=True)
+            source_line: str
+            for source_line in cell_source:
+                yield (cell_no, source_line)
 
 
-def is_notebook(file: Union[Path, str]) -> bool:
-    """Determines whether a file is a notebook file or not.
+def numbered_lines(lines: Iterable[str]) -> Iterator[Tuple[int, str]]:
+    """Numbers the lines of a text file that's split at newlines only.
 
     Args:
-        file: the file, as either a pathlib.Path object or a filename string.
+        lines: the lines, such as a file opened with newline="\n"
 
     Returns:
-        True if notebook file, else False.
+        A generator that yields a (line number, line) tuple for each line.
+        A carriage return at the end of a line is removed, so that lines with
+        CRLF line endings match like lines with LF line endings. Other
+        carriage returns don't end a line, so lines are counted the same way
+        as by iter_block_matches and TrigramIndex.refresh.
     """
-    if isinstance(file, str):
-        return Path(file).suffix.lower() == ".ipynb"
-    return file.suffix.lower() == ".ipynb"
+    for number, line in enumerate(lines, 1):
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
+        elif line.endswith("\r"):
+            line = line[:-1]  # the last line, without a newline
+        yield (number, line)
 
 
 def pad_string(string: str, length: int) -> str:
@@ -360,51 +4516,378 @@ def pad_string(string: str, length: int) -> str:
     return string[:length].ljust(length)
 
 
-def search_file(file: str, search_for: str) -> Tuple[List[Match], int, int]:
+def pattern_list(search_for: Union[str, List[str]]) -> List[str]:
+    """Converts search text to a list of search patterns.
+
+    Args:
+        search_for: the text to search for, or a list of patterns
+
+    Returns:
+        A list of the patterns. Empty and duplicate patterns in a list are
+        dropped, and the order is otherwise preserved.
+    """
+    if isinstance(search_for, str):
+        return [search_for]
+    return list(dict.fromkeys(pattern for pattern in search_for if pattern))
+
+
+def pattern_regex(patterns: List[str]) -> str:
+    """Builds a regular expression that matches any of several patterns.
+
+    The patterns are merged into a trie, and the regular expression follows
+    the trie's branches, like the goto function of an Aho-Corasick automaton.
+    Patterns that share a prefix share its part of the expression, so the
+    regex engine never compares the same text against each pattern in turn.
+
+    Args:
+        patterns: the patterns, as literal text
+
+    Returns:
+        The regular expression, as a string.
+    """
+    trie: dict = {}
+    for pattern in patterns:
+        node: dict = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[""] = {}  # end of a pattern
+
+    def branch(node: dict) -> str:
+        """Returns the regular expression for a trie node's branches."""
+        alternatives: List[str] = [
+            re.escape(char) + branch(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not alternatives:
+            return ""
+        regex: str = "|".join(alternatives)
+        if len(alternatives) > 1 or "" in node:
+            regex = f"(?:{regex})"
+        return regex + "?" if "" in node else regex
+
+    return branch(trie)
+
+
+def query_server(socket_file: Path, request: dict) -> Optional[Iterator[dict]]:
+    """Sends a search request to the pyfind server.
+
+    Args:
+        socket_file: the server's socket file
+        request: the search request, with the Search options in "options"
+            and the subdirs argument of iter_matches in "subdirs"
+
+    Returns:
+        A generator that yields each record the server sends, as a dictionary,
+        or None if the server isn't running.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    connection: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(socket_file))
+        connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+    except OSError:
+        connection.close()
+        return None
+    return read_records(connection)
+
+
+def read_block(binary_file: IO[bytes], stats: Optional[SearchStats] = None) -> bytes:
+    """Reads the next block of a file, for iter_block_matches.
+
+    Args:
+        binary_file: the file, opened in binary mode
+        stats: the SearchStats to time the read in, if any. The phase is
+            switched to "read" for the read, and back to "match" after it.
+
+    Returns:
+        Up to config.READ_BLOCK_SIZE bytes, or b"" at the end of the file.
+    """
+    if stats is None:
+        return binary_file.read(config.READ_BLOCK_SIZE)
+    stats.switch("read")
+    block: bytes = binary_file.read(config.READ_BLOCK_SIZE)
+    stats.switch("match")
+    return block
+
+
+def read_notebook_json(file: Path) -> str:
+    """Reads a notebook's JSON, leaving out its cell outputs.
+
+    Args:
+        file: the notebook file, as a pathlib.Path
+
+    Returns:
+        The notebook's JSON text, with the value of each "outputs" member
+        replaced by an empty array.
+
+    The file is read a block at a time, and the outputs are scanned for their
+    end and dropped as they're read, so memory use depends on the size of the
+    rest of the notebook, not the size of images and other output data.
+    Notebook files are always UTF-8.
+    """
+    kept: List[str] = []
+    text: str = ""
+    pos: int = 0
+    # nesting depth of the outputs being skipped, or None if not skipping
+    skip_depth: Optional[int] = None
+    in_string: bool = False
+    with file.open(encoding="utf-8", errors="replace", newline="") as notebook_file:
+        while True:
+            block: str = notebook_file.read(config.READ_BLOCK_SIZE)
+            text, pos = text[pos:] + block, 0
+            while pos < len(text):
+                if skip_depth is None:
+                    quote: int = text.find('"', pos)
+                    if quote == -1:
+                        kept.append(text[pos:])
+                        pos = len(text)
+                        break
+                    key = JSON_KEY.match(text, quote)
+                    if block and (key is None or key.end() == len(text)):
+                        # the string, or the colon after it, is in the next block
+                        kept.append(text[pos:quote])
+                        pos = quote
+                        break
+                    end: int = len(text) if key is None else key.end()
+                    kept.append(text[pos:end])
+                    pos = end
+                    if key is not None and key.group(1) == "outputs" and key.group(2):
+                        skip_depth = 0
+                elif skip_depth == 0:
+                    # the start of the outputs value
+                    start: int = JSON_WHITESPACE.match(text, pos).end()
+                    if start == len(text):
+                        pos = start
+                        break
+                    if text[start] in "[{":
+                        skip_depth = 1
+                        pos = start + 1
+                    else:
+                        skip_depth = None  # not a list, so it's kept
+                elif in_string:
+                    # stops at the closing quote, or at the end of the block
+                    pos = JSON_STRING_CHARS.match(text, pos).end()
+                    if not text.startswith('"', pos):
+                        break  # the string continues in the next block
+                    in_string = False
+                    pos += 1
+                else:
+                    token = JSON_STRUCTURE.search(text, pos)
+                    if token is None:
+                        pos = len(text)
+                        break
+                    pos = token.end()
+                    char: str = token.group()
+                    if char == '"':
+                        in_string = True
+                    elif char in "[{":
+                        skip_depth += 1
+                    else:
+                        skip_depth -= 1
+                        if skip_depth == 0:
+                            kept.append("[]")
+                            skip_depth = None
+            if not block:
+                kept.append(text[pos:])  # the end of a truncated file
+                return "".join(kept)
+
+
+def read_records(connection: socket.socket) -> Iterator[dict]:
+    """Reads the records sent by the pyfind server.
+
+    Args:
+        connection: the socket connected to the server
+
+    Returns:
+        A generator that yields each record, as a dictionary. The connection
+        is closed when the last record has been read.
+    """
+    with connection, connection.makefile("r", encoding="utf-8") as reader:
+        for line in reader:
+            yield json.loads(line)
+
+
+def required_literal(regex: str, flags: int = 0) -> Tuple[str, bool]:
+    """Finds literal text that every match of a regular expression contains.
+
+    Lines that don't contain the literal text can be rejected with a fast
+    substring check, without running the regular expression.
+
+    Args:
+        regex: the regular expression
+        flags: the flags the regular expression is compiled with
+
+    Returns:
+        A (literal, ignore_case) tuple. The literal is the longest run of
+        literal characters that's required by the regular expression, or an
+        empty string if there's no such text, and ignore_case is whether the
+        literal is matched without regard to case.
+    """
+    try:
+        parsed = sre_parse.parse(regex, flags)
+    except (re.error, OverflowError, RecursionError):
+        return ("", False)
+    ignore_case: bool = bool(parsed.state.flags & re.IGNORECASE)
+    repeats = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+    if hasattr(sre_parse, "POSSESSIVE_REPEAT"):
+        repeats.add(sre_parse.POSSESSIVE_REPEAT)
+
+    def literal_runs(items: Any) -> List[str]:
+        """Returns the runs of required literal characters in parsed items."""
+        runs: List[str] = []
+        run: List[str] = []
+        for opcode, argument in items:
+            if opcode is sre_parse.LITERAL:
+                run.append(chr(argument))
+                continue
+            if run:
+                runs.append("".join(run))
+                run = []
+            if opcode is sre_parse.SUBPATTERN:
+                # skip groups that ignore case when the rest doesn't
+                add_flags: int = argument[1]
+                if ignore_case or not add_flags & re.IGNORECASE:
+                    runs.extend(literal_runs(argument[-1]))
+            elif opcode in repeats and argument[0] >= 1:
+                runs.extend(literal_runs(argument[2]))
+        if run:
+            runs.append("".join(run))
+        return runs
+
+    return (max(literal_runs(parsed), key=len, default=""), ignore_case)
+
+
+def result_of(
+    pending: Union[Future, Tuple]
+) -> Optional[Tuple[List[Match], int, int]]:
+    """Gets the search_file results from a queued search.
+
+    Args:
+        pending: a Future for a search running in a worker process, or the
+            results of a search that has already completed
+
+    Returns:
+        The search_file results tuple, or None if the file was deleted or
+        couldn't be read by the time it was searched.
+    """
+    if isinstance(pending, Future):
+        try:
+            return pending.result()
+        except OSError:
+            return None
+    return pending
+
+
+def scope_index_file(pyfind_folder: Path, scope: str, root: Path) -> Path:
+    """Gets the file that the index for a *stdlib or *packages search is
+    stored in.
+
+    Args:
+        pyfind_folder: the pyfind folder
+        scope: "stdlib" or "packages"
+        root: the root folder of the search
+
+    Returns:
+        A file in the config.SCOPE_INDEX_FOLDER folder, with a name that's
+        unique to the Python interpreter and the root folder, so that each
+        interpreter and environment has its own index.
+    """
+    digest: str = hashlib.sha1(
+        f"{sys.executable}|{root}".encode("utf-8", "surrogateescape")
+    ).hexdigest()[:16]
+    return pyfind_folder.joinpath(
+        config.SCOPE_INDEX_FOLDER, f"{scope}-{digest}.index"
+    )
+
+
+def search_file(
+    file: str,
+    search_for: Union[str, List[str]],
+    engine: str = "text",
+    matcher: Optional[Pattern[bytes]] = None,
+    max_count: Optional[int] = None,
+    notebook_cache: Optional[NotebookCache] = None,
+    text_matcher: Optional[TextMatcher] = None,
+    context: Tuple[int, int] = (0, 0),
+    token_cache: Optional[TokenCache] = None,
+    archive_types: Optional[Iterable[str]] = None,
+) -> Tuple[List[Match], int, int]:
     """Searches a file for a specified string.
 
     Args:
         file: name of the file to be searched (str)
-        search_for: the text to search for
+        search_for: the text to search for, or a list of patterns
+        engine: "text" to read the file's raw bytes a block at a time (see
+            iter_block_matches), or "mmap" to memory-map them (see
+            iter_bytes_matches). Only the lines that may match are decoded.
+            Notebooks, context lines, and searches that can't be done on raw
+            bytes decode the whole file and search it line by line.
+        matcher: the bytes matcher for the file's encoding, from
+            TextMatcher.bytes_matcher(). If not provided, it's compiled for
+            the file's encoding.
+        max_count: stop reading the file after this many matches
+        notebook_cache: the cache to read notebook source code from, if any
+        text_matcher: the TextMatcher for search_for. If not provided, it's
+            compiled for this file.
+        context: the number of (before, after) context lines to include with
+            each match
+        token_cache: in code mode, the cache to read the tokens of Python files
+            and notebooks from, if any
+        archive_types: if provided, file is searched as an archive if it is
+            one, for members of these file types (see iter_archive_matches)
 
     Returns:
         A tuple containing these three values:
         - a list of Match objects
         - number of lines searched
-        - number of bytes searched (i.e., file size in bytes)
+        - number of bytes searched (i.e., file size in bytes, or the number
+          of bytes read if max_count matches were found)
     """
-    file_path: Path = Path(file)
-
     matches: List[Match] = []
-    line_count: int = 0
-    byte_count: int = file_path.stat().st_size
+    file_matches = iter_file_matches(
+        file,
+        search_for,
+        engine,
+        matcher,
+        max_count,
+        notebook_cache=notebook_cache,
+        text_matcher=text_matcher,
+        context=context,
+        token_cache=token_cache,
+        archive_types=archive_types,
+    )
+    while True:
+        try:
+            matches.append(next(file_matches))
+        except StopIteration as done:
+            line_count, byte_count = done.value
+            return (matches, line_count, byte_count)
 
-    if is_notebook(file):
-        # special case for searching Jupyter notebook files
-        with file_path.open(errors="replace") as notebook_file:
-            notebook_data: dict = json.loads(notebook_file.read())
-        cell_no: int
-        cell: dict
-        for cell_no, cell in enumerate(notebook_data["cells"]):
-            if cell["cell_type"] == "code":
-                source_line: str
-                for source_line in cell["source"]:
-                    line_count += 1
-                    if search_for.lower() in source_line.lower():
-                        matches.append(
-                            Match(file_path, source_line.strip(), cell_no, search_for)
-                        )
-        return (matches, line_count, byte_count)
 
-    # plain text search for all other file types
-    with file_path.open(errors="replace") as searchfile:
-        lineno: int
-        line: str
-        for lineno, line in enumerate(searchfile, 1):
-            line_count += 1
-            if search_for.lower() in line.lower():
-                matches.append(Match(file_path, line.strip(), lineno, search_for))
-    return (matches, line_count, byte_count)
+def strip_match(line: str, start: int, end: int) -> Tuple[str, Tuple[int, int]]:
+    """Strips a matched line, adjusting the offsets of the match to suit.
+
+    Args:
+        line: the line of text where a match was found
+        start: offset of the start of the match in line
+        end: offset of the end of the match in line
+
+    Returns:
+        A (stripped line, (start, end)) tuple, with the offsets of the match
+        in the stripped line. Parts of the match that were stripped are
+        dropped.
+    """
+    stripped: str = line.strip()
+    lead: int = len(line) - len(line.lstrip())
+    return (
+        stripped,
+        (
+            min(max(start - lead, 0), len(stripped)),
+            min(max(end - lead, 0), len(stripped)),
+        ),
+    )
 
 
 def textfile_to_list(filename: str) -> List[str]:
@@ -422,3 +4905,69 @@ def textfile_to_list(filename: str) -> List[str]:
             if line.strip():
                 returned_list.append(line.strip())
     return returned_list
+
+
+def tokenize_source(source: List[Tuple[int, str]], cells: bool = False) -> CodeTokens:
+    """Gets the code tokens of Python source code, for TokenCache.
+
+    Args:
+        source: (position, source line) tuples, as returned by code_source()
+        cells: whether the source is notebook cells, which are tokenized
+            separately
+
+    Returns:
+        A (code, starts, places, lines) tuple. Code is the tokens from
+        code_tokens(), separated by single spaces, starts has the offset of
+        each token in code, places has the (line index, start, end) of each
+        token in source, and lines is the number of source lines.
+    """
+    parts: List[str] = []
+    starts: array = array("I")
+    places: array = array("I")
+    offset: int = 0
+    first: int = 0  # index in source of the first line of the current cell
+    while first < len(source):
+        last: int = first + 1
+        if cells:
+            while last < len(source) and source[last][0] == source[first][0]:
+                last += 1
+        else:
+            last = len(source)
+        text: str = "".join(line for _, line in source[first:last])
+        for token, row, start, end in code_tokens(text):
+            parts.append(token)
+            starts.append(offset)
+            places.extend((first + row - 1, start, end))
+            offset += len(token) + 1
+        first = last
+    return (" ".join(parts), starts, places, len(source))
+
+
+def trigram_mask(trigram_set: Iterable[str], bits: int) -> int:
+    """Converts a set of trigrams to a bitmask.
+
+    Args:
+        trigram_set: the trigrams
+        bits: the size of the bitmask (a power of 2)
+
+    Returns:
+        An int with the bit for each trigram's hash set. Hashes are computed
+        with CRC-32, because they must be the same in every Python process.
+    """
+    mask: int = 0
+    for trigram in trigram_set:
+        mask |= 1 << (zlib.crc32(trigram.encode("utf-8", "replace")) & (bits - 1))
+    return mask
+
+
+def trigrams(text: str) -> set:
+    """Gets the set of distinct 3-character substrings in a string.
+
+    Args:
+        text: the string
+
+    Returns:
+        A set of the trigrams in text, or an empty set if text is shorter than
+        3 characters.
+    """
+    return {text[pos : pos + 3] for pos in range(len(text) - 2)}
@@ -2,12 +2,26 @@
 """
 from pathlib import Path
 
+import io
+import json
+import os
+import pstats
+import tarfile
+import threading
+import time
+import zipfile
+
 import pytest
 from click.testing import CliRunner
 
+import benchmark
 import config
 from pyfind import highlight_match, Search, textfile_to_list
-from pyfind import cli, Match, is_notebook, search_file, pad_string
+from pyfind import cli, Match, is_notebook, search_file, pad_string, TrigramIndex
+from pyfind import iter_file_matches, notebook_source, NotebookCache, Console
+from pyfind import pattern_regex, TextMatcher, required_literal, VersionedIndex
+from pyfind import query_server, Server, Watcher, TokenCache
+from pyfind import file_encoding, iter_archive_matches, read_notebook_json
 
 LONG_TEXT = (
     "START Lorem ipsum dolor sit amet, consectetuer adipiscing elit. "
@@ -50,6 +64,36 @@ def test_pad_string(string, length, expected):
     assert pad_string(string, length) == expected
 
 
+@pytest.mark.unit_test
+def test_console(capsys):
+    """class: Console
+    """
+    console = Console()
+    console.write("first ", config.COLOR_MATCH_LINE, nl=False)
+    console.write("line")
+    console.progress("status line", config.COLOR_SEARCHED_FOLDERS)
+    assert capsys.readouterr().out == ""  # buffered, and stdout isn't a tty
+    console.flush()
+    out, err = capsys.readouterr()
+    assert out == "first line\n"
+    assert err == ""
+
+    # poll() flushes text that has been buffered for the flush interval, even
+    # if nothing more is written
+    console.write("second line")
+    console.poll()
+    assert capsys.readouterr().out == ""
+    console.last_flush -= config.CONSOLE_FLUSH_INTERVAL
+    console.poll()
+    assert capsys.readouterr().out == "second line\n"
+
+    output = io.StringIO()
+    console = Console(output)
+    assert not console.show_progress
+    console.write('{"type": "summary"}')
+    console.flush()
+    assert output.getvalue() == '{"type": "summary"}\n'
+
 @pytest.mark.unit_test
 @pytest.mark.parametrize(
     "searchfor,maxchars,expected",
@@ -100,6 +144,9 @@ def test_highlight_match(searchfor, maxchars, expected):
     """function: highlight_match()
     """
     assert highlight_match(LONG_TEXT, searchfor, maxchars) == expected
+    start = LONG_TEXT.find(searchfor)
+    span = (start, start + len(searchfor))
+    assert highlight_match(LONG_TEXT, searchfor, maxchars, span) == expected
 
 @pytest.mark.unit_test
 @pytest.mark.parametrize(
@@ -116,6 +163,59 @@ def test_is_notebook(filename, expected):
     """
     assert is_notebook(filename) == expected
 
+@pytest.mark.unit_test
+def test_notebook_source(tmp_path, monkeypatch):
+    """functions: notebook_source() and read_notebook_json()
+    """
+    notebook = {
+        "metadata": {"kernelspec": {"name": "python3"}},
+        "cells": [
+            {"cell_type": "markdown", "source": ["# import nothing"]},
+            {
+                "outputs": [
+                    {"data": {"image/png": "iVBORw0K" * 1000, "text/plain": ["{[\"]}"]}}
+                ],
+                "cell_type": "code",
+                "execution_count": 1.5e3,
+                "source": ["import json\n", 'print("\\"}]{[")'],
+            },
+            {"cell_type": "code", "source": "x = 1\ny = [\n"},
+        ],
+        "nbformat": 4,
+    }
+    file = tmp_path / "sample.ipynb"
+    file.write_text(json.dumps(notebook, indent=1))
+    assert list(notebook_source(file)) == [
+        (1, "import json\n"),
+        (1, 'print("\\"}]{[")'),
+        (2, "x = 1\n"),
+        (2, "y = [\n"),
+    ]
+
+    # outputs are dropped as the file is read, whichever block they end in,
+    # and notebooks are read as UTF-8 whatever the locale
+    notebook["cells"][2]["source"] = 'name = "M\u00fcller"'
+    file.write_bytes(json.dumps(notebook, ensure_ascii=False).encode())
+    expected = list(notebook_source(file, file.read_bytes().decode()))
+    assert expected[-1] == (2, 'name = "M\u00fcller"')
+    for block_size in [1, 2, 3, 5, 64]:
+        monkeypatch.setattr(config, "READ_BLOCK_SIZE", block_size)
+        assert list(notebook_source(file)) == expected
+        cells = json.loads(read_notebook_json(file))["cells"]
+        assert cells[1]["outputs"] == []
+
+@pytest.mark.unit_test
+def test_notebook_cache(tmp_path):
+    """class: NotebookCache
+    """
+    cache = NotebookCache(tmp_path / "cache")
+    notebook = Path("testdata.ipynb")
+    assert cache.source(notebook) == list(notebook_source(notebook))
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    # a cache hit returns the same source
+    assert cache.source(notebook) == list(notebook_source(notebook))
+    assert search_file(notebook, "requests", notebook_cache=cache)[1:] == (1, 703)
+
 @pytest.mark.unit_test
 def test_print_match(capsys):
     """method: Match.print_match()
@@ -187,6 +287,29 @@ def test_search_file(filename, search_for, match, hits, lines, bytes):
     assert search_results[1] == lines
     assert search_results[2] == bytes
 
+@pytest.mark.unit_test
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "whatever",
+        "one\nWhatEver two whatever\nthree\n\nwhatever\n",
+        "no hits here\nor here",
+        "windows\r\nline endings whatever\r\n",
+    ],
+)
+def test_search_file_mmap(tmp_path, content):
+    """function: search_file() with the mmap engine
+    """
+    file = tmp_path / "sample.txt"
+    file.write_bytes(content.encode())
+    text_results = search_file(file, "whatever")
+    mmap_results = search_file(file, "whatever", engine="mmap")
+    assert [(match.match, match.position) for match in mmap_results[0]] == [
+        (match.match, match.position) for match in text_results[0]
+    ]
+    assert mmap_results[1:] == text_results[1:]
+
 @pytest.mark.unit_test
 def test_search_folder():
     """method: Search.search_folder()
@@ -197,6 +320,817 @@ def test_search_folder():
     assert "testdata.ipynb" in [str(match.file) for match in matches]
     assert "testdata.txt" in [str(match.file) for match in matches]
 
+@pytest.mark.unit_test
+def test_iter_file_matches():
+    """function: iter_file_matches()
+    """
+    file_matches = iter_file_matches("testdata.txt", "whatever")
+    assert next(file_matches).position == 3
+    assert next(file_matches).position == 4
+    with pytest.raises(StopIteration) as done:
+        next(file_matches)
+    assert done.value.value == search_file("testdata.txt", "whatever")[1:]
+
+@pytest.mark.unit_test
+def test_iter_matches():
+    """method: Search.iter_matches()
+    """
+    searcher = Search("whatever", [".txt"])
+    matches = searcher.iter_matches(".", subdirs=True)
+    first = next(matches)
+    assert first.position == 3
+    matches.close()
+    assert searcher.searched_files == 1
+    assert [
+        (str(match.file), match.position)
+        for match in Search("whatever", [".txt"]).iter_matches(".", subdirs=True)
+    ] == [
+        (str(match.file), match.position)
+        for match in Search("whatever", [".txt"]).search_folder(
+            ".", subdirs=True, print_matches=False
+        )
+    ]
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("engine", ["text", "mmap"])
+def test_search_file_max_count(tmp_path, engine):
+    """function: search_file() with max_count
+    """
+    file = tmp_path / "sample.txt"
+    file.write_text("whatever\n" * 10 + "x" * 100000 + "\nwhatever\n")
+    matches, lines, bytes_read = search_file(file, "whatever", engine, max_count=3)
+    assert [match.position for match in matches] == [1, 2, 3]
+    assert lines == 3
+    assert bytes_read < file.stat().st_size
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("engine", ["text", "mmap"])
+def test_search_file_context(tmp_path, engine):
+    """function: search_file() with context lines
+    """
+    file = tmp_path / "sample.txt"
+    file.write_text("a\nb json\nc\nd\ne json\nf\ng\nh\ni\nj json\nk\n")
+    matches, lines, _ = search_file(file, "json", engine, context=(2, 2))
+    # overlapping context is merged, with no line included twice
+    assert [(match.position, match.before, match.after) for match in matches] == [
+        (2, ["a"], ["c", "d"]),
+        (5, [], ["f", "g"]),
+        (10, ["h", "i"], ["k"]),
+    ]
+    assert lines == 11
+    # the trailing context of the last match is read after max_count
+    matches, lines, _ = search_file(file, "json", engine, max_count=1, context=(0, 1))
+    assert [(match.position, match.after) for match in matches] == [(2, ["c"])]
+    assert lines == 3
+    assert matches[0].as_record()["after"] == ["c"]
+    assert "before" not in matches[0].as_record()
+
+    # notebook context lines don't extend past the match's cell
+    notebook = {
+        "cells": [
+            {"cell_type": "code", "source": "import os\nimport json\n"},
+            {"cell_type": "code", "source": "x = json.loads(y)\nprint(x)\n"},
+        ]
+    }
+    file = tmp_path / "sample.ipynb"
+    file.write_text(json.dumps(notebook))
+    matches, _, _ = search_file(file, "json", engine, context=(1, 1))
+    assert [(match.position, match.before, match.after) for match in matches] == [
+        (0, ["import os"], []),
+        (1, [], ["print(x)"]),
+    ]
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize(
+    "head,expected",
+    [
+        (b"import os\n", "utf-8"),
+        (b"#!/usr/bin/env python\n# -*- coding: latin-1 -*-\n", "iso-8859-1"),
+        (b"# coding: no-such-codec\n", "utf-8"),
+        (b"\xef\xbb\xbfimport os\n", "utf-8-sig"),
+        ("import os\n".encode("utf-16"), "utf-16"),
+        (b"\x7fELF\x02\x01\x01\x00\x00", None),
+    ],
+)
+def test_file_encoding(head, expected):
+    """function: file_encoding()
+    """
+    assert file_encoding(head) == expected
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("engine", ["text", "mmap"])
+def test_search_file_encodings(tmp_path, engine, monkeypatch):
+    """function: search_file() with encoding detection and binary files
+    """
+    # small blocks, so that lines are carried over between blocks
+    monkeypatch.setattr(config, "READ_BLOCK_SIZE", 7)
+    file = tmp_path / "latin.py"
+    file.write_bytes(
+        "# coding: latin-1\nname = 'Müller'\n\nprint(name)  # Müller".encode(
+            "latin-1"
+        )
+    )
+    matches, lines, bytes_read = search_file(file, "print", engine)
+    assert [(match.position, match.match) for match in matches] == [
+        (4, "print(name)  # Müller")
+    ]
+    assert (lines, bytes_read) == (4, file.stat().st_size)
+    # non-ASCII search text is found in the decoded lines
+    matches, _, _ = search_file(file, "müller", engine)
+    assert [match.position for match in matches] == [2, 4]
+
+    file = tmp_path / "wide.txt"
+    file.write_text("first\nsecond whatever\n", encoding="utf-16")
+    matches, lines, _ = search_file(file, "whatever", engine)
+    assert [(match.position, match.match) for match in matches] == [
+        (2, "second whatever")
+    ]
+
+    file = tmp_path / "binary.txt"
+    file.write_bytes(b"whatever\0whatever\n")
+    assert search_file(file, "whatever", engine) == ([], 0, 0)
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("engine", ["text", "mmap"])
+@pytest.mark.parametrize("context", [(0, 0), (1, 0)])
+def test_search_file_crlf(tmp_path, engine, context):
+    """function: iter_file_matches() with CRLF line endings and an anchored
+    regular expression
+    """
+    crlf_file = tmp_path / "crlf.txt"
+    crlf_file.write_bytes(b"first line\r\nwhatever foo\r\nfoo bar\r\nlast foo")
+    text_matcher = TextMatcher(r"foo$", regex=True)
+    matches = list(
+        iter_file_matches(
+            crlf_file, r"foo$", engine, text_matcher=text_matcher, context=context
+        )
+    )
+    assert [(match.position, match.match, match.span) for match in matches] == [
+        (2, "whatever foo", (9, 12)),
+        (4, "last foo", (5, 8)),
+    ]
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("engine", ["text", "mmap"])
+def test_search_file_patterns(tmp_path, engine):
+    """function: search_file() with a list of patterns
+    """
+    file = tmp_path / "sample.txt"
+    file.write_text("import json\nJSON.dumps(x)\nnothing\njson.loads(y)\n")
+    matches, lines, _ = search_file(file, ["json.dumps", "json", "loads"], engine)
+    assert [(match.position, match.search_for) for match in matches] == [
+        (1, "json"),
+        (2, "json.dumps"),
+        (2, "json"),
+        (4, "json"),
+        (4, "loads"),
+    ]
+    assert lines == 4
+
+@pytest.mark.unit_test
+def test_search_file_code(tmp_path):
+    """function: search_file() in code mode, with a TokenCache
+    """
+    file = tmp_path / "sample.py"
+    file.write_text(
+        "import json\n"
+        "# json.dumps in a comment\n"
+        "x = json.dumps(y)\n"
+        "s = 'json.dumps in a string'\n"
+        "my_json.dumps_all(z)\n"
+        "w = (json\n"
+        "     .dumps(1))\n"
+    )
+    cache = TokenCache(tmp_path / "cache")
+    text_matcher = TextMatcher(["json.dumps(", "import"], code=True)
+    for _ in range(2):  # tokenized, then read from the cache
+        matches, lines, _ = search_file(
+            file, "", text_matcher=text_matcher, token_cache=cache
+        )
+        assert [
+            (match.position, match.search_for, match.span) for match in matches
+        ] == [
+            (1, "import", (0, 6)),
+            (3, "json.dumps(", (4, 15)),
+            (6, "json.dumps(", (5, 9)),
+        ]
+        assert lines == 7
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    # a changed file is tokenized again
+    file.write_text("json.dumps(x)  # changed\n")
+    matches, _, _ = search_file(file, "", text_matcher=text_matcher, token_cache=cache)
+    assert [match.match for match in matches] == ["json.dumps(x)  # changed"]
+    with pytest.raises(ValueError):
+        TextMatcher("# just a comment", code=True)
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("engine", ["text", "mmap"])
+def test_match_compact(tmp_path, engine):
+    """class: Match, compacted by Search.search_folder()
+    """
+    (tmp_path / "sample.txt").write_bytes(
+        "whatever first\n  second Whatever  \n".encode("utf-8-sig")
+    )
+    matches = Search("whatever", [".txt"], engine=engine).search_folder(
+        str(tmp_path), print_matches=False
+    )
+    assert not hasattr(matches[0], "__dict__")
+    assert [match._match for match in matches] == [None, None]
+    # the text is read from the file again
+    assert [(match.match, match.span) for match in matches] == [
+        ("whatever first", (0, 8)),
+        ("second Whatever", (7, 15)),
+    ]
+    assert matches[1].as_record()["text"] == "second Whatever"
+    # a match without a byte offset keeps its text
+    match = Match(tmp_path / "sample.txt", "text", 1, "text", (0, 4)).compact()
+    assert (match.match, match.before, match.after) == ("text", [], [])
+
+@pytest.mark.unit_test
+def test_search_archives(tmp_path):
+    """class: Search, with the archives option
+    """
+    member = tmp_path / "mod.py"
+    member.write_text("import json\nx = json.dumps(1)\n")
+    with zipfile.ZipFile(tmp_path / "pkg-1.0-py3-none-any.whl", "w") as wheel:
+        wheel.write(member, "pkg/mod.py")
+        wheel.writestr("pkg/data.bin", b"json.dumps\0")
+    with tarfile.open(tmp_path / "pkg-1.0.tar.gz", "w:gz") as sdist:
+        sdist.add(member, "pkg-1.0/pkg/mod.py")
+    (tmp_path / "broken.zip").write_bytes(b"not a zip file")
+    member.unlink()
+
+    searcher = Search("json.dumps", [".py", ".bin"], archives=True)
+    matches = searcher.search_folder(str(tmp_path), print_matches=False)
+    assert sorted((str(match.file), match.position) for match in matches) == [
+        (f"{tmp_path / 'pkg-1.0-py3-none-any.whl'}!pkg/mod.py", 2),
+        (f"{tmp_path / 'pkg-1.0.tar.gz'}!pkg-1.0/pkg/mod.py", 2),
+    ]
+    assert searcher.searched_files == 3
+    # the tables of contents are cached, and damaged archives aren't
+    contents = searcher.archive_cache
+    assert sorted(Path(path).name for path in contents) == [
+        "pkg-1.0-py3-none-any.whl",
+        "pkg-1.0.tar.gz",
+    ]
+    assert contents[str(tmp_path / "pkg-1.0.tar.gz")][2] == [("pkg-1.0/pkg/mod.py", 30)]
+    assert Search("json.dumps", [".py"]).search_folder(
+        str(tmp_path), print_matches=False
+    ) == []
+
+@pytest.mark.unit_test
+def test_text_matcher():
+    """class: TextMatcher
+    """
+    assert pattern_regex(["json", "json.dumps", "abc"]) == r"(?:abc|json(?:\.dumps)?)"
+    matcher = TextMatcher(["Spam", "eggs", "", "spam"])
+    assert matcher.patterns == ["Spam", "eggs", "spam"]
+    assert matcher.find("EGGS and spam") == [
+        ("Spam", 9, 13),
+        ("eggs", 0, 4),
+        ("spam", 9, 13),
+    ]
+    assert matcher.find("ham") == []
+    assert TextMatcher([]).find("anything") == []
+    assert TextMatcher("Spam", case_sensitive=True).find("spam Spam") == [
+        ("Spam", 5, 9)
+    ]
+    assert TextMatcher("spam", word=True).find("spammy (spam)") == [("spam", 8, 12)]
+    assert TextMatcher(r"sp\w+m", regex=True).find("a SPAAM") == [
+        (r"sp\w+m", 2, 7)
+    ]
+    assert TextMatcher(r"sp\w+m", regex=True).index_patterns() == ["sp"]
+    assert TextMatcher(r"\w+", regex=True).index_patterns() is None
+    # in word and regex modes, the bytes matcher finds the required literal
+    assert TextMatcher("spam", word=True).bytes_matcher().search(b"SPAMMY")
+    assert TextMatcher(r"\w+", regex=True).bytes_matcher() is None
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize(
+    "regex,expected",
+    [
+        (r"foo\d+barbaz", ("barbaz", False)),
+        (r"(?i)Hello, \w+", ("Hello, ", True)),
+        (r"a(?i:bc)d", ("a", False)),
+        (r"x*ab(cdef)+", ("cdef", False)),
+        (r"spam|eggs", ("", False)),
+    ],
+)
+def test_required_literal(regex, expected):
+    """function: required_literal()
+    """
+    assert required_literal(regex) == expected
+
+@pytest.mark.unit_test
+def test_search_modes():
+    """class: Search, with the regex, word and case_sensitive options
+    """
+    for search_for, options, expected in [
+        (r"WHAT\w+", {"regex": True}, 4),
+        (r"WHAT\w+", {"regex": True, "case_sensitive": True}, 0),
+        ("whatever", {"case_sensitive": True}, 4),
+        ("whatever", {"word": True}, 4),
+        ("whatev", {"word": True}, 0),
+    ]:
+        searcher = Search(search_for, [".txt"], **options)
+        matches = searcher.search_folder(".", subdirs=True, print_matches=False)
+        assert len(matches) == expected
+        for match in matches:
+            assert match.match[match.span[0] : match.span[1]] == "whatever"
+
+@pytest.mark.unit_test
+def test_search_limits():
+    """class: Search, with max_results, files_with_matches and stop()
+    """
+    searcher = Search("whatever", [".txt"], max_results=3)
+    matches = searcher.search_folder(".", subdirs=True, print_matches=False)
+    assert len(matches) == 3
+    assert searcher.searched_files == 2
+
+    searcher = Search("whatever", [".txt"], files_with_matches=True)
+    matches = searcher.search_folder(".", subdirs=True, print_matches=False)
+    assert [match.position for match in matches] == [3, 3]
+    assert searcher.searched_lines == 6
+
+    searcher = Search("whatever", [".txt"])
+    for match in searcher.iter_matches(".", subdirs=True):
+        searcher.stop()
+    assert searcher.match_count == 1
+    assert searcher.searched_files == 1
+
+@pytest.mark.unit_test
+def test_search_deadline(tmp_path, capsys, monkeypatch):
+    """class: Search, with a deadline
+    """
+    for folder in ["a", "b"]:
+        tmp_path.joinpath(folder).mkdir()
+        for name in ["1.txt", "2.txt", "3.txt"]:
+            tmp_path.joinpath(folder, name).write_text("whatever\n")
+    searcher = Search("whatever", [".txt"])
+    for match in searcher.iter_matches(str(tmp_path), subdirs=True):
+        searcher.deadline = 0.0  # the deadline passes during the first file
+    for match in searcher.iter_matches(str(tmp_path / "b")):
+        pass
+    assert searcher.timed_out
+    assert (searcher.match_count, searcher.searched_files) == (1, 1)
+    # b is skipped twice, as a subfolder and as a search root
+    assert (searcher.skipped_folders, searcher.skipped_files) == (2, 2)
+    summary = searcher.summary_record()
+    assert summary["partial"] and summary["skipped_files"] == 2
+    searcher.print_summary()
+    out, _ = capsys.readouterr()
+    assert "Partial: timed out, 2 folders and 2 files not searched" in out
+
+    # the files queued for worker processes are skipped
+    searcher = Search("whatever", [".txt"], workers=2)
+    for match in searcher.iter_matches(str(tmp_path), subdirs=True):
+        searcher.deadline = 0.0
+    searcher.close()
+    assert (searcher.searched_files, searcher.skipped_files) == (1, 5)
+
+    searcher.reset_totals()
+    searcher.deadline = time.monotonic() + 60
+    assert len(searcher.search_folder(str(tmp_path), True, False)) == 6
+    assert not searcher.summary_record()["partial"]
+    searcher.close()
+
+    # the deadline is checked while indexing, while a file is read line by
+    # line or scanned through a memory map, and between the members of an
+    # archive
+    searcher = Search("whatever", [".txt"])
+
+    def slow_index(file):
+        searcher.deadline = 0.0
+
+    searcher.skip_file = slow_index
+    assert not searcher.search_folder(str(tmp_path), True, False)
+    assert (searcher.searched_files, searcher.skipped_files) == (0, 3)
+
+    big_file = tmp_path / "big.txt"
+    big_file.write_text("nothing\n" * config.STOP_CHECK_LINES * 3)
+    for context in [(0, 0), (1, 0)]:
+        file_matches = iter_file_matches(
+            big_file, "müller", stop=lambda: True, context=context
+        )
+        with pytest.raises(StopIteration) as done:
+            next(file_matches)
+        assert done.value.value[0] == config.STOP_CHECK_LINES
+
+    # the mmap engine checks it before each chunk of the carriage return scan,
+    # and after each chunk of the search
+    monkeypatch.setattr(config, "MMAP_CHUNK_SIZE", 1000)
+    chunks = -(-big_file.stat().st_size // 1000)
+    for stop_after, totals in [(0, (0, 0)), (chunks, (126, 1008))]:
+        file_matches = iter_file_matches(
+            big_file,
+            "whatever",
+            engine="mmap",
+            stop=iter([False] * stop_after + [True]).__next__,
+        )
+        with pytest.raises(StopIteration) as done:
+            next(file_matches)
+        assert done.value.value == totals
+
+    archive = tmp_path / "archive.zip"
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("module.txt", "whatever\n")
+    archive_matches = iter_archive_matches(
+        archive, TextMatcher("whatever"), [".txt"], stop=lambda: True
+    )
+    with pytest.raises(StopIteration) as done:
+        next(archive_matches)
+    assert done.value.value == (0, 0)
+
+@pytest.mark.unit_test
+def test_search_recent(tmp_path):
+    """method: Search.iter_folders_matches(), with and without recent
+    """
+    for number, name in enumerate(["a/old.txt", "b/new.txt", "a/newer.txt"]):
+        tmp_path.joinpath(name).parent.mkdir(exist_ok=True)
+        tmp_path.joinpath(name).write_text("whatever\n")
+        os.utime(tmp_path / name, ns=(number * 10 ** 9, number * 10 ** 9))
+    roots = [str(tmp_path / "a"), str(tmp_path / "b")]
+
+    searcher = Search("whatever", [".txt"], recent=True)
+    matches = list(searcher.iter_folders_matches(roots))
+    assert [match.file.name for match in matches] == [
+        "newer.txt",
+        "new.txt",
+        "old.txt",
+    ]
+    assert (searcher.searched_folders, searcher.searched_files) == (2, 3)
+
+    # the most recent match is found first, in either root
+    searcher = Search("whatever", [".txt"], recent=True, max_results=1)
+    matches = list(searcher.iter_folders_matches(roots[::-1]))
+    assert [match.file.name for match in matches] == ["newer.txt"]
+    assert searcher.searched_files == 1
+
+    searcher = Search("whatever", [".txt"], recent=True, deadline=0.0)
+    assert not list(searcher.iter_folders_matches(roots))
+    assert (searcher.skipped_folders, searcher.skipped_files) == (2, 0)
+
+    searcher = Search("whatever", [".txt"])
+    matches = list(searcher.iter_folders_matches(roots[::-1]))
+    assert matches[0].file.name == "new.txt"
+
+    # a file deleted after the walk is skipped, and the search goes on
+    searcher = Search("whatever", [".txt"], recent=True)
+    matches = searcher.iter_folders_matches(roots)
+    assert next(matches).file.name == "newer.txt"
+    tmp_path.joinpath("a/old.txt").unlink()
+    assert [match.file.name for match in matches] == ["new.txt"]
+    assert (searcher.searched_files, searcher.skipped_files) == (2, 1)
+
+    searcher = Search("whatever", [".txt"], workers=2)
+    files = [tmp_path / "a/old.txt", tmp_path / "b/new.txt"]
+    assert len(list(searcher.search_files(files))) == 1
+    assert searcher.skipped_files == 1
+
+@pytest.mark.unit_test
+def test_server(tmp_path):
+    """class: Server, with query_server() and Search.iter_server_matches()
+    """
+    (tmp_path / "projects.txt").write_text(str(Path(".").resolve()))
+    server = Server(tmp_path)
+    assert query_server(server.socket_file, {}) is None  # not running yet
+    thread = threading.Thread(target=server.serve, args=(7,))
+    thread.start()
+    while not server.socket_file.exists():
+        time.sleep(0.01)
+
+    # bad requests get an error record, and don't stop the server
+    options = {"search_for": "whatever", "file_types": [".txt"]}
+    for request, record_type in [
+        ({}, "error"),
+        ({"options": "whatever"}, "error"),
+        ({"options": options, "timeout": "1"}, "error"),
+        ({"options": dict(options, bad=1)}, "error"),
+        ({"options": options}, "summary"),  # subdirs defaults to False
+    ]:
+        records = list(query_server(server.socket_file, request))
+        assert records[-1]["type"] == record_type
+
+    plain = Search("whatever", [".txt", ".ipynb"])
+    plain_matches = plain.search_folder(".", subdirs=True, print_matches=False)
+    for _ in range(2):  # a cold search, then a warm one
+        searcher = Search("whatever", [".txt", ".ipynb"])
+        records = query_server(
+            server.socket_file,
+            {
+                "options": {"search_for": "whatever", "file_types": [".txt", ".ipynb"]},
+                "subdirs": True,
+            },
+        )
+        matches = list(searcher.iter_server_matches(records))
+        assert [(str(match.file), match.position, match.span) for match in matches] == [
+            (str(match.file.resolve()), match.position, match.span)
+            for match in plain_matches
+        ]
+        assert searcher.searched_lines == plain.searched_lines
+    thread.join()
+    assert not server.socket_file.exists()
+
+@pytest.mark.unit_test
+def test_search_stats(capsys):
+    """class: SearchStats, with Search.print_stats()
+    """
+    searcher = Search("whatever", [".txt", ".ipynb"], stats=True)
+    matches = searcher.search_folder(".", subdirs=True, print_matches=False)
+    assert len(matches) == 4
+    # the block engine is used as without stats, and only decodes matched lines
+    assert {"walk", "open", "read", "match", "notebook"} <= set(
+        searcher.stats.phases
+    )
+    assert "decode" not in searcher.stats.phases
+    plain = Search("whatever", [".txt", ".ipynb"])
+    plain.search_folder(".", subdirs=True, print_matches=False)
+    assert searcher.searched_bytes == plain.searched_bytes
+    slowest = [name for _, name in searcher.stats.slowest_files()]
+    assert len(slowest) == 4
+    assert str(Path("subfolder", "testdata.txt")) in slowest
+    searcher.print_summary()
+    out, err = capsys.readouterr()
+    assert "Slowest files:" in out
+    assert err == ""
+
+    # context lines need the whole file decoded and split into lines
+    searcher = Search("whatever", [".txt"], stats=True, context=(1, 0))
+    searcher.search_folder(".", subdirs=True, print_matches=False)
+    assert {"read", "decode", "match"} <= set(searcher.stats.phases)
+
+@pytest.mark.unit_test
+def test_search_folder_workers():
+    """method: Search.search_folder() with a worker pool
+    """
+    serial = Search("whatever", [".txt", ".py"])
+    serial_matches = serial.search_folder(".", subdirs=True, print_matches=False)
+    parallel = Search("whatever", [".txt", ".py"], workers=2)
+    parallel_matches = parallel.search_folder(".", subdirs=True, print_matches=False)
+    parallel.close()
+    assert [(str(match.file), match.position) for match in parallel_matches] == [
+        (str(match.file), match.position) for match in serial_matches
+    ]
+    assert parallel.searched_files == serial.searched_files
+    assert parallel.searched_lines == serial.searched_lines
+    assert parallel.searched_bytes == serial.searched_bytes
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize(
+    "search_for", ["whatever", "import", "requests", "zzz", ["zzz", "whatever"]]
+)
+def test_trigram_index(tmp_path, search_for):
+    """class: TrigramIndex
+    """
+    plain = Search(search_for, [".txt", ".py", ".ipynb"])
+    plain_matches = plain.search_folder(".", subdirs=True, print_matches=False)
+    for _ in range(2):  # build the index, then search with the saved index
+        indexed = Search(search_for, [".txt", ".py", ".ipynb"])
+        indexed.index = TrigramIndex(tmp_path / "test.index")
+        indexed_matches = indexed.search_folder(".", subdirs=True, print_matches=False)
+        indexed.close()
+        assert [(str(match.file), match.position) for match in indexed_matches] == [
+            (str(match.file), match.position) for match in plain_matches
+        ]
+        assert indexed.searched_files == plain.searched_files
+        assert indexed.searched_lines == plain.searched_lines
+        assert indexed.searched_bytes == plain.searched_bytes
+    index = TrigramIndex(tmp_path / "test.index")
+    assert not index.may_contain(index.refresh(Path("testdata.py")), "whatever")
+    assert index.may_contain(index.refresh(Path("testdata.py")), "PATHLIB")
+    assert index.may_contain(index.refresh(Path("testdata.py")), ["zzz", "PATHLIB"])
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("search_for", ["müller", "whatever", "zzz"])
+@pytest.mark.parametrize("context", [(0, 0), (1, 0)])
+def test_trigram_index_encodings(tmp_path, search_for, context):
+    """class: TrigramIndex, with the same results as searching without it
+    """
+    folder = tmp_path / "files"
+    folder.mkdir()
+    folder.joinpath("latin1.txt").write_bytes(
+        "# -*- coding: latin-1 -*-\nname = 'müller'\n".encode("latin-1")
+    )
+    folder.joinpath("binary.txt").write_bytes("whatever\0müller\n".encode() * 10)
+    folder.joinpath("cr.txt").write_bytes(b"first\rsecond\rthird\r")
+    folder.joinpath("crlf.txt").write_bytes(b"first\r\nwhatever\r\n")
+    plain = Search(search_for, [".txt"], context=context)
+    plain_matches = plain.search_folder(str(folder), print_matches=False)
+    for _ in range(2):  # build the index, then search with the saved index
+        indexed = Search(search_for, [".txt"], context=context)
+        indexed.index = TrigramIndex(tmp_path / "test.index")
+        indexed_matches = indexed.search_folder(str(folder), print_matches=False)
+        indexed.close()
+        assert [(match.file.name, match.position) for match in indexed_matches] == [
+            (match.file.name, match.position) for match in plain_matches
+        ]
+        assert (indexed.searched_lines, indexed.searched_bytes) == (
+            plain.searched_lines,
+            plain.searched_bytes,
+        )
+    assert len(plain_matches) == (0 if search_for == "zzz" else 1)
+
+@pytest.mark.unit_test
+def test_versioned_index(tmp_path):
+    """class: VersionedIndex
+    """
+    site_packages = tmp_path / "site-packages"
+    (site_packages / "spam").mkdir(parents=True)
+    owned = site_packages / "spam" / "eggs.py"
+    owned.write_text("import json\n")
+    unowned = site_packages / "loose.py"
+    unowned.write_text("import json\n")
+    info = site_packages / "spam-1.0.dist-info"
+    info.mkdir()
+    (info / "RECORD").write_text("spam/eggs.py,,\nspam-1.0.dist-info/RECORD,,\n")
+    index_file = tmp_path / "packages.index"
+
+    def search(search_for):
+        searcher = Search(search_for, [".py"])
+        searcher.index = VersionedIndex(index_file, site_packages, packages=True)
+        matches = searcher.search_folder(
+            site_packages, subdirs=True, print_matches=False
+        )
+        searcher.close()
+        return sorted(match.file.name for match in matches)
+
+    assert search("json") == ["eggs.py", "loose.py"]
+    # files of unchanged distributions aren't checked for changes
+    owned.write_text("import pickle\n")
+    unowned.write_text("import pickle\n")
+    assert search("pickle") == ["loose.py"]
+    # upgrading the distribution re-indexes its files
+    info.rename(site_packages / "spam-1.1.dist-info")
+    assert search("pickle") == ["eggs.py", "loose.py"]
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watcher(tmp_path, inotify):
+    """class: Watcher
+    """
+    project = tmp_path / "project"
+    (project / "__pycache__").mkdir(parents=True)
+    changed = project / "changed.py"
+    changed.write_text("import json\n")
+    deleted = project / "deleted.py"
+    deleted.write_text("import json\n")
+    searcher = Search("", [".py"])
+    searcher.index = TrigramIndex(tmp_path / "test.index")
+    watcher = Watcher(searcher, [str(project)])
+    if not inotify:
+        watcher.close()
+    thread = threading.Thread(target=watcher.watch, args=(1.5,))
+    thread.start()
+    time.sleep(0.5)
+    changed.write_text("import pickle\n")
+    deleted.unlink()
+    (project / "sub").mkdir()
+    (project / "sub" / "created.py").write_text("import pickle\n")
+    (project / "__pycache__" / "skipped.py").write_text("import pickle\n")
+    thread.join()
+    watcher.close()
+
+    index = TrigramIndex(tmp_path / "test.index")
+    assert sorted(Path(key).name for key in index.entries) == [
+        "changed.py",
+        "created.py",
+    ]
+    entry = index.entries[str(changed.resolve())]
+    assert entry[:2] == (changed.stat().st_mtime_ns, changed.stat().st_size)
+    assert index.may_contain(entry, "pickle")
+
+@pytest.mark.unit_test
+def test_walk_folder(tmp_path):
+    """method: Search.walk_folder()
+    """
+    for folder in [
+        "src",
+        "src/pkg",
+        ".git/objects",
+        "src/pkg.egg-info",
+        "node_modules/lib",
+        "build/gen",
+    ]:
+        tmp_path.joinpath(folder).mkdir(parents=True)
+        tmp_path.joinpath(folder, "module.py").write_text("import os\n")
+        tmp_path.joinpath(folder, "notes.md").write_text("import os\n")
+    searcher = Search(
+        "import",
+        [".py"],
+        skipped_globs=["*.egg-info", "node_*"],
+        skipped_regexes=[r"build[\\/]gen$"],
+    )
+    files = list(searcher.walk_folder(str(tmp_path), subdirs=True))
+    assert sorted(file.relative_to(tmp_path).as_posix() for file in files) == [
+        "src/module.py",
+        "src/pkg/module.py",
+    ]
+    # .git, node_modules and build/gen are pruned, build is not
+    assert searcher.searched_folders == 4
+
+@pytest.mark.unit_test
+def test_walk_folder_gitignore(tmp_path):
+    """method: Search.walk_folder() with .gitignore rules
+    """
+    for folder in ["src/gen", "venv/lib", "dist", "docs/build"]:
+        tmp_path.joinpath(folder).mkdir(parents=True)
+    for file in [
+        "setup.py",
+        "src/app.py",
+        "src/app_pb2.py",
+        "src/keep_pb2.py",
+        "src/gen/out.py",
+        "venv/lib/site.py",
+        "dist/wheel.py",
+        "docs/build/conf.py",
+        "docs/conf.py",
+    ]:
+        tmp_path.joinpath(file).write_text("import os\n")
+    tmp_path.joinpath(".gitignore").write_text(
+        "# comment\n\nvenv/\n/dist\n*_pb2.py\n!keep_pb2.py\n"
+    )
+    tmp_path.joinpath("src", ".gitignore").write_text("gen/\n")
+    tmp_path.joinpath("docs", ".gitignore").write_text("build\n")
+    searcher = Search("import", [".py"], gitignore=True)
+    files = list(searcher.walk_folder(str(tmp_path), subdirs=True))
+    assert sorted(file.relative_to(tmp_path).as_posix() for file in files) == [
+        "docs/conf.py",
+        "setup.py",
+        "src/app.py",
+        "src/keep_pb2.py",
+    ]
+    searcher = Search("import", [".py"])
+    assert len(list(searcher.walk_folder(str(tmp_path), subdirs=True))) == 9
+
+@pytest.mark.unit_test
+def test_walk_folder_visited(tmp_path):
+    """methods: Search.walk_folder() and Search.search_roots() with overlapping
+    roots, hard links and symlinks
+    """
+    tmp_path.joinpath("repo", "pkg").mkdir(parents=True)
+    tmp_path.joinpath("repo", "archive", "lib").mkdir(parents=True)
+    tmp_path.joinpath("repo", "module.py").write_text("import os\n")
+    tmp_path.joinpath("repo", "pkg", "core.py").write_text("import os\n")
+    os.link(tmp_path / "repo" / "module.py", tmp_path / "repo" / "pkg" / "hard.py")
+    tmp_path.joinpath("repo", "pkg", "loop").symlink_to(tmp_path / "repo")
+    tmp_path.joinpath("repo", "alias.py").symlink_to(tmp_path / "repo" / "module.py")
+    tmp_path.joinpath("link").symlink_to(tmp_path / "repo")
+    searcher = Search("import", [".py"])
+    roots = [
+        str(tmp_path / "repo" / "pkg"),
+        str(tmp_path / "link"),
+        str(tmp_path / "repo"),
+        str(tmp_path / "repo" / "archive" / "lib"),
+    ]
+    # pkg is inside repo, link is repo, and archive is skipped in repo
+    assert searcher.search_roots(roots, subdirs=True) == [
+        str(tmp_path / "repo"),
+        str(tmp_path / "repo" / "archive" / "lib"),
+    ]
+    assert searcher.search_roots(roots) == [
+        str(tmp_path / "repo" / "pkg"),
+        str(tmp_path / "repo"),
+        str(tmp_path / "repo" / "archive" / "lib"),
+    ]
+
+    # each folder is searched once, and module.py is searched once, through
+    # whichever of its names is found first
+    for follow_links in [False, True]:
+        searcher = Search("import", [".py"], follow_links=follow_links)
+        files = [
+            file.relative_to(tmp_path).as_posix()
+            for root in roots
+            for file in searcher.walk_folder(root, subdirs=True)
+        ]
+        assert len(files) == 2 and "repo/pkg/core.py" in files
+        assert searcher.searched_folders == 3
+        searcher.reset_totals()
+        assert len(list(searcher.walk_folder(roots[2], subdirs=True))) == 2
+
+    # each search_folder() call is a new search, but the roots of one
+    # iter_folders_matches() call are one search
+    searcher = Search("import", [".py"])
+    for _ in range(2):
+        matches = searcher.search_folder(roots[2], subdirs=True, print_matches=False)
+        assert len(matches) == 2
+    for _ in range(2):
+        assert len(list(searcher.iter_folders_matches(roots, subdirs=True))) == 2
+
+@pytest.mark.unit_test
+def test_benchmark_corpora(tmp_path):
+    """function: benchmark.generate_corpora()
+    """
+    for run in ["first", "second"]:
+        benchmark.generate_corpora(tmp_path / run, scale=0.01, seed=7)
+    first = sorted((tmp_path / "first").rglob("*.*"))
+    assert len(first) > len(benchmark.CORPORA)
+    for file in first:
+        second = tmp_path / "second" / file.relative_to(tmp_path / "first")
+        assert file.read_bytes() == second.read_bytes()
+    result = benchmark.run_case(tmp_path / "first" / "huge_file", {"engine": "mmap"})
+    assert result["first_match"] is not None
+    assert result["lines"] == 2001
+
 @pytest.mark.unit_test
 def test_textfile_to_list():
     """function: textfile_to_list()
@@ -287,5 +1221,83 @@ def test_cli_packages() -> None:
     assert "termui.py" in result.output
 
 
+@pytest.mark.cli
+def test_cli_files_with_matches() -> None:
+    """Test the --files-with-matches option.
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, ["whatever", ".", "-ft=txt", "-s", "-l"])
+    assert result.exit_code == 0
+    assert "line 3:" not in result.output
+    assert result.output.count("testdata.txt") == 2
+
+
+@pytest.mark.cli
+def test_cli_jsonl() -> None:
+    """Test the --format=jsonl option.
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, ["whatever", ".", "-ft=txt", "--format=jsonl"])
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert records[0] == {
+        "type": "match",
+        "path": "testdata.txt",
+        "line": 3,
+        "column": 14,
+        "text": 'Should find "whatever" on lines 3 and 4.',
+    }
+    assert records[1]["line"] == 4
+    assert records[2]["type"] == "summary"
+    assert records[2]["files"] == 1
+    assert not records[2]["partial"]
+
+    result = runner.invoke(
+        cli, ["whatever", ".", "-ft=txt", "--format=jsonl", "--timeout=0"]
+    )
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert records == [
+        {
+            "type": "summary",
+            "folders": 0,
+            "files": 0,
+            "lines": 0,
+            "bytes": 0,
+            "partial": True,
+            "skipped_folders": 1,
+            "skipped_files": 0,
+        }
+    ]
+
+
+@pytest.mark.cli
+def test_cli_patterns_file(tmp_path) -> None:
+    """Test the -f/--patterns-file option.
+    """
+    patterns_file = tmp_path / "patterns.txt"
+    patterns_file.write_text("whatever\nPathlib\n")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["-f", str(patterns_file), ".", "-ft=py/txt", "--format=jsonl"]
+    )
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in result.output.splitlines()]
+    assert {record["pattern"] for record in records[:-1]} == {"whatever", "Pathlib"}
+    assert records[-1]["type"] == "summary"
+
+
+@pytest.mark.cli
+def test_cli_profile(tmp_path) -> None:
+    """Test the --profile option, including *projects without a projects.txt.
+    """
+    runner = CliRunner()
+    for number, startdir in enumerate([".", "*projects"]):
+        profile = tmp_path / f"{number}.prof"
+        result = runner.invoke(cli, ["whatever", startdir, f"--profile={profile}"])
+        assert result.exit_code == 0
+        assert pstats.Stats(str(profile)).total_calls > 0
+
+
 if __name__ == "__main__":
     pytest.main()  # run all tests